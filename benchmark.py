@@ -0,0 +1,661 @@
+""" benchmark.py
+
+Offline benchmark harness for the download pipeline of process_duty_csv.
+Consists of a generator of synthetic duty CSVs, a local HTTP server with
+configurable latency, bandwidth and failure rate that serves synthetic files
+of the sizes named in their URLs, and a headless driver that runs ProcessCSV
+end to end into a temporary directory. The driver reports the wall time,
+throughput and peak (Python heap) memory of each stage, so that changes to
+the download path can be compared
+
+    python benchmark.py generate out.csv --rows 500 --sizes duty \\
+        --url http://127.0.0.1:8000 --destination C:/benchmark/
+    python benchmark.py serve --port 8000 --latency 0.05 --failure-rate 0.01
+    python benchmark.py run --rows 200 --sizes lognormal --jobs 8
+"""
+import os
+import re
+import sys
+import csv
+import json
+import math
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import logging
+import http.server
+import config
+
+# Synthetic file contents, byte i of every file is i % 256. The pattern is a
+# multiple of 256 bytes so that any offset can be served from it
+PATTERN = bytes(range(256)) * 256
+REPORT_EXTENSIONS = (".pdf", ".xlsx", ".vcf.gz", ".html", ".txt")
+FILES_PATH_REGEX = re.compile(r"/files/(\d+)/[^/?]+")
+
+
+def fixed_size(rng: random.Random, args: argparse.Namespace) -> int:
+    """
+    Return args.size for every file
+        :param rng (obj):   Random number generator
+        :param args (obj):  Parsed command line arguments
+        :return (int):      File size in bytes
+    """
+    return args.size
+
+
+def uniform_size(rng: random.Random, args: argparse.Namespace) -> int:
+    """
+    Return a size drawn uniformly between args.min_size and args.max_size
+        :param rng (obj):   Random number generator
+        :param args (obj):  Parsed command line arguments
+        :return (int):      File size in bytes
+    """
+    return rng.randint(args.min_size, args.max_size)
+
+
+def lognormal_size(rng: random.Random, args: argparse.Namespace) -> int:
+    """
+    Return a size drawn from a lognormal distribution with median
+    args.size, clipped to args.min_size and args.max_size
+        :param rng (obj):   Random number generator
+        :param args (obj):  Parsed command line arguments
+        :return (int):      File size in bytes
+    """
+    size = int(rng.lognormvariate(math.log(args.size), args.sigma))
+    return max(args.min_size, min(args.max_size, size))
+
+
+def duty_size(rng: random.Random, args: argparse.Namespace) -> int:
+    """
+    Return a size resembling a duty CSV: mostly small reports, with a
+    fraction (args.large_fraction) of large BAM-like files between a quarter
+    of args.max_size and args.max_size
+        :param rng (obj):   Random number generator
+        :param args (obj):  Parsed command line arguments
+        :return (int):      File size in bytes
+    """
+    if rng.random() < args.large_fraction:
+        return rng.randint(args.max_size // 4, args.max_size)
+    return lognormal_size(rng, args)
+
+
+SIZE_DISTRIBUTIONS = {
+    "fixed": fixed_size,
+    "uniform": uniform_size,
+    "lognormal": lognormal_size,
+    "duty": duty_size,
+}
+
+
+def synthetic_md5(size: int) -> str:
+    """
+    Return the MD5 checksum of a synthetic file
+        :param size (int):  File size in bytes
+        :return (str):      MD5 hex digest
+    """
+    digest = hashlib.md5()
+    remaining = size
+    while remaining:
+        chunk = PATTERN[: min(remaining, len(PATTERN))]
+        digest.update(chunk)
+        remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def generate_csv(
+    csv_path: str, url: str, destination: str, args: argparse.Namespace
+) -> int:
+    """
+    Write a synthetic duty CSV whose rows download files from the benchmark
+    server. Rows are spread over args.dirs destination subdirectories, and
+    the Size and md5 columns are included if requested
+        :param csv_path (str):      Path of the CSV to write
+        :param url (str):           Base URL of the benchmark server
+        :param destination (str):   Destination root directory
+        :param args (obj):          Parsed command line arguments
+        :return (int):              Total size of the files in bytes
+    """
+    rng = random.Random(args.seed)
+    distribution = SIZE_DISTRIBUTIONS[args.sizes]
+    header = ["Url", "GSTT_dir", "subdir"]
+    if args.size_column:
+        header.append("Size")
+    if args.md5:
+        header.append("md5")
+    total = 0
+    with open(csv_path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for index in range(args.rows):
+            size = distribution(rng, args)
+            if size >= args.max_size // 4 and args.sizes == "duty":
+                extension = ".bam"
+            elif args.sizes == "duty":
+                extension = rng.choice(REPORT_EXTENSIONS)
+            else:
+                extension = ".bin"
+            row = [
+                f"{url}/files/{size}/file_{index:06d}{extension}",
+                destination,
+                f"dir_{index % args.dirs:03d}/",
+            ]
+            if args.size_column:
+                row.append(size)
+            if args.md5:
+                row.append(synthetic_md5(size))
+            writer.writerow(row)
+            total += size
+    return total
+
+
+class SyntheticFileHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve synthetic files at /files/<size>/<name>, with the latency,
+    bandwidth and failure rate set on the server. HEAD and single Range
+    requests (bytes=start- and bytes=start-end) are supported, so the
+    probing, resume and segmented download paths are exercised. A failed
+    request either returns HTTP 503 or drops the connection half way
+    through the body
+
+    Methods
+        do_HEAD()
+            Send the headers of a synthetic file
+        do_GET()
+            Send a synthetic file, or the requested range of it
+        _send()
+            Send the response headers and, unless a HEAD request, the body
+        _write_body()
+            Write the body from the pattern, limited to the server bandwidth
+        log_message()
+            Discard the per-request access log
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self) -> None:
+        """
+        Send the headers of a synthetic file
+        """
+        self._send(body=False)
+
+    def do_GET(self) -> None:
+        """
+        Send a synthetic file, or the requested range of it
+        """
+        self._send(body=True)
+
+    def _send(self, body: bool) -> None:
+        """
+        Send the response headers and, unless a HEAD request, the body
+            :param body (bool): False for a HEAD request
+        """
+        server = self.server
+        time.sleep(server.latency)
+        match = FILES_PATH_REGEX.fullmatch(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        size = int(match.group(1))
+        with server.lock:
+            failure = server.rng.random() < server.failure_rate
+            drop = server.rng.random() < 0.5
+        if failure and not (drop and body):
+            self.send_error(503)
+            return
+        start, last = 0, size - 1
+        range_match = re.fullmatch(
+            r"bytes=(\d+)-(\d*)", self.headers.get("Range", "")
+        )
+        if range_match:
+            first = int(range_match.group(1))
+            final = size - 1
+            if range_match.group(2):
+                final = min(int(range_match.group(2)), size - 1)
+            if first <= final:
+                start, last = first, final
+            else:
+                # An unsatisfiable range is ignored and the whole file sent
+                range_match = None
+        if range_match:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{last}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(last + 1 - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{size}"')
+        self.end_headers()
+        if body:
+            end = start + (last + 1 - start) // 2 if failure else last + 1
+            self._write_body(start, end)
+            if failure:
+                self.close_connection = True
+
+    def _write_body(self, start: int, end: int) -> None:
+        """
+        Write bytes start to end of the synthetic file from the pattern,
+        sleeping as needed to stay within the server bandwidth
+            :param start (int): First byte offset
+            :param end (int):   Offset to stop at
+        """
+        bandwidth = self.server.bandwidth
+        began = time.perf_counter()
+        offset = start
+        while offset < end:
+            pattern_offset = offset % 256
+            chunk = PATTERN[
+                pattern_offset : pattern_offset
+                + min(end - offset, len(PATTERN) - pattern_offset)
+            ]
+            self.wfile.write(chunk)
+            offset += len(chunk)
+            if bandwidth:
+                ahead = (offset - start) / bandwidth - (
+                    time.perf_counter() - began
+                )
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def log_message(self, format: str, *args) -> None:
+        """
+        Discard the per-request access log
+        """
+
+
+class SyntheticFileServer(http.server.ThreadingHTTPServer):
+    """
+    Threaded HTTP server for SyntheticFileHandler. Clients that close the
+    connection early, e.g. a cancelled or timed out download, are expected,
+    so their connection errors are not printed into the benchmark report
+
+    Methods
+        handle_error()
+            Ignore connections closed by the client, otherwise print the
+            traceback
+    """
+
+    def handle_error(self, request, client_address) -> None:
+        """
+        Ignore connections closed by the client (ConnectionResetError,
+        BrokenPipeError), otherwise print the traceback
+            :param request (obj):           Client socket
+            :param client_address (tuple):  Client address and port
+        """
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(
+    host: str,
+    port: int,
+    latency: float,
+    bandwidth: int,
+    failure_rate: float,
+    seed: int,
+) -> SyntheticFileServer:
+    """
+    Start the benchmark server in a background thread
+        :param host (str):          Address to listen on
+        :param port (int):          Port to listen on, 0 for any free port
+        :param latency (float):     Seconds to wait before each response
+        :param bandwidth (int):     Bytes per second per connection, 0 for
+                                    unlimited
+        :param failure_rate (float):Fraction of requests that fail
+        :param seed (int):          Seed for the failure random numbers
+        :return (obj):              Running server
+    """
+    server = SyntheticFileServer((host, port), SyntheticFileHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.failure_rate = failure_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    threading.Thread(
+        target=server.serve_forever, name="benchmark_server", daemon=True
+    ).start()
+    return server
+
+
+class Stage:
+    """
+    Measure the wall time and peak Python heap memory of a benchmark stage
+
+    Methods
+        __enter__()
+            Start timing and reset the tracemalloc peak
+        __exit__()
+            Record the wall time and peak memory
+        result()
+            Return the stage's measurements
+    """
+
+    def __init__(self, name: str):
+        """
+        Constructor for the Stage class
+            :param name (str):  Stage name
+        """
+        self.name = name
+        self.seconds = None
+        self.peak_memory = None
+        self.count = None
+        self.unit = None
+        self.status = "ok"
+        self._start = None
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        self.seconds = time.perf_counter() - self._start
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        if exc_type is SystemExit:
+            self.status = "failed"
+            return True
+        return False
+
+    def result(self) -> dict:
+        """
+        Return the stage's measurements
+            :return (dict): Stage name, status, wall time, throughput and
+                            peak memory
+        """
+        throughput = None
+        if self.count is not None and self.seconds:
+            throughput = self.count / self.seconds
+        return {
+            "stage": self.name,
+            "status": self.status,
+            "seconds": round(self.seconds, 3),
+            "count": self.count,
+            "unit": self.unit,
+            "throughput_per_second": (
+                None if throughput is None else round(throughput, 1)
+            ),
+            "peak_memory_bytes": self.peak_memory,
+        }
+
+
+def run_benchmark(args: argparse.Namespace) -> list:
+    """
+    Run ProcessCSV end to end on a synthetic CSV against the benchmark
+    server, in a temporary directory, measuring each stage
+        :param args (obj):  Parsed command line arguments
+        :return (list):     Stage measurements
+    """
+    # Imported here so the generate and serve commands do not load the
+    # download pipeline
+    import process_duty_csv
+    from csv_reader import read_rows
+    from transport import get_transport
+    from throttle import BandwidthThrottle
+
+    root = tempfile.mkdtemp(prefix="process_duty_csv_benchmark_")
+    root = root.replace("\\", "/")
+    csv_folder = f"{root}/csv/"
+    destination = f"{root}/destination/"
+    os.makedirs(destination)
+    for directory in config.DIRS.values():
+        os.makedirs(directory % csv_folder)
+    config.CSV_FOLDER["TEST"] = csv_folder
+    csv_path = f"{csv_folder}benchmark.duty_csv.csv"
+    logfile_path = f"{config.DIRS['LOGS'] % csv_folder}benchmark.log"
+    logger_obj, logger = process_duty_csv.get_logger(logfile_path, "benchmark")
+    if not args.verbose:
+        for handler in logger_obj.listener.handlers:
+            if type(handler) is logging.StreamHandler:
+                handler.setLevel(logging.WARNING)
+    server = start_server(
+        "127.0.0.1",
+        0,
+        args.latency,
+        args.bandwidth,
+        args.failure_rate,
+        args.seed,
+    )
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    transport = get_transport(args.transport)
+    if transport.name == "http":
+        # The benchmark server is local, so the bandwidth profiles for the
+        # Trust's network link do not apply
+        transport.throttle = BandwidthThrottle([])
+    stages = []
+    tracemalloc.start()
+    try:
+        with Stage("generate CSV") as stage:
+            total_bytes = generate_csv(csv_path, url, destination, args)
+            stage.count, stage.unit = args.rows, "rows"
+        stages.append(stage)
+
+        with Stage("read CSV") as stage:
+            stage.count = sum(1 for _ in read_rows(csv_path))
+            stage.unit = "rows"
+        stages.append(stage)
+
+        def new_process():
+            return process_duty_csv.ProcessCSV(
+                csv_path,
+                "TEST",
+                logfile_path,
+                logger_obj,
+                transport,
+                args.jobs,
+                args.share_jobs,
+            )
+
+        with Stage("create tasks") as stage:
+            process = new_process()
+            stage.count = len(list(process.iter_tasks()))
+            stage.unit = "tasks"
+            process.journal.close()
+            process.checksum_pool.close()
+        stages.append(stage)
+
+        with Stage("download") as stage:
+            process = new_process()
+            stage.count, stage.unit = total_bytes, "bytes"
+            process.download_data()
+        stages.append(stage)
+
+        if stage.status == "ok":
+            with Stage("archive CSV") as stage:
+                process.archive_csv()
+                stage.count, stage.unit = 1, "CSVs"
+            stages.append(stage)
+    finally:
+        tracemalloc.stop()
+        server.shutdown()
+        transport.close()
+        logger_obj.shutdown_logs()
+        if args.keep:
+            print(f"Benchmark files kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    return [stage.result() for stage in stages]
+
+
+def print_report(results: list) -> None:
+    """
+    Print the stage measurements as a table
+        :param results (list):  Stage measurements
+    """
+    print(
+        f"{'Stage':<14}{'Status':<8}{'Wall time':>11}"
+        f"{'Throughput':>24}{'Peak memory':>16}"
+    )
+    for result in results:
+        throughput = result["throughput_per_second"]
+        if throughput is None:
+            throughput = "-"
+        elif result["unit"] == "bytes":
+            throughput = f"{throughput / 1024 ** 2:.1f} MiB/s"
+        else:
+            throughput = f"{throughput:.1f} {result['unit']}/s"
+        print(
+            f"{result['stage']:<14}{result['status']:<8}"
+            f"{result['seconds']:>10.3f}s{throughput:>24}"
+            f"{result['peak_memory_bytes'] / 1024 ** 2:>12.1f} MiB"
+        )
+
+
+def arg_parse() -> argparse.Namespace:
+    """
+    Parse arguments supplied by the command line
+        :return (obj):  Parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the process_duty_csv download pipeline"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    csv_options = argparse.ArgumentParser(add_help=False)
+    csv_options.add_argument(
+        "--rows", type=int, default=100, help="Number of CSV rows"
+    )
+    csv_options.add_argument(
+        "--sizes",
+        choices=sorted(SIZE_DISTRIBUTIONS),
+        default="duty",
+        help="File size distribution",
+    )
+    csv_options.add_argument(
+        "--size",
+        type=int,
+        default=256 * 1024,
+        help="Fixed size, or median size of the lognormal and duty "
+        "distributions (bytes)",
+    )
+    csv_options.add_argument(
+        "--min-size", type=int, default=1024, help="Minimum size (bytes)"
+    )
+    csv_options.add_argument(
+        "--max-size",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="Maximum size (bytes)",
+    )
+    csv_options.add_argument(
+        "--sigma",
+        type=float,
+        default=1.5,
+        help="Shape of the lognormal distribution",
+    )
+    csv_options.add_argument(
+        "--large-fraction",
+        type=float,
+        default=0.05,
+        help="Fraction of large files in the duty distribution",
+    )
+    csv_options.add_argument(
+        "--dirs",
+        type=int,
+        default=4,
+        help="Number of destination subdirectories",
+    )
+    csv_options.add_argument(
+        "--size-column",
+        action="store_true",
+        help="Include the Size column, instead of sizes being probed",
+    )
+    csv_options.add_argument(
+        "--md5", action="store_true", help="Include the md5 column"
+    )
+    csv_options.add_argument(
+        "--seed", type=int, default=1, help="Random number seed"
+    )
+
+    server_options = argparse.ArgumentParser(add_help=False)
+    server_options.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds to wait before each response",
+    )
+    server_options.add_argument(
+        "--bandwidth",
+        type=int,
+        default=0,
+        help="Bytes per second per connection, 0 for unlimited",
+    )
+    server_options.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests that fail with HTTP 503 or a dropped "
+        "connection",
+    )
+
+    generate = subparsers.add_parser(
+        "generate", parents=[csv_options], help="Write a synthetic duty CSV"
+    )
+    generate.add_argument("csv_path", help="Path of the CSV to write")
+    generate.add_argument(
+        "--url",
+        default="http://127.0.0.1:8000",
+        help="Base URL of the benchmark server",
+    )
+    generate.add_argument(
+        "--destination", required=True, help="Destination root directory"
+    )
+
+    serve = subparsers.add_parser(
+        "serve",
+        parents=[server_options],
+        help="Run the benchmark server until interrupted",
+    )
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--seed", type=int, default=1)
+
+    run = subparsers.add_parser(
+        "run",
+        parents=[csv_options, server_options],
+        help="Run ProcessCSV end to end and report each stage",
+    )
+    run.add_argument("-j", "--jobs", type=int, default=config.JOBS)
+    run.add_argument("--share-jobs", type=int, default=config.SHARE_JOBS)
+    run.add_argument("--transport", default="http")
+    run.add_argument("--json", help="Also write the results to this file")
+    run.add_argument(
+        "--keep", action="store_true", help="Keep the temporary directory"
+    )
+    run.add_argument(
+        "--verbose", action="store_true", help="Print the process log"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    if args.command == "generate":
+        total = generate_csv(args.csv_path, args.url, args.destination, args)
+        print(f"Wrote {args.rows} rows ({total} bytes) to {args.csv_path}")
+    elif args.command == "serve":
+        server = start_server(
+            args.host,
+            args.port,
+            args.latency,
+            args.bandwidth,
+            args.failure_rate,
+            args.seed,
+        )
+        print(f"Serving synthetic files on http://{args.host}:{args.port}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        results = run_benchmark(args)
+        print_report(results)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as file:
+                json.dump({"args": vars(args), "stages": results}, file)
+        sys.exit(0 if all(r["status"] == "ok" for r in results) else 1)
@@ -0,0 +1,314 @@
+""" cache.py
+
+Opt-in local cache of downloaded files shared between runs. The same
+DNAnexus files appear again in later CSVs when runs are reanalysed,
+re-issued or sent to the test area; a cached file is served by a local copy
+or hardlink instead of being fetched from the cloud again. Files are
+addressed by their DNAnexus file ID where the URL contains one, otherwise by
+their expected MD5 checksum, otherwise by the URL plus a validator (ETag or
+Last-Modified and size) from a probe of the URL. The total size of the cache
+is bounded, the least recently used files being evicted first. The index is
+a JSON file in the cache directory
+"""
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+import logging
+import config
+from file_copy import link_or_copy
+from transport import UrlProber
+
+# DNAnexus file IDs, e.g. file-GZ4xk0j0xKj6Y8Bk1QQ8z7Vb
+FILE_ID_REGEX = re.compile(r"file-[0-9A-Za-z]{24}")
+
+
+def cache_key(task) -> str:
+    """
+    Return the key a task's file is cached under: its DNAnexus file ID if
+    the URL contains one, otherwise its expected MD5 checksum, otherwise its
+    URL and validator
+        :param task (DownloadTask): Download task
+        :return (str):              Cache key, or None if the file cannot be
+                                    identified without downloading it
+    """
+    match = FILE_ID_REGEX.search(task.url)
+    if match:
+        return match.group(0)
+    if task.md5:
+        return f"md5:{task.md5}"
+    if task.validator:
+        return f"url:{task.url} {task.validator}"
+    return None
+
+
+class DownloadCache:
+    """
+    Size-bounded cache of downloaded files with least recently used
+    eviction. Safe to use from multiple threads
+
+    Methods
+        contains()
+            Return the cached size of a task's file, without counting a hit
+            or miss
+        lookup()
+            Return the path of a task's cached file, counting a hit or miss
+        serve()
+            Copy or hardlink a task's cached file to its destination
+        discard()
+            Remove a task's file from the cache
+        store()
+            Add a downloaded file to the cache, evicting the least recently
+            used files to stay within the maximum size
+        log_stats()
+            Log the hit, miss and eviction counts
+        save()
+            Write the index to disk
+        close()
+            Write the index to disk and close the prober's connections
+        _evict()
+            Evict the least recently used files until the cache fits
+        _path()
+            Return the path a key's file is cached at
+    """
+
+    INDEX_NAME = "index.json"
+
+    def __init__(
+        self,
+        directory: str,
+        logger: logging.Logger,
+        max_bytes: int = config.CACHE["MAX_BYTES"],
+    ):
+        """
+        Constructor for the DownloadCache class
+            :param directory (str): Cache directory on local disk
+            :param logger (obj):    Python logging object
+            :param max_bytes (int): Maximum total size of the cached files
+        """
+        self.directory = os.path.abspath(directory)
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(self.directory, self.INDEX_NAME)
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.prober = UrlProber()
+        self._lock = threading.Lock()
+        # Keys whose files are being added by store()
+        self._storing = set()
+        os.makedirs(self.directory, exist_ok=True)
+        # key: {"size": bytes, "md5": checksum or None, "used": time}
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, encoding="utf-8") as file:
+                    self.entries = json.load(file)
+            except ValueError as exception:
+                self.logger.error(
+                    "%s was raised when reading the cache index %s, the "
+                    "cache will be rebuilt: %s",
+                    type(exception).__name__,
+                    self.index_path,
+                    exception,
+                )
+        self.logger.info(
+            "Download cache %s holds %s files (%s of %s bytes)",
+            self.directory,
+            len(self.entries),
+            sum(entry["size"] for entry in self.entries.values()),
+            self.max_bytes,
+        )
+        # The maximum size may have been lowered since the last run
+        with self._lock:
+            self._evict()
+
+    def contains(self, task) -> int:
+        """
+        Return the cached size of a task's file, without counting a hit or
+        miss. Used to consult the index before the task is scheduled
+            :param task (DownloadTask): Download task
+            :return (int):              Size in bytes, or None if not cached
+        """
+        key = cache_key(task)
+        with self._lock:
+            entry = self.entries.get(key) if key else None
+            return entry["size"] if entry else None
+
+    def lookup(self, task) -> str:
+        """
+        Return the path of a task's cached file, counting a hit or miss. If
+        the file can only be identified by its URL and validator, and the
+        validator has not yet been probed, the URL is probed first. An entry
+        whose file is missing or has changed size, or whose checksum does not
+        match the task's expected checksum, is removed
+            :param task (DownloadTask): Download task
+            :return (str):              Path of the cached file, or None
+        """
+        key = cache_key(task)
+        if key is None:
+            task.validator = self.prober.probe(task.url).validator
+            key = cache_key(task)
+        with self._lock:
+            entry = self.entries.get(key) if key else None
+            if entry is not None:
+                path = self._path(key)
+                try:
+                    valid = os.path.getsize(path) == entry["size"]
+                except OSError:
+                    valid = False
+                if task.md5 and entry["md5"] and task.md5 != entry["md5"]:
+                    valid = False
+                if valid:
+                    entry["used"] = time.time()
+                    self.hits += 1
+                    return path
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def serve(self, task, path: str) -> str:
+        """
+        Copy or hardlink a task's cached file to its destination, setting
+        the task's checksum to the one recorded in the index, which is not
+        re-verified. Raises OSError if the file could not be placed
+            :param task (DownloadTask): Download task
+            :param path (str):          Path of the cached file
+            :return (str):              Method used
+        """
+        method = link_or_copy(path, task.filepath)
+        with self._lock:
+            entry = self.entries.get(cache_key(task))
+            task.checksum = entry["md5"] if entry else None
+        return method
+
+    def discard(self, task) -> None:
+        """
+        Remove a task's file from the cache, e.g. when the cached file no
+        longer matches the task's expected checksum
+            :param task (DownloadTask): Download task
+        """
+        key = cache_key(task)
+        with self._lock:
+            if self.entries.pop(key, None) is None:
+                return
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def store(self, task, path: str) -> None:
+        """
+        Add a downloaded file to the cache, then evict the least recently
+        used files until the cache fits within its maximum size. Files
+        larger than the maximum size, or that cannot be identified, are not
+        cached. The file is linked or copied to a temporary file unique to
+        the call and renamed into place, and a key being added by another
+        thread is skipped, so concurrent stores of the same file do not
+        collide. Raises OSError if the file could not be added
+            :param task (DownloadTask): Download task
+            :param path (str):          Path of the downloaded file
+        """
+        key = cache_key(task)
+        if key is None:
+            return
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.entries or key in self._storing:
+                return
+            self._storing.add(key)
+        cache_path = self._path(key)
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}"
+        try:
+            link_or_copy(path, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            with self._lock:
+                self._storing.discard(key)
+            raise
+        with self._lock:
+            self._storing.discard(key)
+            self.entries[key] = {
+                "size": size,
+                "md5": task.checksum,
+                "used": time.time(),
+            }
+            self.stored += 1
+            self._evict()
+
+    def log_stats(self, logger: logging.Logger) -> None:
+        """
+        Log the hit, miss and eviction counts
+            :param logger (obj):    Python logging object
+        """
+        with self._lock:
+            logger.info(
+                "Download cache: %s hits, %s misses, %s files stored, %s "
+                "files (%s bytes) evicted",
+                self.hits,
+                self.misses,
+                self.stored,
+                self.evicted,
+                self.evicted_bytes,
+            )
+
+    def close(self) -> None:
+        """
+        Write the index to disk and close the prober's connections
+        """
+        self.save()
+        self.prober.pool.close()
+
+    def save(self) -> None:
+        """
+        Write the index to disk, replacing the previous index atomically
+        """
+        tmp_path = f"{self.index_path}.tmp"
+        with self._lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as file:
+                    json.dump(self.entries, file)
+                os.replace(tmp_path, self.index_path)
+            except OSError as exception:
+                self.logger.error(
+                    "%s was raised when writing the cache index %s: %s",
+                    type(exception).__name__,
+                    self.index_path,
+                    exception,
+                )
+
+    def _evict(self) -> None:
+        """
+        Evict the least recently used files until the cache fits within its
+        maximum size. Called with the lock held
+        """
+        total = sum(entry["size"] for entry in self.entries.values())
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            entry = self.entries.pop(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            total -= entry["size"]
+            self.evicted += 1
+            self.evicted_bytes += entry["size"]
+
+    def _path(self, key: str) -> str:
+        """
+        Return the path a key's file is cached at
+            :param key (str):   Cache key
+            :return (str):      File path in the cache directory
+        """
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name)
@@ -0,0 +1,85 @@
+""" checksum.py
+
+MD5 verification of downloaded files against the optional md5 column of the
+CSV (the checksum DNAnexus records for each file). The http transport hashes
+each file as it is written, so no second read is needed. Files whose bytes
+did not pass through the script in order (BITS downloads, segmented
+downloads, and files downloaded by a previous run) are hashed by a small
+thread pool, which bounds the number of full reads made from the network
+share at once
+"""
+import hashlib
+import concurrent.futures
+import config
+
+
+class ChecksumError(Exception):
+    """
+    Raised when a downloaded file does not match its expected checksum, or
+    its checksum could not be computed
+    """
+
+
+def hash_file(path: str, digest=None, length: int = None):
+    """
+    Update a hash with the contents of a file, reading it in fixed size
+    chunks
+        :param path (str):      File path
+        :param digest (obj):    hashlib object to update, a new MD5 hash is
+                                created if not supplied
+        :param length (int):    Number of bytes to read from the start of the
+                                file, or None to read the whole file
+        :return (obj):          Updated hashlib object
+    """
+    if digest is None:
+        digest = hashlib.md5()
+    remaining = length
+    with open(path, "rb") as file:
+        while remaining is None or remaining > 0:
+            size = config.CHECKSUM["CHUNK_SIZE"]
+            if remaining is not None:
+                size = min(size, remaining)
+            chunk = file.read(size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest
+
+
+class ChecksumPool:
+    """
+    Thread pool that computes the MD5 checksums of files on disk
+
+    Methods
+        md5()
+            Return the MD5 checksum of a file, waiting for a pool thread to
+            compute it
+        close()
+            Shut down the pool threads
+    """
+
+    def __init__(self, jobs: int = config.CHECKSUM["JOBS"]):
+        """
+        Constructor for the ChecksumPool class
+            :param jobs (int):  Maximum number of files hashed at once
+        """
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, jobs), thread_name_prefix="checksum"
+        )
+
+    def md5(self, path: str) -> str:
+        """
+        Return the MD5 checksum of a file, waiting for a pool thread to
+        compute it. Exceptions raised reading the file are re-raised
+            :param path (str):  File path
+            :return (str):      MD5 hex digest
+        """
+        return self._executor.submit(hash_file, path).result().hexdigest()
+
+    def close(self) -> None:
+        """
+        Shut down the pool threads
+        """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,386 @@
+""" command_runner.py
+
+Pool of long-lived shell processes that run download commands. Starting a
+new shell, and a new PowerShell inside it, for every file costs from hundreds
+of milliseconds to seconds before any bytes move. Each worker in the pool is
+a single shell process that is sent commands over stdin, and writes each
+command's output followed by a delimiter line carrying its exit status to
+stdout. Workers that time out or crash are killed and replaced
+
+On Windows the workers are PowerShell processes. Elsewhere they are bash
+processes, so the pool can be exercised on Linux with a powershell stand-in
+on the PATH
+"""
+import os
+import sys
+import uuid
+import queue
+import signal
+import threading
+import subprocess
+import time
+import config
+
+
+class CommandRunnerError(Exception):
+    """
+    Raised when a command does not run to completion in a worker
+    """
+
+
+class CommandTimeout(CommandRunnerError):
+    """
+    Raised when a command does not finish within its timeout
+    """
+
+
+class WorkerCrashed(CommandRunnerError):
+    """
+    Raised when a worker shell exits while running a command
+    """
+
+
+class BashShell:
+    """
+    Bash worker shell. Each command runs in a subshell, so that it cannot
+    exit the worker or change its state, with stdin from /dev/null so that it
+    cannot consume the commands sent to the worker
+
+    Methods
+        wrap()
+            Return the line that runs a command and writes its delimiter
+    """
+
+    name = "bash"
+    argv = ["bash", "--noprofile", "--norc"]
+    init = None
+
+    @staticmethod
+    def wrap(command: str, marker: str) -> str:
+        """
+        Return the line that runs a command and writes its delimiter
+            :param command (str):   Shell command
+            :param marker (str):    Unique delimiter for this command
+            :return (str):          Line to send to the worker
+        """
+        return f'( {command}\n) 2>&1 </dev/null; echo "{marker} $?"\n'
+
+
+class PowerShell:
+    """
+    PowerShell worker shell, reading commands from stdin. Errors are made
+    terminating so that a failed cmdlet gives a nonzero status, and progress
+    bars are disabled
+
+    Methods
+        wrap()
+            Return the line that runs a command and writes its delimiter
+    """
+
+    name = "powershell"
+    argv = [
+        "powershell",
+        "-NoLogo",
+        "-NoProfile",
+        "-NonInteractive",
+        "-Command",
+        "-",
+    ]
+    init = (
+        "$ErrorActionPreference = 'Stop'; "
+        "$ProgressPreference = 'SilentlyContinue'\n"
+    )
+
+    @staticmethod
+    def wrap(command: str, marker: str) -> str:
+        """
+        Return the line that runs a command and writes its delimiter
+            :param command (str):   PowerShell command
+            :param marker (str):    Unique delimiter for this command
+            :return (str):          Line to send to the worker
+        """
+        return (
+            "$global:LASTEXITCODE = 0; $status = 0; "
+            f'try {{ & {{ {command} }} 2>&1 | ForEach-Object {{ "$_" }}; '
+            "if ($LASTEXITCODE) { $status = $LASTEXITCODE } } "
+            'catch { "$_"; $status = 1 }; '
+            f'"{marker} $status"; [Console]::Out.Flush()\n'
+        )
+
+
+def default_shell():
+    """
+    Return the worker shell for this platform
+        :return (class):    PowerShell on Windows, otherwise BashShell
+    """
+    return PowerShell if sys.platform == "win32" else BashShell
+
+
+class ShellWorker:
+    """
+    A single long-lived shell process. A reader thread puts each line of
+    the shell's output on a queue, so that waiting for output can time out
+
+    Methods
+        run()
+            Run a command, passing each line of its output to a callback, and
+            return its exit status
+        alive()
+            Return True if the shell process is running
+        kill()
+            Kill the shell process and any commands it is running
+        close()
+            Ask the shell to exit, killing it if it does not
+        _close_pipes()
+            Close the pipes to the shell process
+        _read()
+            Put each line of the shell's output on the queue
+    """
+
+    def __init__(self, shell):
+        """
+        Constructor for the ShellWorker class
+            :param shell (class):   BashShell or PowerShell
+        """
+        self.shell = shell
+        kwargs = {}
+        if sys.platform == "win32":
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs["start_new_session"] = True
+        self.process = subprocess.Popen(
+            shell.argv,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            bufsize=1,
+            **kwargs,
+        )
+        self._lines = queue.SimpleQueue()
+        threading.Thread(
+            target=self._read, name="command_runner_reader", daemon=True
+        ).start()
+        if shell.init:
+            self.process.stdin.write(shell.init)
+            self.process.stdin.flush()
+
+    def run(self, command: str, on_line, timeout: float = None) -> int:
+        """
+        Run a command, passing each line of its output to a callback as it
+        is written, and return its exit status
+            :param command (str):       Shell command
+            :param on_line (callable):  Called with each line of output
+            :param timeout (float):     Seconds to wait for the command to
+                                        finish, or None to wait indefinitely
+            :return (int):              Exit status of the command
+        """
+        marker = f"__process_duty_csv_{uuid.uuid4().hex}__"
+        try:
+            self.process.stdin.write(self.shell.wrap(command, marker))
+            self.process.stdin.flush()
+        except OSError as exception:
+            raise WorkerCrashed(
+                f"worker shell could not be sent the command: {exception}"
+            ) from exception
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise CommandTimeout(
+                        f"command did not finish within {timeout}s"
+                    )
+            try:
+                line = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if line is None:
+                raise WorkerCrashed(
+                    "worker shell exited with returncode "
+                    f"{self.process.wait()}"
+                )
+            if line.startswith(marker):
+                return int(line.split()[-1])
+            on_line(line.rstrip("\n"))
+
+    def alive(self) -> bool:
+        """
+        Return True if the shell process is running
+            :return (bool): True if running
+        """
+        return self.process.poll() is None
+
+    def kill(self) -> None:
+        """
+        Kill the shell process and any commands it is running
+        """
+        if self.alive():
+            if sys.platform == "win32":
+                subprocess.run(
+                    ["taskkill", "/F", "/T", "/PID", str(self.process.pid)],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            else:
+                try:
+                    os.killpg(self.process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self.process.wait()
+        self._close_pipes()
+
+    def close(self) -> None:
+        """
+        Ask the shell to exit, killing it if it does not
+        """
+        if not self.alive():
+            self.process.wait()
+            self._close_pipes()
+            return
+        try:
+            self.process.stdin.write("exit\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=5)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            self.kill()
+        self._close_pipes()
+
+    def _close_pipes(self) -> None:
+        """
+        Close the pipes to the shell process
+        """
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def _read(self) -> None:
+        """
+        Put each line of the shell's output on the queue, then None once the
+        shell exits
+        """
+        try:
+            for line in self.process.stdout:
+                self._lines.put(line)
+        except (OSError, ValueError):
+            pass
+        self._lines.put(None)
+
+
+class CommandRunnerPool:
+    """
+    Thread-safe pool of ShellWorkers. Workers are started as they are
+    needed, up to the maximum, and reused for later commands. A worker whose
+    command times out or that crashes is killed and discarded, and a new
+    worker is started for the next command
+
+    Methods
+        run()
+            Run a command in an idle worker and return its exit status
+        close()
+            Close all workers
+        _acquire()
+            Return an idle worker, starting one if below the maximum
+        _release()
+            Return a worker to the pool, or discard it if it has exited
+    """
+
+    def __init__(
+        self,
+        max_workers: int = config.BITS["MAX_WORKERS"],
+        timeout: float = config.BITS["TIMEOUT"],
+        shell=None,
+    ):
+        """
+        Constructor for the CommandRunnerPool class
+            :param max_workers (int):   Maximum number of worker shells
+            :param timeout (float):     Default seconds to wait for a command
+                                        to finish, None to wait indefinitely
+            :param shell (class):       Worker shell, defaults to the shell
+                                        for this platform
+        """
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.shell = shell or default_shell()
+        self._condition = threading.Condition()
+        self._idle = []
+        self._workers = 0
+        self._closed = False
+
+    def run(self, command: str, on_line, timeout: float = None) -> int:
+        """
+        Run a command in an idle worker and return its exit status. Raises
+        CommandTimeout or WorkerCrashed if the command does not complete, in
+        which case the worker is killed
+            :param command (str):       Shell command
+            :param on_line (callable):  Called with each line of output
+            :param timeout (float):     Seconds to wait for the command,
+                                        defaults to the pool's timeout
+            :return (int):              Exit status of the command
+        """
+        worker = self._acquire()
+        try:
+            return worker.run(command, on_line, timeout or self.timeout)
+        except CommandRunnerError:
+            worker.kill()
+            raise
+        finally:
+            self._release(worker)
+
+    def close(self) -> None:
+        """
+        Close all workers. Workers running a command are closed when it
+        finishes
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
+
+    def _acquire(self) -> ShellWorker:
+        """
+        Return an idle worker, starting one if none are idle and the pool is
+        below its maximum, otherwise waiting for a worker to be released
+            :return (ShellWorker):  Worker
+        """
+        with self._condition:
+            while True:
+                while self._idle:
+                    worker = self._idle.pop()
+                    if worker.alive():
+                        return worker
+                    self._workers -= 1
+                if self._workers < self.max_workers:
+                    self._workers += 1
+                    break
+                self._condition.wait()
+        try:
+            return ShellWorker(self.shell)
+        except OSError as exception:
+            with self._condition:
+                self._workers -= 1
+                self._condition.notify()
+            raise WorkerCrashed(
+                f"worker shell could not be started: {exception}"
+            ) from exception
+
+    def _release(self, worker: ShellWorker) -> None:
+        """
+        Return a worker to the pool, or discard it if it has exited or the
+        pool is closed
+            :param worker (ShellWorker):    Worker
+        """
+        with self._condition:
+            if worker.alive() and not self._closed:
+                self._idle.append(worker)
+                worker = None
+            else:
+                self._workers -= 1
+            self._condition.notify()
+        if worker is not None:
+            worker.close()
@@ -2,6 +2,10 @@
 """
 import datetime
 
+# File the git tag is cached in at deploy time (--cache-git-tag), relative to
+# the script directory
+GIT_TAG_FILE = "GIT_TAG"
+
 LOGGING_FORMATTER = "%(asctime)s - %(levelname)s - %(message)s"
 TIMESTAMP = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
@@ -26,3 +30,162 @@ RUNFOLDER_DIR_LABEL = (
     "Please input the final part of the destination folder without "
     "quotation marks, e.g.: NGS451 or TSO12345"
 )
+
+# Maximum number of concurrent downloads, overall and to a single destination
+# share (drive letter or UNC share)
+JOBS = 4
+SHARE_JOBS = 2
+
+# Download transport backend used by default ("bits" or "http"), and settings
+# for the in-process HTTP transport
+TRANSPORT = "bits"
+HTTP = {
+    "CHUNK_SIZE": 1024 * 1024,  # Bytes read from the socket at a time
+    "TIMEOUT": 60,  # Socket timeout (seconds)
+    "MAX_IDLE": 8,  # Idle keep-alive connections kept per host
+    "MAX_REDIRECTS": 5,
+    # Bytes written between updates of a partial download's resume sidecar
+    "STATE_INTERVAL": 64 * 1024 * 1024,
+    # Files of at least SEGMENT_THRESHOLD bytes are downloaded as SEGMENTS
+    # byte ranges in parallel, where the server supports Range requests
+    "SEGMENTS": 4,
+    "SEGMENT_THRESHOLD": 1024 * 1024 * 1024,
+}
+
+# Priority classes used to order downloads. Each task takes the first class
+# whose EXTENSIONS match the file name or whose DESTINATIONS appear in the
+# destination directory, a class with neither matches every task. Classes are
+# started in the order listed, and within a class the "smallest" or "largest"
+# files are started first. Sizes come from the optional Size column of the
+# CSV, or are probed with up to SIZE_PROBE_JOBS concurrent HEAD requests
+# (0 disables probing)
+PRIORITY_CLASSES = [
+    {
+        "NAME": "reports",
+        "EXTENSIONS": [
+            ".xlsx",
+            ".xls",
+            ".pdf",
+            ".html",
+            ".txt",
+            ".csv",
+            ".tsv",
+            ".json",
+            ".vcf",
+            ".vcf.gz",
+        ],
+        "DESTINATIONS": [],
+        "ORDER": "smallest",
+    },
+    {
+        "NAME": "bulk",
+        "EXTENSIONS": [],
+        "DESTINATIONS": [],
+        "ORDER": "largest",
+    },
+]
+SIZE_PROBE_JOBS = 8
+
+# MD5 verification against the optional md5 column of the CSV. Files not
+# hashed while downloading are hashed by a pool of JOBS threads
+CHECKSUM = {
+    "JOBS": 2,
+    "CHUNK_SIZE": 1024 * 1024,  # Bytes read from the file at a time
+}
+
+# Prometheus textfile the transfer metrics totals are written to at the end
+# of a run (e.g. in the node_exporter textfile collector directory), or None
+PROMETHEUS_TEXTFILE = None
+
+# Download retry policy. Each download is attempted up to ATTEMPTS times
+# (overridden by --attempts), waiting a random time of up to BASE_DELAY
+# seconds, doubled for each retry up to MAX_DELAY, between attempts. After
+# BREAKER_THRESHOLD consecutive failures to a host (0 disables the circuit
+# breaker), downloads from it pause for BREAKER_RESET seconds, doubled for
+# each failed trial request up to BREAKER_MAX_RESET. A trial request that has
+# not finished within BREAKER_TRIAL_TIMEOUT seconds lets another trial through
+RETRY = {
+    "ATTEMPTS": 5,
+    "BASE_DELAY": 2,
+    "MAX_DELAY": 120,
+    "BREAKER_THRESHOLD": 5,
+    "BREAKER_RESET": 30,
+    "BREAKER_MAX_RESET": 600,
+    "BREAKER_TRIAL_TIMEOUT": 300,
+}
+
+# Settings for the bits transport: maximum number of long-lived worker shells
+# that run the download commands, seconds to wait for a download command to
+# finish before its worker is killed, and the BITS priority (High, Normal or
+# Low) of jobs started while a THROTTLE profile is in force
+BITS = {
+    "MAX_WORKERS": 16,
+    "TIMEOUT": 4 * 60 * 60,
+    "THROTTLED_PRIORITY": "Low",
+}
+
+# Fan-out of a file downloaded once to the other destinations of rows with
+# the same URL. A hardlink is used where possible (set HARDLINK to False to
+# always copy), otherwise a kernel copy, or a buffered copy in CHUNK_SIZE
+# byte reads
+FANOUT = {
+    "HARDLINK": True,
+    "CHUNK_SIZE": 1024 * 1024,
+}
+
+# Optional local staging directory for downloads (None to download straight
+# to the destination). Staged files are moved to their destination by
+# FLUSH_JOBS threads, in writes of BUFFER_SIZE bytes
+STAGING = {
+    "DIR": None,
+    "FLUSH_JOBS": 4,
+    "BUFFER_SIZE": 8 * 1024 * 1024,
+}
+
+# Optional local cache of downloaded files shared between runs (None to not
+# cache). The least recently used files are evicted once the cached files
+# total more than MAX_BYTES
+CACHE = {
+    "DIR": None,
+    "MAX_BYTES": 200 * 1024**3,
+}
+
+# Daemon mode. The CSV folder is polled every POLL_INTERVAL seconds where
+# inotify is not available. Runfolder placeholders of a CSV are answered by
+# a sidecar file, named as the CSV with ANSWERS_SUFFIX in place of .csv
+DAEMON = {
+    "POLL_INTERVAL": 10,
+    "ANSWERS_SUFFIX": ".answers.json",
+}
+
+# Bandwidth limit shared by all downloads of the http transport, by time of
+# day. Each profile applies from START until END (local time, HH:MM, an END
+# before START runs past midnight) on its DAYS (0 = Monday, every day if
+# omitted). The first profile in force sets the limit in BYTES_PER_SEC, and
+# downloads are unlimited outside every profile. A new limit applies to
+# downloads already running. BURST is the seconds of transfer at the limit
+# that may be received at once
+THROTTLE = {
+    "PROFILES": [
+        {
+            "START": "08:00",
+            "END": "18:00",
+            "DAYS": [0, 1, 2, 3, 4],
+            "BYTES_PER_SEC": 20 * 1024 * 1024,
+        },
+    ],
+    "BURST": 1,
+}
+
+# Preflight checks of the downloads of a CSV (see planner.py), run with
+# --plan as a dry run. When PREFLIGHT is True, a real run reads the whole CSV
+# and probes every URL before starting any download, and does not start any
+# on a hard failure; downloads then no longer start as soon as their row is
+# read, or while the runfolder inputs are requested. URLs are probed by the
+# SIZE_PROBE_JOBS threads, HEADROOM bytes are left free on each destination
+# volume, and the time estimate assumes BYTES_PER_SEC
+PLAN = {
+    "PREFLIGHT": False,
+    "HEADROOM": 1024 * 1024 * 1024,
+    "BYTES_PER_SEC": 50 * 1024 * 1024,
+}
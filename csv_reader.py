@@ -0,0 +1,133 @@
+""" csv_reader.py
+
+Streaming reader for the CSV files generated by duty_csv. Rows are validated
+against the expected schema and yielded one at a time as compact records, so
+memory use does not grow with the size of the CSV
+"""
+import re
+import csv
+from typing import Iterator
+
+REQUIRED_COLUMNS = ("Url", "GSTT_dir", "subdir")
+SIZE_COLUMN = "Size"
+CHECKSUM_COLUMN = "md5"
+MD5_REGEX = re.compile(r"[0-9a-f]{32}")
+
+
+class CSVSchemaError(ValueError):
+    """
+    Raised when the CSV does not match the expected schema
+    """
+
+
+class CSVRow:
+    """
+    A single row of the CSV
+
+    Attributes
+        line_number (int):  Line of the CSV the row was read from
+        url (str):          DNAnexus download URL
+        gstt_dir (str):     Destination directory, which may contain %s
+                            placeholders for user-supplied subdirectories
+        subdir (str):       Subdirectory of gstt_dir to download the file to
+        size (int):         File size in bytes from the optional Size
+                            column, or None if not given
+        md5 (str):          Expected MD5 checksum of the file from the
+                            optional md5 column, or None if not given
+    """
+
+    __slots__ = ("line_number", "url", "gstt_dir", "subdir", "size", "md5")
+
+    def __init__(
+        self,
+        line_number: int,
+        url: str,
+        gstt_dir: str,
+        subdir: str,
+        size: int = None,
+        md5: str = None,
+    ):
+        """
+        Constructor for the CSVRow class
+            :param line_number (int):   Line of the CSV the row was read from
+            :param url (str):           DNAnexus download URL
+            :param gstt_dir (str):      Destination directory
+            :param subdir (str):        Subdirectory of gstt_dir
+            :param size (int):          File size in bytes, or None
+            :param md5 (str):           Expected MD5 checksum, or None
+        """
+        self.line_number = line_number
+        self.url = url
+        self.gstt_dir = gstt_dir
+        self.subdir = subdir
+        self.size = size
+        self.md5 = md5
+
+
+def parse_size(value: str):
+    """
+    Return the file size given in the optional Size column, or None if the
+    cell is empty or not a whole number of bytes
+        :param value (str): Cell value
+        :return (int):      File size in bytes, or None
+    """
+    try:
+        size = int(value.strip())
+    except ValueError:
+        return None
+    return size if size >= 0 else None
+
+
+def read_rows(csv_path: str) -> Iterator[CSVRow]:
+    """
+    Yield the rows of the CSV as CSVRow objects. Empty cells are read as
+    empty strings. The header is checked for the required columns, and each
+    row for a URL and destination directory. The Size and md5 columns are
+    optional, and an md5 value must be a 32 character hex digest
+        :param csv_path (str):  Path to CSV file
+        :return (Iterator):     CSVRow objects
+    """
+    with open(csv_path, newline="", encoding="utf-8-sig") as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            raise CSVSchemaError("the CSV is empty")
+        missing = [
+            column for column in REQUIRED_COLUMNS if column not in header
+        ]
+        if missing:
+            raise CSVSchemaError(f"the CSV is missing columns: {missing}")
+        url_index, gstt_dir_index, subdir_index = (
+            header.index(column) for column in REQUIRED_COLUMNS
+        )
+        size_index = (
+            header.index(SIZE_COLUMN) if SIZE_COLUMN in header else None
+        )
+        checksum_index = (
+            header.index(CHECKSUM_COLUMN)
+            if CHECKSUM_COLUMN in header
+            else None
+        )
+        for fields in reader:
+            if not any(fields):
+                continue
+            fields += [""] * (len(header) - len(fields))
+            row = CSVRow(
+                reader.line_num,
+                fields[url_index],
+                fields[gstt_dir_index],
+                fields[subdir_index],
+                None if size_index is None else parse_size(fields[size_index]),
+            )
+            if not row.url or not row.gstt_dir:
+                raise CSVSchemaError(
+                    f"line {row.line_number} is missing the Url or GSTT_dir"
+                )
+            if checksum_index is not None and fields[checksum_index].strip():
+                row.md5 = fields[checksum_index].strip().lower()
+                if not MD5_REGEX.fullmatch(row.md5):
+                    raise CSVSchemaError(
+                        f"line {row.line_number} has an invalid md5: "
+                        f"{fields[checksum_index]}"
+                    )
+            yield row
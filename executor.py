@@ -0,0 +1,483 @@
+""" executor.py
+
+Runs the downloads generated by process_duty_csv concurrently, as groups of
+tasks with the same URL, limiting the number of simultaneous transfers both
+overall and per destination share
+"""
+import heapq
+import ntpath
+import itertools
+import threading
+import logging
+from transport import destination_path
+
+
+class DownloadTask:
+    """
+    A single file download defined by a row of the CSV
+
+    Attributes
+        url (str):          DNAnexus download URL
+        destination (str):  Directory the file is downloaded to
+        command (str):      Powershell download command for the file
+        filepath (str):     Path the file is downloaded to
+        download_dir (str): Directory the transport writes the file to, the
+                            destination unless the download is staged
+        download_path (str): Path the transport writes the file to
+        key (str):          Identifies the download in the transfer journal
+        share (str):        Drive or network share the destination is on
+        size (int):         File size in bytes, or None until known
+        validator (str):    ETag, or Last-Modified and size, of the URL
+                            from a probe, or None until known
+        priority (str):     Name of the task's priority class
+        rank (int):         Rank of the task's priority class, lowest first
+        md5 (str):          Expected MD5 checksum, or None if not given
+        checksum (str):     MD5 checksum of the file once verified
+        verify (bool):      True if the file is already on disk and only
+                            needs its checksum verified
+
+    Methods
+        set_download_dir()
+            Set the directory the transport writes the file to
+        staged()
+            Return True if the file is downloaded to a staging directory
+    """
+
+    def __init__(
+        self,
+        url: str,
+        destination: str,
+        command: str,
+        size: int = None,
+        md5: str = None,
+    ):
+        """
+        Constructor for the DownloadTask class
+            :param url (str):           DNAnexus download URL
+            :param destination (str):   Directory the file is downloaded to
+            :param command (str):       Powershell download command
+            :param size (int):          File size in bytes, if known
+            :param md5 (str):           Expected MD5 checksum, if known
+        """
+        self.url = url
+        self.destination = destination
+        self.command = command
+        self.filepath = destination_path(url, destination)
+        self.download_dir = destination
+        self.download_path = self.filepath
+        self.key = f"{url} {self.filepath}"
+        self.share = share_of(destination)
+        self.size = size
+        self.validator = None
+        self.priority = None
+        self.rank = 0
+        self.md5 = md5
+        self.checksum = None
+        self.verify = False
+
+    def set_download_dir(self, directory: str) -> None:
+        """
+        Set the directory the transport writes the file to
+            :param directory (str): Download directory, with a trailing path
+                                    separator
+        """
+        self.download_dir = directory
+        self.download_path = destination_path(self.url, directory)
+
+    def staged(self) -> bool:
+        """
+        Return True if the file is downloaded to a staging directory, rather
+        than straight to its destination
+            :return (bool): True if staged
+        """
+        return self.download_path != self.filepath
+
+
+class DownloadGroup:
+    """
+    Download tasks that share the same URL, which is downloaded once for the
+    first member then copied to the destinations of the other members.
+    Members can be added while the group is being processed, until all of
+    its members have been taken
+
+    Attributes
+        url (str):          DNAnexus download URL
+        share (str):        Destination share of the first member, used for
+                            the per-share cap
+        members (list):     (owner, DownloadTask) tuples, where the owner is
+                            the object that processes the task
+        source (obj):       DownloadGroup whose downloaded file this group's
+                            members are copied from, or None if the first
+                            member is downloaded
+        downloaded (bool):  True once the first member has downloaded, False
+                            if it failed, None until then
+        results (list):     (owner, DownloadTask, success) tuples for the
+                            members processed
+        on_finished (func): Called with the group once all its members have
+                            been processed, or None
+        size (int):         File size of the URL, or None until known
+        validator (str):    Validator of the URL, or None until known
+        priority (str):     Highest priority class of the members
+        rank (int):         Highest (lowest numbered) rank of the members
+
+    Methods
+        add()
+            Add a member, unless all members have already been taken
+        next_member()
+            Take the next member still to be copied
+    """
+
+    def __init__(self, owner, task: DownloadTask, source=None):
+        """
+        Constructor for the DownloadGroup class
+            :param owner (obj):         Object that processes the task
+            :param task (DownloadTask): First task with the URL
+            :param source (obj):        DownloadGroup to copy the file from,
+                                        for a task added after the URL's
+                                        group had finished
+        """
+        self.url = task.url
+        self.share = task.share
+        self.members = [(owner, task)]
+        self.source = source
+        self.downloaded = None
+        self.results = []
+        self.on_finished = None
+        self._lock = threading.Lock()
+        self._next = 0 if source else 1
+        self._closed = False
+
+    def add(self, owner, task: DownloadTask) -> bool:
+        """
+        Add a member, unless all members have already been taken
+            :param owner (obj):         Object that processes the task
+            :param task (DownloadTask): Task with the group's URL
+            :return (bool):             True if the member was added
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            self.members.append((owner, task))
+            return True
+
+    def next_member(self) -> tuple:
+        """
+        Take the next member still to be copied. Once none remain the group
+        is closed, so later tasks with the URL start a new group
+            :return (tuple):    (owner, DownloadTask), or None
+        """
+        with self._lock:
+            if self._next < len(self.members):
+                self._next += 1
+                return self.members[self._next - 1]
+            self._closed = True
+            return None
+
+    @property
+    def size(self) -> int:
+        """
+        File size of the URL, or None until known
+        """
+        return self.members[0][1].size
+
+    @size.setter
+    def size(self, size: int) -> None:
+        for _, task in self.members:
+            task.size = size
+
+    @property
+    def validator(self) -> str:
+        """
+        Validator of the URL from a probe, or None until known
+        """
+        return self.members[0][1].validator
+
+    @validator.setter
+    def validator(self, validator: str) -> None:
+        for _, task in self.members:
+            task.validator = validator
+
+    @property
+    def rank(self) -> int:
+        """
+        Highest (lowest numbered) priority rank of the members
+        """
+        return min(task.rank for _, task in self.members)
+
+    @property
+    def priority(self) -> str:
+        """
+        Priority class name of the highest priority member
+        """
+        _, task = min(self.members, key=lambda member: member[1].rank)
+        return task.priority
+
+
+class DownloadExecutor:
+    """
+    Bounded-concurrency executor of DownloadGroups. Groups are started in the
+    order they are submitted, or lowest sort key first if a sort key is
+    given, skipping over groups whose destination share is already at its
+    cap until a slot on that share becomes free. Groups can be submitted
+    while earlier groups are running, so downloads start as soon as the
+    first group is available. Pending groups are held in a heap per share,
+    so starting a group does not scan the whole pending list
+
+    Methods
+        run()
+            Run all groups using a pool of worker threads, returning the
+            groups that failed
+        start()
+            Start the worker threads, which wait for groups to be submitted
+        submit()
+            Add a group to the pending list
+        update()
+            Reorder a pending group whose sort key may have changed
+        take_dispatched()
+            Return the groups in the order they were started and forget them
+        close()
+            Signal that no more groups will be submitted
+        cancel()
+            Remove the groups that have not started from the pending list
+        join()
+            Close the executor, wait for the workers to finish and return the
+            groups that failed
+        _worker()
+            Take groups from the pending list and run them until the executor
+            is closed and none remain
+        _next_task()
+            Wait for and return the next group that can be started without
+            exceeding the per-share cap
+        _push()
+            Add a pending group's entry to its share's heap
+    """
+
+    def __init__(
+        self,
+        jobs: int,
+        share_jobs: int,
+        logger: logging.Logger,
+        sort_key=None,
+    ):
+        """
+        Constructor for the DownloadExecutor class
+            :param jobs (int):          Maximum number of concurrent downloads
+            :param share_jobs (int):    Maximum number of concurrent downloads
+                                        to a single destination share
+            :param logger (obj):        Python logging object
+            :param sort_key (callable): Called with each pending group when a
+                                        it is submitted or updated, the group
+                                        with the lowest key is started next.
+                                        Ties are started in submission order
+        """
+        self.jobs = max(1, jobs)
+        self.share_jobs = max(1, share_jobs)
+        self.logger = logger
+        self._condition = threading.Condition()
+        # share: heap of [sort key, submission number, entry number, group]
+        # entries, the entry number breaking ties with a group's stale entry
+        self._queues = {}
+        self._entries = itertools.count()
+        # group: its current heap entry, for the groups not yet started
+        self._pending = {}
+        self._active = {}
+        self._failed = []
+        self._closed = False
+        self._workers = []
+        self.sort_key = sort_key
+        self.submitted = 0
+        self.dispatched = []
+
+    def run(self, groups: list, func) -> list:
+        """
+        Run all groups using a pool of worker threads, returning the groups
+        that failed
+            :param groups (list):   DownloadGroup objects
+            :param func (callable): Called with each group, returns True if
+                                    all of its tasks completed successfully
+            :return (list):         DownloadGroup objects that failed
+        """
+        self.start(func)
+        for group in groups:
+            self.submit(group)
+        return self.join()
+
+    def start(self, func) -> None:
+        """
+        Start the worker threads, which wait for groups to be submitted
+            :param func (callable): Called with each group, returns True if
+                                    all of its tasks completed successfully
+        """
+        self._queues = {}
+        self._pending = {}
+        self._active = {}
+        self._failed = []
+        self._closed = False
+        self.submitted = 0
+        self.dispatched = []
+        self._workers = [
+            threading.Thread(target=self._worker, args=(func,), daemon=True)
+            for _ in range(self.jobs)
+        ]
+        self.logger.info(
+            "Running downloads using %s workers (maximum %s per share)",
+            self.jobs,
+            self.share_jobs,
+        )
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, group: DownloadGroup) -> None:
+        """
+        Add a group to the pending list
+            :param group (DownloadGroup):   Tasks with the same URL
+        """
+        with self._condition:
+            self._push(group, self.submitted)
+            self.submitted += 1
+            self._condition.notify_all()
+
+    def update(self, group: DownloadGroup) -> None:
+        """
+        Reorder a pending group whose sort key may have changed, e.g. once its
+        size has been probed or a member of a higher priority class has been
+        added. Groups that have started, or were never submitted, are ignored
+            :param group (DownloadGroup):   Tasks with the same URL
+        """
+        if self.sort_key is None:
+            return
+        with self._condition:
+            entry = self._pending.get(group)
+            if entry is not None and self.sort_key(group) != entry[0]:
+                # The old entry is skipped when it reaches the top of the heap
+                entry[3] = None
+                self._push(group, entry[1])
+
+    def take_dispatched(self) -> list:
+        """
+        Return the groups in the order they were started, and forget them so
+        they are not kept for the life of the executor
+            :return (list): DownloadGroup objects in the order started
+        """
+        with self._condition:
+            dispatched, self.dispatched = self.dispatched, []
+        return dispatched
+
+    def close(self) -> None:
+        """
+        Signal that no more groups will be submitted. Workers exit once the
+        pending list is empty
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def cancel(self) -> list:
+        """
+        Remove the groups that have not started from the pending list.
+        Groups that are running are not interrupted
+            :return (list): DownloadGroup objects that were removed
+        """
+        with self._condition:
+            entries = sorted(self._pending.values(), key=lambda e: e[1])
+            self._queues = {}
+            self._pending = {}
+            self._condition.notify_all()
+        return [entry[3] for entry in entries]
+
+    def join(self) -> list:
+        """
+        Close the executor, wait for the workers to finish and return the
+        groups that failed
+            :return (list): DownloadGroup objects that failed
+        """
+        self.close()
+        for worker in self._workers:
+            worker.join()
+        return self._failed
+
+    def _worker(self, func) -> None:
+        """
+        Take groups from the pending list and run them until the executor is
+        closed and none remain
+            :param func (callable): Called with each group
+        """
+        while True:
+            with self._condition:
+                group = self._next_task()
+            if group is None:
+                return
+            success = False
+            try:
+                success = func(group)
+            except Exception as exception:
+                self.logger.error(
+                    "%s was raised when downloading %s: %s",
+                    type(exception).__name__,
+                    group.url,
+                    exception,
+                )
+            finally:
+                with self._condition:
+                    self._active[group.share] -= 1
+                    if not success:
+                        self._failed.append(group)
+                    self._condition.notify_all()
+
+    def _next_task(self) -> DownloadGroup:
+        """
+        Wait for and return the next group that can be started without
+        exceeding the per-share cap: the lowest entry at the top of the heaps
+        of the shares below their cap. Must be called holding
+        self._condition
+            :return (DownloadGroup):    Next group, or None once the executor
+                                        is closed and no groups remain
+        """
+        while self._pending or not self._closed:
+            best = None
+            for share, queue in list(self._queues.items()):
+                while queue and queue[0][3] is None:
+                    heapq.heappop(queue)
+                if not queue:
+                    del self._queues[share]
+                elif self._active.get(share, 0) < self.share_jobs and (
+                    best is None or queue[0][:2] < best[0][:2]
+                ):
+                    best = queue
+            if best is not None:
+                group = heapq.heappop(best)[3]
+                del self._pending[group]
+                self._active[group.share] = (
+                    self._active.get(group.share, 0) + 1
+                )
+                self.dispatched.append(group)
+                return group
+            self._condition.wait()
+        return None
+
+    def _push(self, group: DownloadGroup, number: int) -> None:
+        """
+        Add a pending group's entry to its share's heap, keyed by its sort
+        key then its submission number. Must be called holding
+        self._condition
+            :param group (DownloadGroup):   Tasks with the same URL
+            :param number (int):            Submission number of the group
+        """
+        key = self.sort_key(group) if self.sort_key else 0
+        entry = [key, number, next(self._entries), group]
+        self._pending[group] = entry
+        heapq.heappush(self._queues.setdefault(group.share, []), entry)
+
+
+def share_of(path: str) -> str:
+    """
+    Return the drive or network share that a path is located on, used to
+    group downloads for the per-share cap
+        :param path (str):  Directory path
+        :return (str):      Drive letter (P:), UNC share (//server/share) or
+                            top level directory for POSIX paths
+    """
+    drive, remainder = ntpath.splitdrive(path)
+    if drive:
+        return drive.replace("\\", "/").upper()
+    return "/" + remainder.replace("\\", "/").strip("/").split("/", 1)[0]
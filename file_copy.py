@@ -0,0 +1,98 @@
+""" file_copy.py
+
+Fan-out of a downloaded file to the other destinations of rows with the same
+URL. A hardlink is used where the destination is on the same volume, so no
+data is copied at all. Otherwise the file is copied in the kernel with
+copy_file_range (which lets filesystems and SMB/NFS servers copy without the
+data passing through this machine) or sendfile, falling back to a buffered
+copy where neither is available (e.g. on Windows)
+"""
+import os
+import shutil
+import config
+
+
+def link_or_copy(source: str, destination: str) -> str:
+    """
+    Place a copy of the source file at the destination path. The copy is
+    written to a temporary file beside the destination and renamed, so a
+    partial copy is never left at the destination
+        :param source (str):        Path of the downloaded file
+        :param destination (str):   Path to place the copy at
+        :return (str):              Method used: hardlink, copy_file_range,
+                                    sendfile or copy
+    """
+    tmp_path = f"{destination}.part"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    method = None
+    if config.FANOUT["HARDLINK"]:
+        try:
+            os.link(source, tmp_path)
+            method = "hardlink"
+        except (OSError, NotImplementedError):
+            method = None
+    try:
+        if method is None:
+            method = fast_copy(source, tmp_path)
+        os.replace(tmp_path, destination)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return method
+
+
+def fast_copy(source: str, destination: str) -> str:
+    """
+    Copy a file using the fastest method available: copy_file_range, then
+    sendfile, then a buffered copy. The modification time is not copied
+        :param source (str):        Source file path
+        :param destination (str):   Destination file path
+        :return (str):              Method used: copy_file_range, sendfile or
+                                    copy
+    """
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        for method, copy in (
+            ("copy_file_range", getattr(os, "copy_file_range", None)),
+            ("sendfile", getattr(os, "sendfile", None)),
+        ):
+            if copy is None:
+                continue
+            try:
+                _kernel_copy(copy, method, src.fileno(), dst.fileno(), size)
+                return method
+            except OSError:
+                # Not supported between these filesystems, start again
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(src, dst, config.FANOUT["CHUNK_SIZE"])
+        return "copy"
+
+
+def _kernel_copy(copy, method: str, src_fd: int, dst_fd: int, size: int):
+    """
+    Copy size bytes between file descriptors with copy_file_range or
+    sendfile, which may copy fewer bytes than requested per call
+        :param copy (callable): os.copy_file_range or os.sendfile
+        :param method (str):    Name of the copy function
+        :param src_fd (int):    Source file descriptor
+        :param dst_fd (int):    Destination file descriptor
+        :param size (int):      Number of bytes to copy
+    """
+    offset = 0
+    chunk_size = config.FANOUT["CHUNK_SIZE"] * 64
+    while offset < size:
+        if method == "sendfile":
+            copied = copy(
+                dst_fd, src_fd, offset, min(chunk_size, size - offset)
+            )
+        else:
+            copied = copy(
+                src_fd, dst_fd, min(chunk_size, size - offset), offset, offset
+            )
+        if not copied:
+            raise OSError(f"{method} copied no bytes at offset {offset}")
+        offset += copied
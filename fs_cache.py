@@ -0,0 +1,126 @@
+""" fs_cache.py
+
+Cached filesystem metadata for the destination paths in the CSV. Most rows
+share a handful of directories on the P:/S: network shares, where every
+os.path.exists() or os.mkdir() call is a round trip to the server. The cache
+answers repeat lookups for the whole run and creates missing directories in
+a single batched pass
+"""
+import os
+import threading
+import logging
+
+
+class PathCache:
+    """
+    Cache of whether directories exist, shared by every CSV processed in a
+    run. A directory that exists implies that all of its parents exist, so
+    those are cached without further stat calls
+
+    Methods
+        valid()
+            Return True if the path is absolute and exists
+        exists()
+            Return True if the path exists, using the cache where possible
+        ensure_dirs()
+            Create any of the directories that don't already exist, in one
+            batched pass over the unique directories
+        log_stats()
+            Log the number of lookups and the network stat calls avoided
+        _key()
+            Return the normalised cache key for a path
+        _mark_exists()
+            Cache a path and all of its parents as existing
+    """
+
+    def __init__(self):
+        """
+        Constructor for the PathCache class
+        """
+        self._exists = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.stat_calls = 0
+
+    def valid(self, path: str) -> bool:
+        """
+        Return True if the path is absolute and exists
+            :param path (str):  Directory path
+            :return (bool):     True if the path is valid
+        """
+        return os.path.isabs(path) and self.exists(path)
+
+    def exists(self, path: str) -> bool:
+        """
+        Return True if the path exists, using the cache where possible
+            :param path (str):  Directory path
+            :return (bool):     True if the path exists
+        """
+        key = self._key(path)
+        with self._lock:
+            self.lookups += 1
+            if key in self._exists:
+                return self._exists[key]
+            self.stat_calls += 1
+        exists = os.path.exists(path)
+        with self._lock:
+            if exists:
+                self._mark_exists(key)
+            else:
+                self._exists[key] = False
+        return exists
+
+    def ensure_dirs(self, directories: list) -> list:
+        """
+        Create any of the directories that don't already exist. The
+        directories are collapsed to the unique set and sorted so that parents
+        are checked before their children, and each missing tree is created
+        with a single os.makedirs() call
+            :param directories (list):  Directory paths
+            :return (list):             Directories that were created
+        """
+        created = []
+        unique = {self._key(directory): directory for directory in directories}
+        for key in sorted(unique):
+            if self.exists(unique[key]):
+                continue
+            os.makedirs(unique[key], exist_ok=True)
+            with self._lock:
+                self._mark_exists(key)
+            created.append(unique[key])
+        return created
+
+    def log_stats(self, logger: logging.Logger) -> None:
+        """
+        Log the number of lookups and the network stat calls avoided
+            :param logger (obj):    Python logging object
+        """
+        logger.info(
+            "Filesystem metadata cache: %s path lookups, %s stat calls made, "
+            "%s stat calls avoided",
+            self.lookups,
+            self.stat_calls,
+            self.lookups - self.stat_calls,
+        )
+
+    @staticmethod
+    def _key(path: str) -> str:
+        """
+        Return the normalised cache key for a path
+            :param path (str):  Directory path
+            :return (str):      Cache key
+        """
+        return os.path.normcase(os.path.normpath(path))
+
+    def _mark_exists(self, key: str) -> None:
+        """
+        Cache a path and all of its parents as existing. Must be called
+        holding self._lock
+            :param key (str):   Normalised path
+        """
+        while key and self._exists.get(key) is not True:
+            self._exists[key] = True
+            parent = os.path.dirname(key)
+            if parent == key:
+                break
+            key = parent
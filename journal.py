@@ -0,0 +1,219 @@
+""" journal.py
+
+Write-ahead transfer journal for a CSV. Records the state of each download
+so that a rerun of the same CSV only queues the files that did not complete
+"""
+import os
+import json
+import time
+import threading
+import logging
+
+
+class TransferJournal:
+    """
+    Append-only journal of download states, one JSON record per line. Done
+    records, which let a rerun skip a file, are flushed and synced to disk
+    as they are written. The other records only describe progress, so they
+    are buffered and written with the next done record or on closing,
+    rather than costing a synchronous write to the share per row. On
+    loading, the journal is replayed so that the last record for each
+    download gives its state, and is then compacted
+
+    States
+        pending     Queued for download
+        in-flight   Download started
+        done        Download completed, with the file's size, modification
+                    time and checksum (if known)
+        failed      Download did not complete within the permitted attempts
+
+    Methods
+        load()
+            Replay the journal, returning the last record for each download
+        compact()
+            Rewrite the journal with only the last record for each download,
+            and open it for appending
+        completed()
+            Return True if the journal records the task as done and a stat of
+            the destination file confirms it is unchanged
+        checksum()
+            Return the checksum the journal records for the task's file
+        pending()
+            Record that tasks have been queued
+        in_flight()
+            Record that a task's download has started
+        done()
+            Record that a task's download completed
+        failed()
+            Record that a task's download failed
+        close()
+            Close the journal file
+        _append()
+            Append records to the journal, syncing them to disk if requested
+    """
+
+    PENDING = "pending"
+    IN_FLIGHT = "in-flight"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, journal_path: str, logger: logging.Logger):
+        """
+        Constructor for the TransferJournal class
+            :param journal_path (str):  Journal file path
+            :param logger (obj):        Python logging object
+        """
+        self.journal_path = journal_path
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._file = None
+        self.records = self.load()
+        self.compact()
+
+    def load(self) -> dict:
+        """
+        Replay the journal, returning the last record for each download. A
+        partially written final line (e.g. after a crash) is ignored
+            :return (dict): Records keyed by download key
+        """
+        records = {}
+        if not os.path.exists(self.journal_path):
+            return records
+        with open(self.journal_path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record["key"]] = record
+        self.logger.info(
+            "Loaded %s records from the transfer journal %s",
+            len(records),
+            self.journal_path,
+        )
+        return records
+
+    def compact(self) -> None:
+        """
+        Rewrite the journal with only the last record for each download,
+        and open it for appending
+        """
+        tmp_path = f"{self.journal_path}.tmp"
+        with self._lock:
+            if self._file:
+                self._file.close()
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                for record in self.records.values():
+                    file.write(f"{json.dumps(record)}\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.journal_path)
+            self._file = open(self.journal_path, "a", encoding="utf-8")
+
+    def completed(self, task) -> bool:
+        """
+        Return True if the journal records the task as done and a stat of the
+        destination file confirms its size and modification time are
+        unchanged
+            :param task (DownloadTask): Download task
+            :return (bool):             True if the file does not need to be
+                                        downloaded again
+        """
+        record = self.records.get(task.key)
+        if not record or record["state"] != self.DONE:
+            return False
+        try:
+            stat = os.stat(task.filepath)
+        except OSError:
+            return False
+        return (
+            stat.st_size == record["size"]
+            and stat.st_mtime_ns == record["mtime_ns"]
+        )
+
+    def checksum(self, task) -> str:
+        """
+        Return the checksum the journal records for the task's file
+            :param task (DownloadTask): Download task
+            :return (str):              Checksum, or None if not recorded
+        """
+        record = self.records.get(task.key)
+        return record.get("checksum") if record else None
+
+    def pending(self, tasks: list) -> None:
+        """
+        Record that tasks have been queued. The records are buffered
+            :param tasks (list):    DownloadTask objects
+        """
+        self._append(tasks, self.PENDING)
+
+    def in_flight(self, task) -> None:
+        """
+        Record that a task's download has started. The record is buffered
+            :param task (DownloadTask): Download task
+        """
+        self._append([task], self.IN_FLIGHT)
+
+    def done(self, task, checksum: str = None) -> None:
+        """
+        Record that a task's download completed, with the size and
+        modification time of the destination file. The record is synced to
+        disk before returning
+            :param task (DownloadTask): Download task
+            :param checksum (str):      Checksum of the file, if known
+        """
+        stat = os.stat(task.filepath)
+        self._append(
+            [task],
+            self.DONE,
+            sync=True,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            checksum=checksum,
+        )
+
+    def failed(self, task) -> None:
+        """
+        Record that a task's download failed. The record is buffered
+            :param task (DownloadTask): Download task
+        """
+        self._append([task], self.FAILED)
+
+    def close(self) -> None:
+        """
+        Close the journal file, writing any buffered records
+        """
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _append(
+        self, tasks: list, state: str, sync: bool = False, **fields
+    ) -> None:
+        """
+        Append records to the journal, flushing and syncing them to disk if
+        requested, otherwise leaving them in the file's buffer
+            :param tasks (list):    DownloadTask objects
+            :param state (str):     Download state
+            :param sync (bool):     True to flush and sync the records
+            :param fields (dict):   Additional fields for the records
+        """
+        records = [
+            {
+                "key": task.key,
+                "state": state,
+                "url": task.url,
+                "filepath": task.filepath,
+                "time": time.time(),
+                **fields,
+            }
+            for task in tasks
+        ]
+        with self._lock:
+            for record in records:
+                self.records[record["key"]] = record
+                self._file.write(f"{json.dumps(record)}\n")
+            if sync:
+                self._file.flush()
+                os.fsync(self._file.fileno())
@@ -4,42 +4,78 @@
 Log messages using the python standard library logging module.
 """
 import sys
+import queue
+import atexit
 import logging
+import logging.handlers
 import config
 
+# Queued loggers whose listener is running, stopped by a single exit hook
+_QUEUED_LOGGERS = set()
+
+
+@atexit.register
+def _shutdown_queued_logs() -> None:
+    """
+    Stop the listeners of the queued loggers still running at exit, so no
+    records are lost
+    """
+    for logger_obj in list(_QUEUED_LOGGERS):
+        logger_obj.shutdown_logs()
+
 
 class Logger(object):
     """
-    Simple logging class
+    Simple logging class. In queued mode, log records are put on a queue by
+    the calling thread and written to the file and stream handlers by a
+    QueueListener thread, so threads never block on log file I/O
 
     Methods
         shutdown_logs()
             To prevent duplicate filehandlers and system handlers close and
-            remove all handlers for all log files with a python logging object
+            remove all handlers for all log files with a python logging object.
+            In queued mode, stop the listener once the queue is flushed
         _get_file_handler()
             Returns the FileHandler associated with the logging object
         _get_stream_handler()
             Returns the StreamHandler associated with the logging object
         get_logger()
             Return a Python logging object
+        get_queued_logger()
+            Return a Python logging object that logs via a queue
     """
 
     _formatter = logging.Formatter(
         config.LOGGING_FORMATTER
     )  # Log string format
 
-    def __init__(self, logfile_path: str):
+    def __init__(
+        self, logfile_path: str, name: str = "logger", queued: bool = False
+    ):
         """
         Constructor for the Logger class
             :param logfile_path (str): Logfile path
+            :param name (str):         Logger name, unique per logfile
+            :param queued (bool):      Log via a queue and listener thread
         """
-        self.logger = self.get_logger("logger", logfile_path)
+        self.listener = None
+        if queued:
+            self.logger = self.get_queued_logger(name, logfile_path)
+        else:
+            self.logger = self.get_logger(name, logfile_path)
 
     def shutdown_logs(self):
         """
         To prevent duplicate filehandlers and system handlers close and
-        remove all handlers for all log files that have a python logging object
+        remove all handlers for all log files that have a python logging
+        object. In queued mode, stop the listener once the queue is flushed
         """
+        if self.listener:
+            _QUEUED_LOGGERS.discard(self)
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
         for handler in self.logger.handlers[:]:
             self.logger.removeHandler(handler)
             handler.close()
@@ -77,3 +113,28 @@ class Logger(object):
         logger.addHandler(self._get_file_handler(filepath))
         logger.addHandler(self._get_stream_handler())
         return logger
+
+    def get_queued_logger(self, name: str, filepath: str) -> logging.Logger:
+        """
+        Return a Python logging object whose records are put on a queue, and
+        start a QueueListener thread that writes them to the file and stream
+        handlers. The listener is stopped at exit if shutdown_logs() has not
+        been called, so no records are lost
+            :param name (str):       Logger name
+            :param filepath (str):   Logfile path
+            :return logger (obj):   Python logging object
+        """
+        log_queue = queue.SimpleQueue()
+        logger = logging.getLogger(name)
+        logger.filepath = filepath
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self.listener = logging.handlers.QueueListener(
+            log_queue,
+            self._get_file_handler(filepath),
+            self._get_stream_handler(),
+            respect_handler_level=True,
+        )
+        self.listener.start()
+        _QUEUED_LOGGERS.add(self)
+        return logger
@@ -0,0 +1,364 @@
+""" metrics.py
+
+Per-transfer metrics for a CSV: queue wait, duration, time spent on retries,
+bytes, throughput, attempt count and exit status of every download. At the
+end of a run they are written as a JSON and a CSV summary beside the process
+log, and optionally as a Prometheus textfile for the node_exporter textfile
+collector, so that slow files and hours can be found and the concurrency
+settings tuned
+"""
+import os
+import csv
+import json
+import time
+import threading
+import logging
+import datetime
+
+
+class TransferRecord:
+    """
+    Metrics for a single download
+
+    Attributes
+        url (str):              DNAnexus download URL
+        filepath (str):         Path the file is downloaded to
+        priority (str):         Name of the task's priority class
+        queued_at (float):      Time the task was queued
+        started_at (float):     Time the first attempt started
+        retried_at (float):     Time the last attempt started
+        finished_at (float):    Time the task finished
+        attempts (int):         Number of attempts made
+        size (int):             Size of the file once complete, in bytes
+        status (str):           done, copied, cached, verified or failed
+    """
+
+    __slots__ = (
+        "url",
+        "filepath",
+        "priority",
+        "queued_at",
+        "started_at",
+        "retried_at",
+        "finished_at",
+        "attempts",
+        "size",
+        "status",
+    )
+
+    FIELDS = (
+        "url",
+        "filepath",
+        "priority",
+        "status",
+        "attempts",
+        "bytes",
+        "started",
+        "queue_wait_seconds",
+        "duration_seconds",
+        "retry_seconds",
+        "throughput_bytes_per_second",
+    )
+
+    def __init__(self, task):
+        """
+        Constructor for the TransferRecord class
+            :param task (DownloadTask): Download task
+        """
+        self.url = task.url
+        self.filepath = task.filepath
+        self.priority = task.priority
+        self.queued_at = time.time()
+        self.started_at = None
+        self.retried_at = None
+        self.finished_at = None
+        self.attempts = 0
+        self.size = None
+        self.status = None
+
+    @property
+    def queue_wait(self) -> float:
+        """
+        Seconds between the task being queued and its first attempt
+        """
+        if self.started_at is None:
+            return None
+        return self.started_at - self.queued_at
+
+    @property
+    def duration(self) -> float:
+        """
+        Seconds between the first attempt starting and the task finishing
+        """
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    @property
+    def retry_time(self) -> float:
+        """
+        Seconds spent on attempts that failed before the last attempt
+        """
+        if self.started_at is None or self.retried_at is None:
+            return 0.0
+        return self.retried_at - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        """
+        Bytes per second over the last attempt
+        """
+        if not self.size or self.finished_at is None:
+            return None
+        elapsed = self.finished_at - (self.retried_at or self.started_at)
+        return self.size / elapsed if elapsed > 0 else None
+
+    def as_dict(self) -> dict:
+        """
+        Return the record as a dictionary of the summary fields
+            :return (dict): Summary fields
+        """
+        started = None
+        if self.started_at is not None:
+            started = datetime.datetime.fromtimestamp(
+                self.started_at
+            ).isoformat(timespec="seconds")
+        return {
+            "url": self.url,
+            "filepath": self.filepath,
+            "priority": self.priority,
+            "status": self.status,
+            "attempts": self.attempts,
+            "bytes": self.size,
+            "started": started,
+            "queue_wait_seconds": _round(self.queue_wait),
+            "duration_seconds": _round(self.duration),
+            "retry_seconds": _round(self.retry_time),
+            "throughput_bytes_per_second": _round(self.throughput),
+        }
+
+
+class TransferMetrics:
+    """
+    Thread-safe collection of the TransferRecords of a CSV
+
+    Methods
+        queued()
+            Record that a task has been queued
+        attempt()
+            Record the start of an attempt at a task
+        finished()
+            Record that a task has finished
+        totals()
+            Return the totals over all finished transfers
+        log_totals()
+            Log the totals over all finished transfers
+        write_summary()
+            Write the JSON and CSV summaries
+    """
+
+    DONE = "done"
+    COPIED = "copied"
+    CACHED = "cached"
+    VERIFIED = "verified"
+    FAILED = "failed"
+
+    def __init__(self, csv_name: str):
+        """
+        Constructor for the TransferMetrics class
+            :param csv_name (str):  Name of the CSV the transfers belong to
+        """
+        self.csv_name = csv_name
+        self.records = {}
+        self._lock = threading.Lock()
+
+    def queued(self, task) -> None:
+        """
+        Record that a task has been queued
+            :param task (DownloadTask): Download task
+        """
+        with self._lock:
+            self.records[task.key] = TransferRecord(task)
+
+    def attempt(self, task) -> None:
+        """
+        Record the start of an attempt at a task
+            :param task (DownloadTask): Download task
+        """
+        now = time.time()
+        with self._lock:
+            record = self.records.setdefault(task.key, TransferRecord(task))
+            if record.started_at is None:
+                record.started_at = now
+            else:
+                record.retried_at = now
+            record.attempts += 1
+
+    def finished(self, task, status: str) -> None:
+        """
+        Record that a task has finished, and the size of its file if it
+        completed
+            :param task (DownloadTask): Download task
+            :param status (str):        done, copied, cached, verified or
+                                        failed
+        """
+        size = None
+        if status != self.FAILED:
+            try:
+                size = os.path.getsize(task.filepath)
+            except OSError:
+                pass
+        with self._lock:
+            record = self.records.setdefault(task.key, TransferRecord(task))
+            record.finished_at = time.time()
+            record.priority = task.priority
+            record.status = status
+            record.size = size
+
+    def totals(self) -> dict:
+        """
+        Return the totals over all finished transfers
+            :return (dict): Totals, including a count per status
+        """
+        with self._lock:
+            records = [
+                record
+                for record in self.records.values()
+                if record.status is not None
+            ]
+        statuses = {}
+        for record in records:
+            statuses[record.status] = statuses.get(record.status, 0) + 1
+        transferred = [
+            record
+            for record in records
+            if record.status in (self.DONE, self.COPIED, self.CACHED)
+        ]
+        total_bytes = sum(record.size or 0 for record in transferred)
+        started = [r.started_at for r in records if r.started_at is not None]
+        finished = [r.finished_at for r in records]
+        wall_time = max(finished) - min(started) if started else 0.0
+        return {
+            "csv": self.csv_name,
+            "transfers": len(records),
+            "statuses": statuses,
+            "attempts": sum(record.attempts for record in records),
+            "retries": sum(max(0, r.attempts - 1) for r in records),
+            "bytes": total_bytes,
+            "wall_seconds": _round(wall_time),
+            "queue_wait_seconds": _round(
+                sum(record.queue_wait or 0 for record in records)
+            ),
+            "transfer_seconds": _round(
+                sum(record.duration or 0 for record in records)
+            ),
+            "retry_seconds": _round(
+                sum(record.retry_time for record in records)
+            ),
+            "throughput_bytes_per_second": _round(
+                total_bytes / wall_time if wall_time > 0 else None
+            ),
+        }
+
+    def log_totals(self, logger: logging.Logger) -> None:
+        """
+        Log the totals over all finished transfers
+            :param logger (obj):    Python logging object
+        """
+        totals = self.totals()
+        logger.info(
+            "Transfer metrics: %s transfers %s, %s bytes in %ss (%s bytes/s), "
+            "%s retries taking %ss, %ss total queue wait",
+            totals["transfers"],
+            totals["statuses"],
+            totals["bytes"],
+            totals["wall_seconds"],
+            totals["throughput_bytes_per_second"],
+            totals["retries"],
+            totals["retry_seconds"],
+            totals["queue_wait_seconds"],
+        )
+
+    def write_summary(self, json_path: str, csv_path: str) -> None:
+        """
+        Write the JSON summary (totals and every transfer) and the CSV
+        summary (one row per transfer)
+            :param json_path (str): JSON summary file path
+            :param csv_path (str):  CSV summary file path
+        """
+        with self._lock:
+            rows = [record.as_dict() for record in self.records.values()]
+        with open(json_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {"totals": self.totals(), "transfers": rows}, file, indent=4
+            )
+        with open(csv_path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, fieldnames=TransferRecord.FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def write_prometheus(textfile_path: str, metrics: list) -> None:
+    """
+    Write the totals of one or more CSVs to a Prometheus textfile, for the
+    node_exporter textfile collector. The file is written to a temporary
+    path and renamed so the collector never reads a partial file
+        :param textfile_path (str): Textfile path, ending .prom
+        :param metrics (list):      TransferMetrics objects
+    """
+    lines = []
+    series = (
+        ("transfers", "Transfers finished, by status", "gauge"),
+        ("attempts", "Download attempts made", "gauge"),
+        ("retries", "Download attempts that were retries", "gauge"),
+        ("bytes", "Bytes of files downloaded or copied", "gauge"),
+        ("wall_seconds", "Seconds from first to last transfer", "gauge"),
+        ("queue_wait_seconds", "Total seconds tasks spent queued", "gauge"),
+        ("transfer_seconds", "Total seconds spent transferring", "gauge"),
+        ("retry_seconds", "Total seconds spent on failed attempts", "gauge"),
+    )
+    all_totals = [metric.totals() for metric in metrics]
+    for name, description, metric_type in series:
+        metric_name = f"process_duty_csv_{name}"
+        lines.append(f"# HELP {metric_name} {description}")
+        lines.append(f"# TYPE {metric_name} {metric_type}")
+        for totals in all_totals:
+            csv_label = _label(totals["csv"])
+            if name == "transfers":
+                for status, count in sorted(totals["statuses"].items()):
+                    lines.append(
+                        f'{metric_name}{{csv="{csv_label}",'
+                        f'status="{status}"}} {count}'
+                    )
+            else:
+                lines.append(
+                    f'{metric_name}{{csv="{csv_label}"}} {totals[name] or 0}'
+                )
+    lines.append(
+        "# HELP process_duty_csv_last_run_timestamp_seconds Time the metrics "
+        "were written"
+    )
+    lines.append("# TYPE process_duty_csv_last_run_timestamp_seconds gauge")
+    lines.append(f"process_duty_csv_last_run_timestamp_seconds {time.time()}")
+    tmp_path = f"{textfile_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, textfile_path)
+
+
+def _round(value: float) -> float:
+    """
+    Round a number of seconds or bytes per second for the summaries
+        :param value (float):   Value, or None
+        :return (float):        Value rounded to 3 decimal places, or None
+    """
+    return None if value is None else round(value, 3)
+
+
+def _label(value: str) -> str:
+    """
+    Escape a Prometheus label value
+        :param value (str): Label value
+        :return (str):      Escaped label value
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
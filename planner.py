@@ -0,0 +1,211 @@
+""" planner.py
+
+Preflight checks for the downloads of a CSV, run before the transfers start
+so that a full destination volume or expired links are found in seconds
+rather than hours into the transfer window. Every URL is probed concurrently
+for its size and reachability, the bytes to be written are added up per
+destination volume and compared with the free space on the volume, and a
+report of the bytes, estimated time and any failures is written beside the
+process log
+"""
+import os
+import shutil
+import datetime
+from typing import Tuple
+import config
+from scheduler import SizeProber
+
+
+def volume_root(path: str) -> str:
+    """
+    Return the root of the volume a path is on: its drive on Windows,
+    otherwise the mount point found by walking up the path until the device
+    changes. The path, or one of its parents, must exist
+        :param path (str):  Directory path
+        :return (str):      Volume root
+    """
+    path = os.path.abspath(path)
+    drive = os.path.splitdrive(path)[0]
+    if drive:
+        return f"{drive}/"
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    device = os.stat(path).st_dev
+    parent = os.path.dirname(path)
+    while parent != path and os.stat(parent).st_dev == device:
+        path, parent = parent, os.path.dirname(parent)
+    return path
+
+
+class PreflightPlanner:
+    """
+    Preflight checks for a list of download tasks
+
+    Methods
+        run()
+            Probe the tasks' URLs, check the free space on each destination
+            volume and return the report and the hard failures
+        volumes()
+            Return the bytes needed and free on each destination volume
+        report()
+            Return the dry-run report
+    """
+
+    def __init__(
+        self,
+        headroom: int = config.PLAN["HEADROOM"],
+        bytes_per_sec: int = config.PLAN["BYTES_PER_SEC"],
+    ):
+        """
+        Constructor for the PreflightPlanner class
+            :param headroom (int):      Bytes to leave free on each volume
+            :param bytes_per_sec (int): Throughput the time estimate assumes
+        """
+        self.headroom = headroom
+        self.bytes_per_sec = bytes_per_sec
+
+    def run(
+        self, tasks: list, prober: SizeProber, skip: set = frozenset()
+    ) -> Tuple[str, list]:
+        """
+        Probe the tasks' URLs for their size and reachability, check the
+        free space on each destination volume and return the report. Run
+        before any of the tasks are started, so the free space is not yet
+        reduced by their files. Tasks whose file was downloaded by a
+        previous run and only needs its checksum verified are not checked.
+        Links the server rejects (HTTP 4xx, e.g. expired) and volumes
+        without space for their files are hard failures; URLs that could not
+        be probed for another reason (e.g. a timeout or HTTP 5xx) are
+        reported but may recover. If probing is disabled
+        (config.SIZE_PROBE_JOBS is 0), only the free space is checked, for
+        the sizes given in the CSV
+            :param tasks (list):        DownloadTask objects
+            :param prober (SizeProber): Prober whose results are reused when
+                                        the tasks are scheduled
+            :param skip (set):          URLs not to probe, e.g. held by the
+                                        download cache
+            :return (str):              Report
+            :return (list):             Descriptions of the hard failures
+        """
+        tasks = [task for task in tasks if not task.verify]
+        urls = list(
+            dict.fromkeys(task.url for task in tasks if task.url not in skip)
+        )
+        results = prober.results(urls)
+        probed = results is not None
+        results = results or {}
+        for task in tasks:
+            result = results.get(task.url)
+            if task.size is None and result and result.size is not None:
+                task.size = result.size
+        failures = []
+        for url, result in results.items():
+            if not result.reachable and result.status is not None:
+                if 400 <= result.status < 500:
+                    failures.append(f"Dead link ({result.error}): {url}")
+        volumes = self.volumes(tasks)
+        for root, volume in volumes.items():
+            if volume["free"] is None:
+                failures.append(
+                    f"Free space on {root} could not be read: "
+                    f"{volume['error']}"
+                )
+            elif volume["needed"] + self.headroom > volume["free"]:
+                failures.append(
+                    f"{root} has {volume['free']} bytes free, but "
+                    f"{volume['needed']} bytes are to be written to it (plus "
+                    f"{self.headroom} bytes headroom)"
+                )
+        report = self.report(tasks, results, volumes, failures)
+        if not probed:
+            report = (
+                "URLs were not probed, as config.SIZE_PROBE_JOBS is 0\n"
+                f"{report}"
+            )
+        return report, failures
+
+    def volumes(self, tasks: list) -> dict:
+        """
+        Return the bytes to be written to, and free on, each destination
+        volume. Every destination is counted, including those of duplicate
+        URLs that may be hardlinked, so the estimate errs on the safe side.
+        Files of unknown size are not counted
+            :param tasks (list):    DownloadTask objects
+            :return (dict):         Keyed by volume root: files, needed bytes,
+                                    bytes free (None if unreadable) and any
+                                    error
+        """
+        volumes = {}
+        roots = {}
+        for task in tasks:
+            if task.destination not in roots:
+                roots[task.destination] = volume_root(task.destination)
+            root = roots[task.destination]
+            if root not in volumes:
+                free, error = None, None
+                try:
+                    free = shutil.disk_usage(root).free
+                except OSError as exception:
+                    error = f"{type(exception).__name__}: {exception}"
+                volumes[root] = {
+                    "files": 0,
+                    "needed": 0,
+                    "free": free,
+                    "error": error,
+                }
+            volumes[root]["files"] += 1
+            volumes[root]["needed"] += task.size or 0
+        return volumes
+
+    def report(
+        self, tasks: list, results: dict, volumes: dict, failures: list
+    ) -> str:
+        """
+        Return the dry-run report: the downloads, bytes and estimated time,
+        the bytes needed and free on each destination volume, and the URLs
+        that failed their probe
+            :param tasks (list):        DownloadTask objects
+            :param results (dict):      ProbeResult objects keyed by URL
+            :param volumes (dict):      Volumes returned by volumes()
+            :param failures (list):     Descriptions of the hard failures
+            :return (str):              Report
+        """
+        sizes = {task.url: task.size for task in tasks}
+        total = sum(size for size in sizes.values() if size is not None)
+        unknown = sum(1 for size in sizes.values() if size is None)
+        estimate = datetime.timedelta(
+            seconds=round(total / self.bytes_per_sec)
+        )
+        lines = [
+            f"{len(tasks)} downloads of {len(sizes)} distinct URLs, "
+            f"{total} bytes to download"
+            + (f" ({unknown} URLs of unknown size)" if unknown else ""),
+            f"Estimated transfer time {estimate} at {self.bytes_per_sec} "
+            "bytes/s",
+            f"{'volume':<32}{'files':>8}{'needed':>18}{'free':>18}  status",
+        ]
+        for root, volume in sorted(volumes.items()):
+            if volume["free"] is None:
+                status = "unknown"
+            elif volume["needed"] + self.headroom > volume["free"]:
+                status = "INSUFFICIENT"
+            else:
+                status = "ok"
+            lines.append(
+                f"{root:<32}{volume['files']:>8}{volume['needed']:>18}"
+                f"{volume['free'] if volume['free'] is not None else '-':>18}"
+                f"  {status}"
+            )
+        for url, result in results.items():
+            if not result.reachable and not (
+                result.status is not None and 400 <= result.status < 500
+            ):
+                lines.append(
+                    f"Probe failed, may recover ({result.error}): {url}"
+                )
+        if failures:
+            lines.append(f"{len(failures)} hard failures:")
+            lines.extend(f"  {failure}" for failure in failures)
+        else:
+            lines.append("No hard failures")
+        return "\n".join(lines)
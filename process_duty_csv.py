@@ -3,165 +3,488 @@
 Processes the end of duty CSV files generated by duty_csv, downloading them
 to locations defined in the CSV
 """
+import startup
+import re
 import sys
+import json
+import time
+import queue
+import signal
 import subprocess
 import os
-import tkinter as tk
-from tkinter import filedialog
+import threading
+import functools
 import argparse
 import logging
-from typing import Tuple
-import pandas as pd
+from typing import Tuple, Iterator
 import config
 from logger import Logger
+from csv_reader import CSVRow, read_rows
+from executor import DownloadTask, DownloadGroup, DownloadExecutor
+from journal import TransferJournal
+from fs_cache import PathCache
+from transport import TRANSPORTS, TransferError, BitsTransport, get_transport
+from scheduler import PriorityPolicy, SizeProber
+from checksum import ChecksumPool, ChecksumError
+from metrics import TransferMetrics, write_prometheus
+from retry import RetryPolicy
+from file_copy import link_or_copy
+from staging import StagingArea
+from cache import DownloadCache
+from planner import PreflightPlanner
+
+startup.record("module imports", startup.START_TIME)
 
 
 class ProcessCSV:
     """
-    Class for processing the CSV generated by the duty_csv dnanexus app
+    Class for processing the CSV generated by the duty_csv dnanexus app. The
+    constructor sets up the output paths and transfer journal, process()
+    downloads the files and archives the CSV. Rows are streamed from the CSV
+    through the generator pipeline returned by iter_tasks(), so the first
+    download starts as soon as its row has been parsed
 
     Methods
-        get_dataframe()
-            Read in dataframe from CSV
+        process()
+            Download the files and archive the CSV
+        plan()
+            Create the download tasks and run the preflight checks, without
+            downloading any files
+        read_tasks()
+            Read every download task, probing their URLs in the background
+        iter_tasks()
+            Return the pipeline of generators that turns CSV rows into queued
+            download tasks
+        get_rows()
+            Yield the rows of the CSV
         complete_gstt_paths()
-            If string concatenation string (%s) is in the directory path in the
-            dataframe, collect subdirecctory name (/s) from the user using
-            tkinter input boxes. Then input these into the directory paths
-            within the dataframe
+            If string concatenation string (%s) is in the directory path of a
+            row, collect subdirecctory name (/s) from the user using tkinter
+            input boxes the first time they are needed. Then input these into
+            the directory path. Rows waiting for user input are held back so
+            the other rows are downloaded meanwhile
+        complete_gstt_path()
+            Replace the placeholders in a row's directory path with the user
+            inputs
+        check_roots()
+            Check that the fixed parts of the paths of the rows waiting for
+            user input exist on the share
+        get_placeholder_value()
+            Return the user input that replaces a placeholder match
+        get_user_input()
+            Return a subdirectory that replaces a placeholder, from the
+            answers given for the CSV or from the user
         collect_tkinter_var()
             Call the GetTkinterEntry function to return the variable input
             into the message box by the user
         create_download_commands()
-            For each file in the dataframe, check GSTT directory path is valid,
-            if so add the subdir to the path, and create the powershell
-            download command for that file. Append to download commands list
+            For each row, check GSTT directory path is valid, if so add the
+            subdir to the path, and create the powershell download command for
+            that file for the audit trail. Yield a download task per file
         valid_path()
-            Validation of path using os
+            Validation of path using the filesystem metadata cache
         create_dirs()
-            Create subdirectories specified in the dataframe if they
-            don't already exist
+            Create directories if they don't already exist, using the
+            filesystem metadata cache
         write_cmds_to_file()
-            Write commands from self.command_list to file for audit trail
+            Write the command of each task to file for audit trail
+        write_dispatch_order()
+            Append the order the downloads were started in to the commands
+            file
+        queued_tasks()
+            Yield the download tasks not completed by a previous run
         download_data()
-            Set off each command in self.command_list as a child process
+            Run the download tasks not completed by a previous run
+            concurrently as they are generated, exiting if any failed
         run_process()
-            Execute command as child process using os.system()
-            and communicate output
+            Download the task's file using the transport backend, retrying
+            on failure
+        record_done()
+            Record a completed download in the journal and metrics
+        verify_existing()
+            Verify the checksum of a file downloaded by a previous run
+        verify_checksum()
+            Check a downloaded file against its expected MD5 checksum
+        flush_staged()
+            Move a file downloaded to the staging directory to its
+            destination
+        serve_cached()
+            Serve the task's file from the download cache
+        cache_file()
+            Add a downloaded file to the download cache
+        preflight()
+            Probe every task's URL and check the free space on each
+            destination volume, returning the hard failures
+        close_pools()
+            Wait for staged files to be flushed and save the download cache
+            index, and shut down the checksum pool if it is not shared
+        stop()
+            Stop starting downloads, letting those in progress finish
+        copy_duplicate()
+            Copy a file downloaded for another row to the task's destination
+        write_metrics()
+            Log the transfer metrics and write the JSON and CSV summaries
         archive_csv()
             Move the CSV file and logfile to the archive folder
     """
 
-    def __init__(self):
-        """"""
+    # Matches the placeholders for the worksheets runfolder range and the
+    # runfolder name (%s%s), or the runfolder name only (%s)
+    PLACEHOLDER_REGEX = re.compile(r"%s%s|%s")
+    # Methods timed as stages by --profile, in addition to the generator
+    # stages of iter_tasks()
+    PROFILED_STAGES = (
+        "download_data",
+        "get_user_input",
+        "valid_path",
+        "create_dirs",
+        "run_process",
+        "verify_existing",
+        "verify_checksum",
+        "serve_cached",
+        "cache_file",
+        "flush_staged",
+        "copy_duplicate",
+        "write_metrics",
+        "archive_csv",
+        "preflight",
+    )
+
+    def __init__(
+        self,
+        csv_path: str,
+        script_mode: str,
+        logfile_path: str,
+        logger_obj: Logger,
+        transport,
+        jobs: int,
+        share_jobs: int,
+        path_cache: PathCache = None,
+        checksum_pool: ChecksumPool = None,
+        retry_policy: RetryPolicy = None,
+        staging: StagingArea = None,
+        cache: DownloadCache = None,
+        answers: dict = None,
+        profiler: "profiling.StageProfiler" = None,
+    ):
+        """
+        Constructor for the ProcessCSV class
+            :param csv_path (str):      Path to CSV file
+            :param script_mode (str):   TEST or PROD
+            :param logfile_path (str):  Path to the logfile for this CSV
+            :param logger_obj (class):  Logger() class object for this CSV
+            :param transport (obj):     Download transport backend
+            :param jobs (int):          Maximum number of concurrent downloads
+            :param share_jobs (int):    Maximum number of concurrent downloads
+                                        to a single destination share
+            :param path_cache (obj):    PathCache shared by the CSVs of a run,
+                                        a new cache is used if not supplied
+            :param checksum_pool (obj): ChecksumPool shared by the CSVs of a
+                                        run, a new pool is used if not
+                                        supplied
+            :param retry_policy (obj):  RetryPolicy shared by the CSVs of a
+                                        run, the configured policy is used if
+                                        not supplied
+            :param staging (obj):       StagingArea shared by the CSVs of a
+                                        run, or None to download straight to
+                                        the destinations
+            :param cache (obj):         DownloadCache shared by the CSVs of a
+                                        run, or None to not cache downloads
+            :param answers (dict):      Subdirectories that replace the
+                                        placeholders, keyed worksheets_dir
+                                        and runfolder_dir, or None to ask the
+                                        user
+            :param profiler (obj):      StageProfiler that times the stages,
+                                        or None to not profile
+        """
         self.csv_path = csv_path
-        self.script_mode = SCRIPT_MODE
+        self.script_mode = script_mode
         self.logfile_path = logfile_path
         self.logger_obj = logger_obj
-        self.logger = logger
+        self.logger = logger_obj.logger
+        self.jobs = jobs
+        self.share_jobs = share_jobs
+        self.transport = transport
+        self.path_cache = path_cache or PathCache()
+        self.owns_checksum_pool = checksum_pool is None
+        self.checksum_pool = checksum_pool or ChecksumPool()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.staging = staging
+        self.cache = cache
+        self.answers = answers
+        self.executor = None
+        self.prober = None
+        self.stopping = False
+        self.policy = PriorityPolicy()
+        self.logger.info(
+            "Downloading using the %s transport", self.transport.name
+        )
         self.csv_name = self.csv_path.rsplit("/", 1)[1]
         self.archive_csv_path = (
             f"{config.DIRS['ARCHIVE'] % config.CSV_FOLDER[self.script_mode]}"
             f"{self.csv_name}"
         )
-        logger.info("The CSV archive path is %s", self.archive_csv_path)
-        self.dataframe = self.get_dataframe()
+        self.logger.info("The CSV archive path is %s", self.archive_csv_path)
         self.cmds_filepath = (
             f"{config.DIRS['CMDS'] % config.CSV_FOLDER[self.script_mode]}"
             f"process_duty_csv_cmds_{config.TIMESTAMP}"
             f"{self.csv_name.split('.duty_')[0]}.ps1"
         )
-        logger.info("The commands logfile path is %s", self.cmds_filepath)
-        self.complete_gstt_paths()
-        self.download_cmds = self.create_download_commands()
-        self.create_dirs(self.dataframe)
-        self.write_cmds_to_file()
+        self.logger.info("The commands logfile path is %s", self.cmds_filepath)
+        # Keyed by CSV name so that reruns of the CSV find the journal
+        self.journal_path = (
+            f"{config.DIRS['CMDS'] % config.CSV_FOLDER[self.script_mode]}"
+            f"process_duty_csv_journal_{self.csv_name.split('.csv')[0]}.jsonl"
+        )
+        self.logger.info("The transfer journal path is %s", self.journal_path)
+        self.journal = TransferJournal(self.journal_path, self.logger)
+        self.metrics = TransferMetrics(self.csv_name)
+        # Summaries are written beside the process log
+        self.metrics_path = f"{self.logfile_path.rsplit('.log', 1)[0]}_metrics"
+        self.plan_path = f"{self.logfile_path.rsplit('.log', 1)[0]}_plan.txt"
+        self.worksheets_dir = None
+        self.runfolder_dir = None
+        self.task_count = 0
+        self.queued_count = 0
+        self.profiler = profiler
+        if profiler is not None:
+            # Wrapped per instance, so nothing is wrapped when not profiling
+            for name in self.PROFILED_STAGES:
+                setattr(self, name, profiler.wrap(name, getattr(self, name)))
+
+    def process(self) -> None:
+        """
+        Download the files and archive the CSV
+        """
         self.download_data()
         # Files will only archive if other methods have completed successfully
         self.archive_csv()
-        logger.info("Script has completed successfully")
+        self.logger.info("Script has completed successfully")
 
-    def get_dataframe(self) -> pd.core.frame.DataFrame:
+    def plan(self) -> None:
         """
-        Read in dataframe from CSV
-            :return (pd.core.frame.DataFrame): Dataframe
+        Dry run: create the download tasks and run the preflight checks,
+        without downloading any files or archiving the CSV. Exits if the
+        preflight finds a hard failure
         """
+        prober = SizeProber(config.SIZE_PROBE_JOBS, self.logger)
         try:
-            dataframe = pd.read_csv(
-                self.csv_path,
-            ).fillna("")
-            return dataframe
+            tasks = self.read_tasks(prober)
+            failures = self.preflight(tasks, prober)
+        finally:
+            prober.close()
+            self.close_pools()
+            self.journal.close()
+        if failures:
+            self.logger.error(
+                "The preflight found %s hard failures, see %s",
+                len(failures),
+                self.plan_path,
+            )
+            sys.exit(1)
+        self.logger.info(
+            "Dry run complete. No files were downloaded and the CSV was not "
+            "archived"
+        )
+
+    def read_tasks(self, prober: SizeProber) -> list:
+        """
+        Read every download task of the CSV for the preflight checks,
+        queueing a probe of each URL the download cache does not hold as its
+        task is read, so the probes run while the rest of the CSV is read
+        and the user is asked for the runfolder inputs
+            :param prober (SizeProber): Prober used to schedule the tasks
+            :return (list):             DownloadTask objects
+        """
+        tasks = []
+        for task in self.iter_tasks():
+            if self.cache is None or self.cache.contains(task) is None:
+                prober.prefetch(task.url)
+            tasks.append(task)
+        return tasks
+
+    def iter_tasks(self) -> Iterator[DownloadTask]:
+        """
+        Return the pipeline of generators that turns CSV rows into queued
+        download tasks. Each row passes through every stage before the next
+        row is read
+            :return (Iterator): DownloadTask objects to be downloaded
+        """
+        if self.profiler is None:
+            return self.queued_tasks(
+                self.write_cmds_to_file(
+                    self.create_download_commands(
+                        self.complete_gstt_paths(self.get_rows())
+                    )
+                )
+            )
+        tasks = self.profiler.wrap_iter("get_rows", self.get_rows())
+        for stage in (
+            self.complete_gstt_paths,
+            self.create_download_commands,
+            self.write_cmds_to_file,
+            self.queued_tasks,
+        ):
+            tasks = self.profiler.wrap_iter(stage.__name__, stage(tasks))
+        return tasks
+
+    def get_rows(self) -> Iterator[CSVRow]:
+        """
+        Yield the rows of the CSV
+            :return (Iterator): CSVRow objects
+        """
+        try:
+            yield from read_rows(self.csv_path)
         except Exception as exception:
             self.logger.error(
-                "%s was raised when loading the CSV as a "
-                "pandas dataframe: %s",
+                "%s was raised when reading the CSV: %s",
                 type(exception).__name__,
                 exception,
             )
             sys.exit(1)
 
-    def complete_gstt_paths(self) -> None:
+    def complete_gstt_paths(self, rows: Iterator[CSVRow]) -> Iterator[CSVRow]:
         """
-        If string concatenation string (%s) is in the directory path in the
-        dataframe, collect subdirecctory name (/s) from the user using tkinter
-        input boxes. Then input these into the directory paths within the
-        dataframe
+        If string concatenation string (%s) is in the directory path of a row,
+        collect subdirecctory name (/s) from the user using tkinter input
+        boxes the first time they are needed. Then input these into the
+        directory path in a single pass. Rows that need an input the user has
+        not yet given are held back until the rest of the CSV has been read,
+        so the other rows are downloaded while the user is being asked. The
+        sizes of the held back rows' URLs are probed, and the fixed part of
+        their paths checked on the share, in the background meanwhile
+            :param rows (Iterator): CSVRow objects
+            :return (Iterator):     CSVRow objects with completed paths
         """
+        input_required = False
+        deferred = []
+        for row in rows:
+            if "%s" not in row.gstt_dir:
+                yield row
+                continue
+            input_required = True
+            if self.answers is None and (
+                self.runfolder_dir is None
+                or ("%s%s" in row.gstt_dir and self.worksheets_dir is None)
+            ):
+                deferred.append(row)
+                if self.prober is not None and row.size is None:
+                    self.prober.prefetch(row.url)
+                continue
+            yield self.complete_gstt_path(row)
+        if deferred:
+            self.logger.info(
+                "%s rows are waiting for user input, the other rows are "
+                "downloading meanwhile",
+                len(deferred),
+            )
+            roots = {
+                row.gstt_dir.split("%s", 1)[0].rsplit("/", 1)[0] + "/"
+                for row in deferred
+            }
+            checker = threading.Thread(
+                target=self.check_roots, args=(roots,), name="root_check"
+            )
+            checker.start()
+            try:
+                for row in deferred:
+                    yield self.complete_gstt_path(row)
+            finally:
+                checker.join()
+        if not input_required:
+            self.logger.info("No user input of subdirectories is required")
+
+    def complete_gstt_path(self, row: CSVRow) -> CSVRow:
+        """
+        Replace the placeholders in a row's directory path with the user
+        inputs, collecting them from the user if they have not already been
+        collected
+            :param row (CSVRow):    CSVRow object whose path has placeholders
+            :return (CSVRow):       CSVRow object with its completed path
+        """
+        # Runfolder subdirectories (single %s) are created, whereas the
+        # worksheets runfolder directory (%s%s) must exist
+        create_dir = "%s" in row.gstt_dir.replace("%s%s", "")
         try:
-            # Requires multiple subdirectory inputs (NGS worksheets runfolder
-            # range, and runfolder name)
-            if self.dataframe["GSTT_dir"].str.contains(r"/%s%s/").any():
-                self.logger.info("Getting worksheets subdir")
-                worksheets_dir = self.collect_tkinter_var(
-                    config.WORKSHEETS_DIR_LABEL
-                )
-                self.logger.info("Getting runfolder subdir")
-                runfolder_dir = self.collect_tkinter_var(
-                    config.RUNFOLDER_DIR_LABEL
-                )
-                # Insert directories into dataframe filepath strings
-                self.dataframe["GSTT_dir"] = self.dataframe[
-                    "GSTT_dir"
-                ].str.replace(r"%s%s", rf"{worksheets_dir}/{runfolder_dir}")
-            # Only requires a single subdirectory input (runfolder name)
-            if self.dataframe["GSTT_dir"].str.contains(r"/%s/").any():
-                # Collect indices of rows for which a subdirectory will need to
-                # be created
-                df_indices = self.dataframe.index[
-                    self.dataframe["GSTT_dir"].astype(str).str.contains(r"%s")
-                ]
-                # If runfolder_dir has already been collected don't open
-                # another message box
-                if "runfolder_dir" in locals():
-                    self.dataframe["GSTT_dir"] = self.dataframe[
-                        "GSTT_dir"
-                    ].str.replace(r"%s", runfolder_dir)
-                    # Create subdirectories
-                    self.create_dirs(
-                        self.dataframe.iloc[df_indices].drop_duplicates()
-                    )
-                else:
-                    self.logger.info("Getting runfolder subdir")
-                    runfolder_dir = self.collect_tkinter_var(
-                        config.RUNFOLDER_DIR_LABEL
-                    )
-                    # Insert runfolder_dir into dataframe
-                    self.dataframe["GSTT_dir"] = self.dataframe[
-                        "GSTT_dir"
-                    ].str.replace(r"%s", runfolder_dir)
-                    # Create subdirectories
-                    self.create_dirs(
-                        self.dataframe.iloc[df_indices].drop_duplicates()
-                    )
-            else:
-                self.logger.info("No user input of subdirectories is required")
+            row.gstt_dir = self.PLACEHOLDER_REGEX.sub(
+                self.get_placeholder_value, row.gstt_dir
+            )
         except Exception as exception:
-            logger.error(
+            self.logger.error(
                 "%s was raised when completing "
                 "the GSTT paths using user inputs: %s",
                 type(exception).__name__,
                 exception,
             )
             sys.exit(1)
+        if create_dir:
+            self.create_dirs([row.gstt_dir])
+        return row
+
+    def check_roots(self, roots: set) -> None:
+        """
+        Check that the fixed parts of the paths of the rows waiting for user
+        input exist on the share, warning early of any that do not. The
+        results are kept in the filesystem metadata cache, so the completed
+        paths are validated without further round trips to the share
+            :param roots (set): Directory paths before the first placeholder
+        """
+        for root in sorted(roots):
+            if not self.path_cache.valid(root):
+                self.logger.warning(
+                    "Path does not exist on this system: %s, the rows with "
+                    "destinations under it will fail once the user input "
+                    "is given",
+                    root,
+                )
+
+    def get_placeholder_value(self, match: re.Match) -> str:
+        """
+        Return the user input that replaces a placeholder match, collecting it
+        from the user if it has not already been collected
+            :param match (re.Match):    Placeholder match
+            :return (str):              Subdirectory to insert into the path
+        """
+        # Requires multiple subdirectory inputs (NGS worksheets runfolder
+        # range, and runfolder name)
+        if match.group() == "%s%s" and self.worksheets_dir is None:
+            self.logger.info("Getting worksheets subdir")
+            self.worksheets_dir = self.get_user_input(
+                "worksheets_dir", config.WORKSHEETS_DIR_LABEL
+            )
+        # If runfolder_dir has already been collected don't open another
+        # message box
+        if self.runfolder_dir is None:
+            self.logger.info("Getting runfolder subdir")
+            self.runfolder_dir = self.get_user_input(
+                "runfolder_dir", config.RUNFOLDER_DIR_LABEL
+            )
+        if match.group() == "%s%s":
+            return f"{self.worksheets_dir}/{self.runfolder_dir}"
+        return self.runfolder_dir
+
+    def get_user_input(self, name: str, label: str) -> str:
+        """
+        Return a subdirectory that replaces a placeholder, from the answers
+        given for the CSV if it was supplied with them, otherwise from the
+        user. A CSV supplied with answers exits if the answer is missing, as
+        there may be no user to ask
+            :param name (str):  worksheets_dir or runfolder_dir
+            :param label (str): Label of the input box
+            :return (str):      Subdirectory
+        """
+        if self.answers is None:
+            return self.collect_tkinter_var(label)
+        value = self.answers.get(name)
+        if not value:
+            self.logger.error(
+                "The CSV requires the %s subdirectory, but it is not given "
+                "by its answers file or the runfolder rule",
+                name,
+            )
+            sys.exit(1)
+        self.logger.info("The following %s was supplied: %s", name, value)
+        return value
 
     def collect_tkinter_var(self, label) -> str:
         """
@@ -170,6 +493,7 @@ class ProcessCSV:
             :return (str): Contents from Tkinter Entry
         """
         try:
+            tk = startup.timed_import("tkinter")
             master = tk.Tk()
             entry = GetTkinterEntry(master, label)
             master.protocol("WM_DELETE_WINDOW", entry.on_close)
@@ -187,134 +511,711 @@ class ProcessCSV:
             )
             sys.exit(1)
 
-    def create_download_commands(self) -> list:
+    def create_download_commands(
+        self, rows: Iterator[CSVRow]
+    ) -> Iterator[DownloadTask]:
         """
-        For each file in the dataframe, check GSTT directory path is valid, if
-        so add the subdir to the path, and create the powershell download
-        command for that file. Append to the download commands list
-            :return download_cmds(list): Powershell download commands
+        For each row, check GSTT directory path is valid, if so add the
+        subdir to the path, and create the powershell download command for
+        that file, which is written to the commands log as an audit trail.
+        Yield a download task for each file
+            :param rows (Iterator): CSVRow objects with completed paths
+            :return (Iterator):     DownloadTask objects
         """
-        try:
-            for path in self.dataframe["GSTT_dir"]:
-                self.valid_path(path)
-            self.dataframe["GSTT_dir"] = (
-                self.dataframe["GSTT_dir"] + self.dataframe["subdir"]
-            )
-            # Generate download cmds
-            download_cmds = (
-                "powershell Start-BitsTransfer -Source '"
-                + self.dataframe["Url"]
-                + "' -Destination '"
-                + self.dataframe["GSTT_dir"]
-                + "'"
-            ).tolist()
-            return download_cmds
-        except Exception as exception:
-            self.logger.error(
-                "%s was raised when creating the powershell "
-                "DNAnexus file download commands: %s",
-                type(exception).__name__,
-                exception,
-            )
-            sys.exit(1)
+        for row in rows:
+            self.valid_path(row.gstt_dir)
+            destination = row.gstt_dir + row.subdir
+            self.create_dirs([destination])
+            try:
+                # Generate download cmd
+                task = DownloadTask(
+                    row.url,
+                    destination,
+                    BitsTransport.command(row.url, destination),
+                    row.size,
+                    row.md5,
+                )
+                self.policy.classify(task)
+            except Exception as exception:
+                self.logger.error(
+                    "%s was raised when creating the powershell "
+                    "DNAnexus file download command: %s",
+                    type(exception).__name__,
+                    exception,
+                )
+                sys.exit(1)
+            self.task_count += 1
+            yield task
 
     def valid_path(self, path) -> True:
         """
-        Validation of path using os
+        Validation of path using the filesystem metadata cache, so each
+        directory is only checked on the share once per run
             :return True:
         """
-        if os.path.isabs(path) and os.path.exists(path):
+        if self.path_cache.valid(path):
             return True
         else:
             self.logger.error("Path does not exist on this system: %s", path)
             sys.exit(1)
 
-    def create_dirs(self, dataframe) -> None:
+    def create_dirs(self, directories: list) -> None:
         """
-        Create subdirectories specified in the dataframe if they
-        don't already exist
+        Create directories if they don't already exist, using the filesystem
+        metadata cache so directories already seen in this run are not
+        checked on the share again
+            :param directories (list):  Directory paths
         """
-        for directory in dataframe["GSTT_dir"]:
-            if not os.path.exists(directory):
+        try:
+            for directory in self.path_cache.ensure_dirs(directories):
+                self.logger.info(
+                    "The following directory was created: %s", directory
+                )
+        except Exception as exception:
+            self.logger.error(
+                "%s was raised when trying to create the directories %s: %s",
+                type(exception).__name__,
+                directories,
+                exception,
+            )
+            sys.exit(1)
+
+    def write_cmds_to_file(
+        self, tasks: Iterator[DownloadTask]
+    ) -> Iterator[DownloadTask]:
+        """
+        Write the command of each task to file for audit trail, before the
+        task is passed on for download
+            :param tasks (Iterator):    DownloadTask objects
+            :return (Iterator):         DownloadTask objects
+        """
+        try:
+            file = open(self.cmds_filepath, "w+", encoding="utf-8")
+        except Exception as exception:
+            self.logger.error(
+                "%s was raised when opening the powershell commands "
+                "file (%s): %s",
+                type(exception).__name__,
+                self.cmds_filepath,
+                exception,
+            )
+            sys.exit(1)
+        with file:
+            for task in tasks:
                 try:
-                    os.mkdir(directory)
-                    self.logger.info(
-                        "The following directory was created: %s", directory
-                    )
+                    file.write(f"{task.command}\n")
+                    file.flush()
                 except Exception as exception:
                     self.logger.error(
-                        "%s was raised when trying to create "
-                        "the directory %s: %s",
+                        "%s was raised when writing powershell commands "
+                        "to file (%s): %s",
                         type(exception).__name__,
-                        directory,
+                        self.cmds_filepath,
                         exception,
                     )
                     sys.exit(1)
+                yield task
 
-    def write_cmds_to_file(self) -> None:
+    def write_dispatch_order(self, tasks: list) -> None:
         """
-        Write commands from self.command_list to file for audit trail
+        Append the order the downloads were started in to the commands file
+        as comments, with the priority class and size each was scheduled by
+            :param tasks (list):    DownloadTask objects in the order started
         """
         try:
-            with open(self.cmds_filepath, "w+", encoding="utf-8") as file:
-                for cmd in self.download_cmds:
-                    file.write(f"{cmd}\n")
+            with open(self.cmds_filepath, "a", encoding="utf-8") as file:
+                file.write("# Order in which the downloads were started\n")
+                for number, task in enumerate(tasks, 1):
+                    size = "unknown" if task.size is None else task.size
+                    file.write(
+                        f"# {number} {task.priority} {size} bytes "
+                        f"{task.url} {task.filepath}\n"
+                    )
         except Exception as exception:
             self.logger.error(
-                "%s was raised when writing powershell commands "
-                "to file (%s): %s",
+                "%s was raised when writing the download order to file "
+                "(%s): %s",
                 type(exception).__name__,
                 self.cmds_filepath,
                 exception,
             )
-            sys.exit(1)
 
-    def download_data(self) -> None:
+    def queued_tasks(
+        self, tasks: Iterator[DownloadTask]
+    ) -> Iterator[DownloadTask]:
         """
-        Set off each command in self.command_list as a child process
+        Yield the download tasks that the transfer journal does not record
+        as downloaded by a previous run, recording them as pending. Files
+        downloaded by a previous run that have an expected MD5 checksum the
+        journal has not recorded are yielded to have their checksum verified
+            :param tasks (Iterator):    DownloadTask objects
+            :return (Iterator):         DownloadTask objects to download
         """
-        for cmd in self.download_cmds:
-            self.run_process(cmd)
-        self.logger.info("All commands executed without error")
+        skipped = 0
+        verified = 0
+        for task in tasks:
+            if self.journal.completed(task):
+                checksum = self.journal.checksum(task)
+                if not task.md5 or checksum == task.md5:
+                    skipped += 1
+                    continue
+                if checksum is None:
+                    task.verify = True
+                    verified += 1
+            if not task.verify:
+                self.journal.pending([task])
+            self.metrics.queued(task)
+            self.queued_count += 1
+            yield task
+        if skipped:
+            self.logger.info(
+                "%s of %s files were downloaded by a previous run and will "
+                "not be downloaded again",
+                skipped,
+                self.task_count,
+            )
+        if verified:
+            self.logger.info(
+                "%s files downloaded by a previous run will have their "
+                "checksums verified",
+                verified,
+            )
 
-    def run_process(self, command: str) -> None:
+    def download_data(self) -> None:
         """
-        Execute command as child process using os.system()
-        and communicate output
+        Run the download tasks concurrently using the DownloadExecutor as
+        they are generated from the CSV, skipping files the transfer journal
+        records as downloaded by a previous run. Rows with the same URL are
+        grouped so the URL is downloaded once, and its file linked or copied
+        to the other destinations. Staged downloads are flushed to their
+        destinations before the results are collected. Pending tasks are
+        started in the order set by the priority policy, using sizes from the
+        CSV, the download cache index or probed in the background. All tasks
+        are attempted, then the script exits if any of them failed. If a row
+        of the CSV is invalid, no further downloads are started and the
+        script exits once the downloads in progress have finished. If
+        processing is stopped with stop(), no further downloads are started
+        and the script exits once the downloads in progress have finished,
+        leaving the CSV to be resumed by a later run. If preflight checks are
+        enabled, the whole CSV is read and checked before any download is
+        started, and a hard failure exits before downloading
         """
-        self.logger.info("Running the following command: %s", command)
-        attempts = 1
-        while attempts < 6:
-            try:
-                # Shutdown logger to allow appending to file
-                self.logger_obj.shutdown_logs()
-                returncode = os.system(f"{command} >> {self.logfile_path}")
-                self.logger_obj = Logger(self.logfile_path)
-                self.logger = self.logger_obj.logger
-                if returncode == 0:
-                    self.logger.info(
-                        "Command executed without error. Returncode: %s",
-                        returncode,
+        executor = DownloadExecutor(
+            self.jobs, self.share_jobs, self.logger, self.policy.sort_key
+        )
+        prober = SizeProber(config.SIZE_PROBE_JOBS, self.logger)
+        self.executor = executor
+        self.prober = prober
+        executor.start(download_group)
+        groups = {}
+        try:
+            tasks = self.iter_tasks()
+            if config.PLAN["PREFLIGHT"]:
+                tasks = self.read_tasks(prober)
+                if not self.stopping and self.preflight(tasks, prober):
+                    self.logger.error(
+                        "The preflight found hard failures, no downloads "
+                        "will be started"
                     )
+                    sys.exit(1)
+            for task in tasks:
+                if self.stopping:
                     break
+                group = groups.get(task.url)
+                if group is not None and group.add(self, task):
+                    # The task may raise the group's priority class
+                    executor.update(group)
+                    continue
+                if group is not None:
+                    # The URL's download has finished, copy from its file
+                    group = DownloadGroup(self, task, group.source or group)
                 else:
-                    self.logger.error(
-                        "An error was encountered, with returncode %s",
-                        returncode,
-                    )
-                    if attempts < 5:
-                        self.logger.info(
-                            "Trying again. Attempt %s", attempts + 1
-                        )
-                    else:
-                        sys.exit(1)
-                    attempts += 1
+                    group = DownloadGroup(self, task)
+                    schedule_group(group, prober, self.cache, executor)
+                groups[task.url] = group
+                executor.submit(group)
+            if self.stopping:
+                # Tasks submitted while stop() was cancelling are not started
+                executor.cancel()
+        except SystemExit:
+            executor.cancel()
+            prober.close()
+            self.logger.error(
+                "Processing of the CSV has stopped. Waiting for downloads in "
+                "progress to finish before exiting"
+            )
+            executor.join()
+            self.close_pools()
+            self.journal.close()
+            self.write_metrics()
+            raise
+        try:
+            executor.join()
+        finally:
+            prober.close()
+            self.close_pools()
+            self.journal.close()
+            self.write_metrics()
+        dispatched = executor.take_dispatched()
+        self.write_dispatch_order(
+            [task for group in dispatched for _, task in group.members]
+        )
+        if self.queued_count > len(groups):
+            self.logger.info(
+                "%s downloads were merged into %s unique URLs, the other "
+                "destinations were filled from the downloaded files",
+                self.queued_count,
+                len(groups),
+            )
+        failed_tasks = [
+            task
+            for group in dispatched
+            for _, task, success in group.results
+            if not success
+        ]
+        if self.stopping:
+            self.logger.error(
+                "Processing was stopped before all downloads had started, "
+                "the CSV will not be archived"
+            )
+            sys.exit(1)
+        self.path_cache.log_stats(self.logger)
+        if failed_tasks:
+            for task in failed_tasks:
+                self.logger.error(
+                    "The following download did not complete: %s to %s",
+                    task.url,
+                    task.filepath,
+                )
+            self.logger.error(
+                "%s of %s downloads failed",
+                len(failed_tasks),
+                self.task_count,
+            )
+            sys.exit(1)
+        self.logger.info("All commands executed without error")
+
+    def run_process(self, task: DownloadTask) -> bool:
+        """
+        Download the task's file using the transport backend, retrying on
+        failure according to the retry policy: up to its maximum number of
+        attempts, with an exponential backoff with jitter between attempts,
+        and waiting while the circuit breaker has paused downloads from the
+        URL's host. A file held by the download cache is served from it
+        instead. A file that does not match its expected MD5 checksum is
+        deleted and downloaded again. With a staging directory, the file is
+        downloaded there and is not recorded as done until flush_staged()
+        has moved it to its destination. A file downloaded by a previous run is
+        only downloaded again if its checksum does not match. Safe to call
+        from multiple threads
+            :param task (DownloadTask): Download task
+            :return (bool):             True if the file downloaded without
+                                        error within the permitted attempts
+        """
+        if task.verify:
+            self.metrics.attempt(task)
+            if self.verify_existing(task):
+                self.metrics.finished(task, TransferMetrics.VERIFIED)
+                return True
+        if self.cache is not None and self.serve_cached(task):
+            return True
+        if self.staging is not None and not task.staged():
+            try:
+                self.staging.stage(task)
+            except OSError as exception:
+                self.logger.error(
+                    "%s was raised when staging %s, it will be downloaded "
+                    "straight to its destination: %s",
+                    type(exception).__name__,
+                    task.filepath,
+                    exception,
+                )
+        self.journal.in_flight(task)
+        breaker = self.retry_policy.breaker
+        attempts = 0
+        while True:
+            attempts += 1
+            trial = breaker.wait(task.url, self.logger)
+            self.metrics.attempt(task)
+            try:
+                checksum = self.transport.fetch(task, self.logger)
+                breaker.success(task.url, self.logger)
+            except TransferError as exception:
+                # A rejected request is not a host failure
+                if not exception.client_error:
+                    breaker.failure(task.url, self.logger)
+                self.logger.error(
+                    "An error was encountered when downloading %s: %s",
+                    task.url,
+                    exception,
+                )
             except Exception as exception:
+                breaker.failure(task.url, self.logger)
                 self.logger.error(
-                    "%s was raised when running the command: %s",
+                    "%s was raised when downloading %s: %s",
                     type(exception).__name__,
+                    task.url,
                     exception,
                 )
+            else:
+                # The transfer succeeded, so errors from here on are not
+                # counted against the host
+                try:
+                    self.verify_checksum(task, checksum)
+                except ChecksumError as exception:
+                    self.logger.error(
+                        "An error was encountered when downloading %s: %s",
+                        task.url,
+                        exception,
+                    )
+                except OSError as exception:
+                    self.logger.error(
+                        "%s was raised when verifying the checksum of %s: %s",
+                        type(exception).__name__,
+                        task.download_path,
+                        exception,
+                    )
+                else:
+                    if task.staged():
+                        # Recorded as done once flushed to the destination
+                        return True
+                    self.record_done(task)
+                    return True
+            finally:
+                if trial:
+                    # A trial whose outcome was not recorded lets another in
+                    breaker.release(task.url)
+            if attempts >= self.retry_policy.attempts:
+                self.journal.failed(task)
+                self.metrics.finished(task, TransferMetrics.FAILED)
+                return False
+            delay = self.retry_policy.delay(attempts)
+            self.logger.info(
+                "Trying again in %.1fs. Attempt %s of %s (%s)",
+                delay,
+                attempts + 1,
+                self.retry_policy.attempts,
+                task.url,
+            )
+            time.sleep(delay)
+
+    def record_done(self, task: DownloadTask) -> None:
+        """
+        Record a completed download in the journal and metrics. A failure to
+        write the journal is logged but does not fail the download, which a
+        rerun downloads again
+            :param task (DownloadTask): Download task
+        """
+        try:
+            self.journal.done(task, task.checksum)
+        except OSError as exception:
+            self.logger.error(
+                "%s was raised when recording %s as done in the transfer "
+                "journal, a rerun will download it again: %s",
+                type(exception).__name__,
+                task.filepath,
+                exception,
+            )
+        self.metrics.finished(task, TransferMetrics.DONE)
+        self.logger.info("Download completed without error: %s", task.url)
+
+    def verify_existing(self, task: DownloadTask) -> bool:
+        """
+        Verify the checksum of a file downloaded by a previous run, using the
+        checksum thread pool. The verified checksum is recorded in the
+        journal so the file is not hashed again by later runs
+            :param task (DownloadTask): Download task
+            :return (bool):             True if the file matches its expected
+                                        checksum
+        """
+        try:
+            checksum = self.checksum_pool.md5(task.filepath)
+        except OSError as exception:
+            self.logger.error(
+                "%s was raised when computing the checksum of %s: %s",
+                type(exception).__name__,
+                task.filepath,
+                exception,
+            )
+            return False
+        if checksum != task.md5:
+            self.logger.error(
+                "%s was downloaded by a previous run but its MD5 checksum %s "
+                "does not match the expected %s, it will be downloaded again",
+                task.filepath,
+                checksum,
+                task.md5,
+            )
+            return False
+        task.checksum = checksum
+        self.journal.done(task, checksum)
+        self.logger.info(
+            "MD5 checksum verified for %s, downloaded by a previous run",
+            task.filepath,
+        )
+        return True
+
+    def verify_checksum(self, task: DownloadTask, checksum: str) -> None:
+        """
+        Check a downloaded file against its expected MD5 checksum. If the
+        transport did not compute the checksum while downloading, the file is
+        hashed by the checksum thread pool. A file that does not match is
+        deleted so the retry downloads it from the start
+            :param task (DownloadTask): Download task
+            :param checksum (str):      MD5 checksum computed by the
+                                        transport, or None
+        """
+        if not task.md5:
+            task.checksum = checksum
+            return
+        try:
+            if checksum is None:
+                checksum = self.checksum_pool.md5(task.download_path)
+            if checksum != task.md5:
+                os.remove(task.download_path)
+                raise ChecksumError(
+                    f"MD5 checksum {checksum} of {task.download_path} does "
+                    f"not match the expected {task.md5}"
+                )
+        except OSError as exception:
+            raise ChecksumError(
+                f"{type(exception).__name__} was raised when verifying the "
+                f"checksum of {task.download_path}: {exception}"
+            ) from exception
+        task.checksum = checksum
+        self.logger.info("MD5 checksum verified for %s", task.download_path)
+
+    def flush_staged(self, task: DownloadTask) -> bool:
+        """
+        Move a file downloaded to the staging directory to its destination,
+        then record it as done. Runs in the staging flusher pool
+            :param task (DownloadTask): Download task whose file is staged
+            :return (bool):             True if the file was moved
+        """
+        self.cache_file(task, task.download_path)
+        try:
+            method = self.staging.flush(task)
+        except OSError as exception:
+            self.logger.error(
+                "%s was raised when moving %s to %s: %s",
+                type(exception).__name__,
+                task.download_path,
+                task.filepath,
+                exception,
+            )
+            self.journal.failed(task)
+            self.metrics.finished(task, TransferMetrics.FAILED)
+            return False
+        self.journal.done(task, task.checksum)
+        self.metrics.finished(task, TransferMetrics.DONE)
+        self.logger.info(
+            "Moved %s from the staging directory to %s (%s)",
+            task.download_path,
+            task.filepath,
+            method,
+        )
+        self.logger.info("Download completed without error: %s", task.url)
+        return True
+
+    def serve_cached(self, task: DownloadTask) -> bool:
+        """
+        Serve the task's file from the download cache, by a hardlink or a
+        local copy. If the task has an expected checksum the served file is
+        always hashed, as a hardlinked cache file can have been modified in
+        place through a destination since its checksum was recorded; a file
+        that does not match is removed from the cache
+            :param task (DownloadTask): Download task
+            :return (bool):             True if the file was served from the
+                                        cache, False if it must be downloaded
+        """
+        path = self.cache.lookup(task)
+        if path is None:
+            return False
+        self.metrics.attempt(task)
+        try:
+            method = self.cache.serve(task, path)
+            if task.md5:
+                self.verify_checksum(task, None)
+        except (OSError, ChecksumError) as exception:
+            if isinstance(exception, ChecksumError):
+                self.cache.discard(task)
+            self.logger.error(
+                "%s was raised when serving %s from the download cache, it "
+                "will be downloaded: %s",
+                type(exception).__name__,
+                task.filepath,
+                exception,
+            )
+            return False
+        self.journal.done(task, task.checksum)
+        self.metrics.finished(task, TransferMetrics.CACHED)
+        self.logger.info(
+            "Served %s from the download cache (%s) instead of downloading "
+            "%s",
+            task.filepath,
+            method,
+            task.url,
+        )
+        return True
+
+    def cache_file(self, task: DownloadTask, path: str) -> None:
+        """
+        Add a downloaded file to the download cache. Only files in the
+        staging directory are cached, so the file is read from local disk
+        rather than from the destination share. A failure is logged but does
+        not fail the download
+            :param task (DownloadTask): Download task
+            :param path (str):          Path of the staged file
+        """
+        if self.cache is None:
+            return
+        try:
+            self.cache.store(task, path)
+        except OSError as exception:
+            self.logger.error(
+                "%s was raised when adding %s to the download cache: %s",
+                type(exception).__name__,
+                path,
+                exception,
+            )
+
+    def preflight(self, tasks: list, prober: SizeProber) -> list:
+        """
+        Probe every task's URL for its size and reachability, check the free
+        space on each destination volume, and log and write the report. Run
+        before any of the tasks are submitted. URLs held by the download
+        cache are not probed. An error in the checks themselves is logged
+        but is not a hard failure
+            :param tasks (list):        DownloadTask objects
+            :param prober (SizeProber): Prober used to schedule the tasks, so
+                                        each URL is only probed once
+            :return (list):             Descriptions of the hard failures
+        """
+        cached = set()
+        if self.cache is not None:
+            for task in tasks:
+                size = self.cache.contains(task)
+                if size is not None:
+                    task.size = size
+                    cached.add(task.url)
+        try:
+            report, failures = PreflightPlanner().run(tasks, prober, cached)
+        except Exception as exception:
+            self.logger.error(
+                "%s was raised when running the preflight checks: %s",
+                type(exception).__name__,
+                exception,
+            )
+            return []
+        for line in report.splitlines():
+            self.logger.info("Preflight: %s", line)
+        for failure in failures:
+            self.logger.error("Preflight failure: %s", failure)
+        try:
+            with open(self.plan_path, "w", encoding="utf-8") as file:
+                file.write(f"{report}\n")
+            self.logger.info("Preflight report written to %s", self.plan_path)
+        except OSError as exception:
+            self.logger.error(
+                "%s was raised when writing the preflight report to %s: %s",
+                type(exception).__name__,
+                self.plan_path,
+                exception,
+            )
+        return failures
+
+    def close_pools(self) -> None:
+        """
+        Wait for staged files to be flushed to their destinations, log the
+        download cache counts and write its index, and shut down the checksum
+        pool unless it is shared with other CSVs. The staging area and cache
+        are left open for later CSVs, and are closed by their creator
+        """
+        if self.staging is not None:
+            self.staging.wait()
+        if self.cache is not None:
+            self.cache.log_stats(self.logger)
+            self.cache.save()
+        if self.owns_checksum_pool:
+            self.checksum_pool.close()
+
+    def stop(self) -> None:
+        """
+        Stop starting downloads, letting those in progress finish. The CSV
+        is then not archived, and a later run resumes it. Safe to call from
+        another thread
+        """
+        self.stopping = True
+        if self.executor is not None:
+            self.executor.cancel()
+
+    def copy_duplicate(
+        self, source_task: DownloadTask, task: DownloadTask
+    ) -> bool:
+        """
+        Copy a file downloaded for another row (of this or another CSV) with
+        the same URL to the task's destination, as a hardlink where both are
+        on the same volume, otherwise by a kernel copy. The copy is written to
+        a temporary file and renamed, so a partial copy is never left at the
+        destination
+            :param source_task (DownloadTask):  Task the file was downloaded
+                                                for
+            :param task (DownloadTask):         Download task
+            :return (bool):                     True if the copy succeeded
+        """
+        self.metrics.attempt(task)
+        try:
+            method = "none needed"
+            if os.path.normcase(os.path.abspath(source_task.filepath)) != (
+                os.path.normcase(os.path.abspath(task.filepath))
+            ):
+                method = link_or_copy(source_task.filepath, task.filepath)
+            task.checksum = source_task.checksum
+            self.journal.done(task, task.checksum)
+            self.metrics.finished(task, TransferMetrics.COPIED)
+            self.logger.info(
+                "Copied %s to %s (%s), as it has the same URL %s",
+                source_task.filepath,
+                task.filepath,
+                method,
+                task.url,
+            )
+            return True
+        except OSError as exception:
+            self.logger.error(
+                "%s was raised when copying %s to %s: %s",
+                type(exception).__name__,
+                source_task.filepath,
+                task.filepath,
+                exception,
+            )
+            self.journal.failed(task)
+            self.metrics.finished(task, TransferMetrics.FAILED)
+            return False
+
+    def write_metrics(self) -> None:
+        """
+        Log the transfer metrics and write the JSON and CSV summaries beside
+        the process log. A failure to write the summaries is logged but does
+        not stop the script
+        """
+        self.metrics.log_totals(self.logger)
+        try:
+            self.metrics.write_summary(
+                f"{self.metrics_path}.json", f"{self.metrics_path}.csv"
+            )
+            self.logger.info(
+                "Transfer metrics written to %s.json and %s.csv",
+                self.metrics_path,
+                self.metrics_path,
+            )
+        except Exception as exception:
+            self.logger.error(
+                "%s was raised when writing the transfer metrics to %s: %s",
+                type(exception).__name__,
+                self.metrics_path,
+                exception,
+            )
 
     def archive_csv(self) -> None:
         """
@@ -338,6 +1239,748 @@ class ProcessCSV:
             sys.exit(1)
 
 
+def schedule_group(
+    group: DownloadGroup,
+    prober: SizeProber,
+    cache: DownloadCache,
+    executor: DownloadExecutor,
+) -> None:
+    """
+    Consult the download cache index for a group before it is scheduled. A
+    cached file's size is known, so only groups not in the cache are probed,
+    with their validator requested so that they can be cached. A probed
+    group is reordered in the executor once its size is known
+        :param group (DownloadGroup):       Tasks with the same URL
+        :param prober (SizeProber):         Prober for sizes and validators
+        :param cache (DownloadCache):       Download cache, or None
+        :param executor (DownloadExecutor): Executor the group is submitted to
+    """
+    size = cache.contains(group.members[0][1]) if cache else None
+    if size is not None:
+        group.size = size
+    else:
+        prober.submit(group, cache is not None, executor.update)
+
+
+def download_group(group: DownloadGroup) -> bool:
+    """
+    Download a URL once, using the ProcessCSV of the first row it appears
+    in, then link or copy it to the destinations of the other rows,
+    including rows added to the group while the download was running. A
+    group started after its URL's download finished copies from that file.
+    A staged download is handed to the staging flusher pool to finish, so
+    the download slot is freed while the file is written to the share
+        :param group (DownloadGroup):   Tasks with the same URL
+        :return (bool):                 True if all tasks succeeded
+    """
+    if group.source is None:
+        process, task = group.members[0]
+        group.downloaded = process.run_process(task)
+        if group.downloaded and task.staged():
+            # Free the download slot while the file is flushed to the share
+            process.staging.submit(flush_group, group)
+            return True
+    return finish_group(group)
+
+
+def flush_group(group: DownloadGroup) -> bool:
+    """
+    Finish a staged group in the staging flusher pool. If finishing raises,
+    the members without a result are recorded as failed and the group's
+    on_finished callback is still called, so the group's CSVs do not wait
+    for results that never come
+        :param group (DownloadGroup):   Tasks with the same URL
+        :return (bool):                 True if all tasks succeeded
+    """
+    try:
+        return finish_group(group)
+    except Exception as exception:
+        group.members[0][0].logger.error(
+            "%s was raised when finishing the download of %s: %s",
+            type(exception).__name__,
+            group.url,
+            exception,
+        )
+    # Close the group so later tasks with the URL start a new group
+    while group.next_member() is not None:
+        pass
+    finished = {id(task) for _, task, _ in group.results}
+    if id(group.members[0][1]) not in finished:
+        group.downloaded = False
+    if len(finished) == len(group.members):
+        # on_finished itself raised, after every member had its result
+        return False
+    for process, task in group.members:
+        if id(task) in finished:
+            continue
+        try:
+            process.journal.failed(task)
+        except OSError:
+            pass
+        process.metrics.finished(task, TransferMetrics.FAILED)
+        group.results.append((process, task, False))
+    if group.on_finished is not None:
+        group.on_finished(group)
+    return False
+
+
+def finish_group(group: DownloadGroup) -> bool:
+    """
+    Flush the downloaded file of a group from the staging directory, then
+    link or copy it to the destinations of the other members, and call the
+    group's on_finished callback
+        :param group (DownloadGroup):   Tasks with the same URL
+        :return (bool):                 True if all tasks succeeded
+    """
+    if group.source is None:
+        process, task = group.members[0]
+        if group.downloaded and task.staged():
+            group.downloaded = process.flush_staged(task)
+        group.results.append((process, task, group.downloaded))
+    else:
+        task = group.source.members[0][1]
+        group.downloaded = group.source.downloaded
+    member = group.next_member()
+    while member is not None:
+        duplicate_process, duplicate_task = member
+        if group.downloaded:
+            copied = duplicate_process.copy_duplicate(task, duplicate_task)
+        else:
+            duplicate_process.logger.error(
+                "%s was not copied to %s as its download failed",
+                duplicate_task.url,
+                duplicate_task.filepath,
+            )
+            duplicate_process.journal.failed(duplicate_task)
+            duplicate_process.metrics.finished(
+                duplicate_task, TransferMetrics.FAILED
+            )
+            copied = False
+        group.results.append((duplicate_process, duplicate_task, copied))
+        member = group.next_member()
+    if group.on_finished is not None:
+        group.on_finished(group)
+    return all(success for _, _, success in group.results)
+
+
+class BatchScheduler:
+    """
+    Process every unarchived CSV in the CSV folder as a single batch. The
+    rows of all CSVs are merged into one work queue in which each distinct
+    URL is downloaded once, then copied to the destinations of any other rows
+    with the same URL. Each CSV keeps its own process log, commands log and
+    transfer journal, and is archived as soon as all of its rows complete.
+    In plan mode, each CSV is only prepared and checked by the preflight
+
+    Methods
+        run()
+            Prepare each CSV, run the merged work queue and return the exit
+            code
+        find_csvs()
+            Return the paths of the CSVs waiting in the CSV folder
+        prepare()
+            Create the logger and ProcessCSV object for a CSV, and read its
+            queued download tasks
+        create_groups()
+            Group the queued tasks of all CSVs by URL
+        run_group()
+            Download a URL once and copy it to the other destinations
+        _group_finished()
+            Record the results of a group's tasks
+        _task_finished()
+            Record a task's result, archiving its CSV once all its tasks have
+            completed successfully
+        _csv_finished()
+            Archive a CSV whose tasks all completed, or log its failure
+    """
+
+    def __init__(
+        self,
+        script_mode: str,
+        transport,
+        jobs: int,
+        share_jobs: int,
+        logger: logging.Logger,
+        retry_policy: RetryPolicy = None,
+        staging: StagingArea = None,
+        cache: DownloadCache = None,
+        profiler: "profiling.StageProfiler" = None,
+        plan: bool = False,
+    ):
+        """
+        Constructor for the BatchScheduler class
+            :param script_mode (str):   TEST or PROD
+            :param transport (obj):     Download transport backend
+            :param jobs (int):          Maximum number of concurrent downloads
+            :param share_jobs (int):    Maximum number of concurrent downloads
+                                        to a single destination share
+            :param logger (obj):        Python logging object for the batch
+            :param retry_policy (obj):  RetryPolicy shared by the CSVs, the
+                                        configured policy is used if not
+                                        supplied
+            :param staging (obj):       StagingArea shared by the CSVs, or
+                                        None to download straight to the
+                                        destinations
+            :param cache (obj):         DownloadCache shared by the CSVs, or
+                                        None to not cache downloads
+            :param profiler (obj):      StageProfiler shared by the CSVs, or
+                                        None to not profile
+            :param plan (bool):         Dry run: run the preflight checks on
+                                        each CSV without downloading
+        """
+        self.script_mode = script_mode
+        self.transport = transport
+        self.jobs = jobs
+        self.share_jobs = share_jobs
+        self.logger = logger
+        self.path_cache = PathCache()
+        self.checksum_pool = ChecksumPool()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.staging = staging
+        self.cache = cache
+        self.profiler = profiler
+        self.plan = plan
+        self.policy = PriorityPolicy()
+        self._lock = threading.Lock()
+        self._remaining = {}
+        self._failed = {}
+        self.failed_csvs = []
+        self.processes = []
+
+    def run(self) -> int:
+        """
+        Prepare each CSV, run the merged work queue in priority order and
+        return the exit code. In plan mode, return once every CSV has been
+        prepared and checked
+            :return (int):  0 if every CSV was processed and archived (or in
+                            plan mode, passed the preflight checks), else 1
+        """
+        csv_paths = self.find_csvs()
+        self.logger.info(
+            "Found %s unarchived CSV files: %s", len(csv_paths), csv_paths
+        )
+        processes = self.processes
+        queued = []
+        prober = SizeProber(config.SIZE_PROBE_JOBS, self.logger)
+        try:
+            for csv_path in csv_paths:
+                process, tasks = self.prepare(csv_path, prober)
+                if process is None:
+                    self.failed_csvs.append(csv_path)
+                    continue
+                processes.append(process)
+                if self.plan:
+                    process.journal.close()
+                    continue
+                self._remaining[process] = len(tasks)
+                self._failed[process] = 0
+                queued.extend((process, task) for task in tasks)
+                if not tasks:
+                    self._csv_finished(process)
+            if self.plan:
+                if self.failed_csvs:
+                    self.logger.error(
+                        "The following CSV files could not be prepared or "
+                        "failed the preflight checks: %s",
+                        self.failed_csvs,
+                    )
+                    return 1
+                self.logger.info(
+                    "Dry run complete. No files were downloaded and no CSV "
+                    "files were archived"
+                )
+                return 0
+            groups = self.create_groups(queued)
+            self.logger.info(
+                "%s downloads from %s CSV files merged into %s unique URLs",
+                len(queued),
+                len(processes),
+                len(groups),
+            )
+            executor = DownloadExecutor(
+                self.jobs, self.share_jobs, self.logger, self.policy.sort_key
+            )
+            for group in groups:
+                schedule_group(group, prober, self.cache, executor)
+            executor.run(groups, self.run_group)
+        finally:
+            prober.close()
+            if self.staging is not None:
+                self.staging.close()
+            if self.cache is not None:
+                self.cache.log_stats(self.logger)
+                self.cache.close()
+            self.checksum_pool.close()
+        dispatched = {process: [] for process in processes}
+        for group in executor.take_dispatched():
+            for process, task in group.members:
+                dispatched[process].append(task)
+        for process in processes:
+            process.write_dispatch_order(dispatched[process])
+            process.journal.close()
+            process.write_metrics()
+        self.path_cache.log_stats(self.logger)
+        if self.failed_csvs:
+            self.logger.error(
+                "The following CSV files were not processed successfully: %s",
+                self.failed_csvs,
+            )
+            return 1
+        self.logger.info("All CSV files were processed successfully")
+        return 0
+
+    def find_csvs(self) -> list:
+        """
+        Return the paths of the CSVs waiting in the CSV folder. Archived CSVs
+        have been moved to the archive subdirectory so are not included
+            :return (list): CSV file paths
+        """
+        csv_folder = config.CSV_FOLDER[self.script_mode]
+        return sorted(
+            f"{csv_folder}{entry.name}"
+            for entry in os.scandir(csv_folder)
+            if entry.is_file() and entry.name.lower().endswith(".csv")
+        )
+
+    def prepare(
+        self, csv_path: str, prober: SizeProber
+    ) -> Tuple[ProcessCSV, list]:
+        """
+        Create the logger and ProcessCSV object for a CSV, and read its
+        queued download tasks. A CSV that fails to prepare, or whose
+        preflight checks find a hard failure, is logged and left unarchived
+            :param csv_path (str):      Path to CSV file
+            :param prober (SizeProber): Prober used to schedule the tasks
+            :return (ProcessCSV):       ProcessCSV object, or None on failure
+            :return (list):             DownloadTask objects to download
+        """
+        csv_name = csv_path.rsplit("/", 1)[1]
+        csv_logfile_path = (
+            f"{config.DIRS['LOGS'] % config.CSV_FOLDER[self.script_mode]}"
+            f"process_duty_csv_{config.TIMESTAMP}"
+            f"{csv_name.split('.csv')[0]}.log"
+        )
+        csv_logger_obj, csv_logger = get_logger(csv_logfile_path, csv_name)
+        csv_logger.info(
+            "Running process_duty_csv %s in %s batch mode",
+            git_tag(),
+            self.script_mode,
+        )
+        self.logger.info(
+            "Processing %s, logging to %s", csv_path, csv_logfile_path
+        )
+        process = None
+        try:
+            process = ProcessCSV(
+                csv_path,
+                self.script_mode,
+                csv_logfile_path,
+                csv_logger_obj,
+                self.transport,
+                self.jobs,
+                self.share_jobs,
+                self.path_cache,
+                self.checksum_pool,
+                self.retry_policy,
+                self.staging,
+                self.cache,
+                profiler=self.profiler,
+            )
+            tasks = list(process.iter_tasks())
+            if (self.plan or config.PLAN["PREFLIGHT"]) and process.preflight(
+                tasks, prober
+            ):
+                process.logger.error(
+                    "The preflight found hard failures, the CSV will not be "
+                    "downloaded"
+                )
+                sys.exit(1)
+            return process, tasks
+        except SystemExit:
+            if process is not None:
+                process.journal.close()
+            self.logger.error(
+                "%s could not be prepared for download, see %s",
+                csv_path,
+                csv_logfile_path,
+            )
+            return None, []
+
+    @staticmethod
+    def create_groups(queued: list) -> list:
+        """
+        Group the queued tasks of all CSVs by URL, preserving the order in
+        which each URL first appears
+            :param queued (list):   (ProcessCSV, DownloadTask) tuples
+            :return (list):         DownloadGroup objects
+        """
+        groups = {}
+        for process, task in queued:
+            if not (
+                task.url in groups and groups[task.url].add(process, task)
+            ):
+                groups[task.url] = DownloadGroup(process, task)
+        return list(groups.values())
+
+    def run_group(self, group: DownloadGroup) -> bool:
+        """
+        Download a URL once, using the ProcessCSV of the first row it appears
+        in, then copy it to the other destinations
+            :param group (DownloadGroup):   Tasks with the same URL
+            :return (bool):                 True if all tasks succeeded
+        """
+        group.on_finished = self._group_finished
+        return download_group(group)
+
+    def _group_finished(self, group: DownloadGroup) -> None:
+        """
+        Record the results of a group's tasks
+            :param group (DownloadGroup):   Tasks with the same URL
+        """
+        for result in group.results:
+            self._task_finished(*result)
+
+    def _task_finished(
+        self, process: ProcessCSV, task: DownloadTask, success: bool
+    ) -> None:
+        """
+        Record a task's result, archiving its CSV once all its tasks have
+        completed
+            :param process (ProcessCSV):    ProcessCSV the task belongs to
+            :param task (DownloadTask):     Download task
+            :param success (bool):          True if the task succeeded
+        """
+        with self._lock:
+            self._remaining[process] -= 1
+            if not success:
+                self._failed[process] += 1
+            finished = self._remaining[process] == 0
+        if finished:
+            self._csv_finished(process)
+
+    def _csv_finished(self, process: ProcessCSV) -> None:
+        """
+        Archive a CSV whose tasks all completed, or log its failure
+            :param process (ProcessCSV):    ProcessCSV whose tasks completed
+        """
+        if self._failed[process]:
+            process.logger.error(
+                "%s of %s downloads failed, the CSV will not be archived",
+                self._failed[process],
+                process.task_count,
+            )
+            self.failed_csvs.append(process.csv_path)
+            return
+        process.logger.info("All commands executed without error")
+        try:
+            process.archive_csv()
+        except SystemExit:
+            self.failed_csvs.append(process.csv_path)
+            return
+        process.logger.info("Script has completed successfully")
+        self.logger.info("%s was processed and archived", process.csv_path)
+
+
+class CSVDaemon:
+    """
+    Watch the CSV folder and process each CSV as it lands, keeping the
+    transport's connections or shells, the checksum pool, the staging area
+    and the download cache warm between CSVs. CSVs are processed one at a
+    time by a worker thread, in the order they land. Runfolder placeholders
+    are answered by a sidecar answers file or the runfolder rule, as there is
+    no user to ask. On SIGINT or SIGTERM no further downloads are started,
+    the downloads in progress are allowed to finish and the daemon exits
+
+    Methods
+        run()
+            Watch the CSV folder and process CSVs until stopped, then return
+            the exit code
+        request_stop()
+            Signal handler that asks the daemon to stop
+        process_csv()
+            Create the logger and ProcessCSV object for a CSV and process it
+        get_answers()
+            Return the subdirectories that replace the runfolder placeholders
+            of a CSV
+        _worker()
+            Process the CSVs put on the queue until the sentinel is received
+    """
+
+    def __init__(
+        self,
+        script_mode: str,
+        transport,
+        jobs: int,
+        share_jobs: int,
+        logger: logging.Logger,
+        retry_policy: RetryPolicy = None,
+        staging: StagingArea = None,
+        cache: DownloadCache = None,
+        runfolder_rule: str = None,
+        prometheus_textfile: str = None,
+        profile: list = None,
+    ):
+        """
+        Constructor for the CSVDaemon class
+            :param script_mode (str):           TEST or PROD
+            :param transport (obj):             Download transport backend
+            :param jobs (int):                  Maximum number of concurrent
+                                                downloads
+            :param share_jobs (int):            Maximum number of concurrent
+                                                downloads to a single
+                                                destination share
+            :param logger (obj):                Python logging object for the
+                                                daemon
+            :param retry_policy (obj):          RetryPolicy shared by the
+                                                CSVs, the configured policy
+                                                is used if not supplied
+            :param staging (obj):               StagingArea shared by the
+                                                CSVs, or None
+            :param cache (obj):                 DownloadCache shared by the
+                                                CSVs, or None
+            :param runfolder_rule (str):        Regular expression matched
+                                                against the CSV name, whose
+                                                worksheets_dir and
+                                                runfolder_dir named groups
+                                                answer the placeholders, or
+                                                None
+            :param prometheus_textfile (str):   Prometheus textfile path, or
+                                                None
+            :param profile (list):              --profile options, each CSV
+                                                is profiled if not None
+        """
+        self.script_mode = script_mode
+        self.transport = transport
+        self.jobs = jobs
+        self.share_jobs = share_jobs
+        self.logger = logger
+        self.folder = config.CSV_FOLDER[script_mode]
+        self.checksum_pool = ChecksumPool()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.staging = staging
+        self.cache = cache
+        self.runfolder_rule = (
+            re.compile(runfolder_rule) if runfolder_rule else None
+        )
+        self.prometheus_textfile = prometheus_textfile
+        self.profile = profile
+        self.process = None
+        self.processed_csvs = []
+        self.failed_csvs = []
+        self._stop = threading.Event()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+    def run(self) -> int:
+        """
+        Watch the CSV folder and hand each CSV that lands to the worker
+        thread until stopped. Once stopped, the CSV being processed is told
+        to start no further downloads, and the daemon waits for the downloads
+        in progress and the staged files to finish before closing the shared
+        pools
+            :return (int):  0 if every CSV was processed and archived, else 1
+        """
+        # Imported on first use, as ctypes and the inotify set-up slow
+        # start-up outside daemon mode
+        watcher = startup.timed_import("watcher").FolderWatcher(
+            self.folder, self.logger
+        )
+        worker = threading.Thread(
+            target=self._worker, name="daemon-worker", daemon=True
+        )
+        worker.start()
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        try:
+            while not self._stop.is_set():
+                for csv_path in watcher.wait(1):
+                    self.logger.info("%s landed in the CSV folder", csv_path)
+                    self._queue.put(csv_path)
+        finally:
+            self.logger.info(
+                "Stopping. Waiting for downloads in progress to finish"
+            )
+            self._stop.set()
+            with self._lock:
+                if self.process is not None:
+                    self.process.stop()
+            self._queue.put(None)
+            worker.join()
+            watcher.close()
+            if self.staging is not None:
+                self.staging.close()
+            if self.cache is not None:
+                self.cache.log_stats(self.logger)
+                self.cache.close()
+            self.checksum_pool.close()
+        self.logger.info(
+            "%s CSV files were processed and archived",
+            len(self.processed_csvs),
+        )
+        if self.failed_csvs:
+            self.logger.error(
+                "The following CSV files were not processed successfully: %s",
+                self.failed_csvs,
+            )
+            return 1
+        return 0
+
+    def request_stop(self, signum: int, frame) -> None:
+        """
+        Signal handler that asks the daemon to stop, and the CSV being
+        processed to start no further downloads. The default handler is
+        restored, so a second signal stops the script straight away
+            :param signum (int):    Signal number
+            :param frame (obj):     Current stack frame
+        """
+        self.logger.info("Received signal %s", signal.Signals(signum).name)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self._stop.set()
+        # Read without the lock, which the interrupted thread may hold
+        process = self.process
+        if process is not None:
+            process.stop()
+
+    def process_csv(self, csv_path: str) -> None:
+        """
+        Create the logger and ProcessCSV object for a CSV and process it. A
+        CSV that fails is logged and left in the CSV folder, and is processed
+        again if it is rewritten
+            :param csv_path (str):  Path to CSV file
+        """
+        if not os.path.exists(csv_path):
+            return
+        csv_name = csv_path.rsplit("/", 1)[1]
+        # The daemon runs for days, so each log has its own timestamp
+        csv_logfile_path = (
+            f"{config.DIRS['LOGS'] % self.folder}"
+            f"process_duty_csv_{time.strftime('%Y%m%d-%H%M%S')}"
+            f"{csv_name.split('.csv')[0]}.log"
+        )
+        csv_logger_obj, csv_logger = get_logger(csv_logfile_path, csv_name)
+        csv_logger.info(
+            "Running process_duty_csv %s in %s daemon mode",
+            git_tag(),
+            self.script_mode,
+        )
+        self.logger.info(
+            "Processing %s, logging to %s", csv_path, csv_logfile_path
+        )
+        process = None
+        profiler = get_profiler(self.profile)
+        if profiler is not None:
+            profiler.start()
+        try:
+            # Directories may be created or removed between CSVs, so the
+            # filesystem metadata cache is not shared
+            process = ProcessCSV(
+                csv_path,
+                self.script_mode,
+                csv_logfile_path,
+                csv_logger_obj,
+                self.transport,
+                self.jobs,
+                self.share_jobs,
+                PathCache(),
+                self.checksum_pool,
+                self.retry_policy,
+                self.staging,
+                self.cache,
+                self.get_answers(csv_path, csv_logger),
+                profiler,
+            )
+            with self._lock:
+                self.process = process
+            if self._stop.is_set():
+                process.stop()
+            process.process()
+            self.processed_csvs.append(csv_path)
+            self.logger.info("%s was processed and archived", csv_path)
+        except SystemExit:
+            if process is not None:
+                process.journal.close()
+            self.failed_csvs.append(csv_path)
+            self.logger.error(
+                "%s was not processed successfully, see %s",
+                csv_path,
+                csv_logfile_path,
+            )
+        except Exception as exception:
+            self.failed_csvs.append(csv_path)
+            self.logger.error(
+                "%s was raised when processing %s: %s",
+                type(exception).__name__,
+                csv_path,
+                exception,
+            )
+        finally:
+            with self._lock:
+                self.process = None
+            if process is not None:
+                export_prometheus(
+                    self.prometheus_textfile, [process.metrics], self.logger
+                )
+            if profiler is not None:
+                profiler.stop()
+                profiler.write(
+                    f"{csv_logfile_path.rsplit('.log', 1)[0]}_profile",
+                    csv_logger,
+                )
+            csv_logger_obj.shutdown_logs()
+
+    def get_answers(self, csv_path: str, logger: logging.Logger) -> dict:
+        """
+        Return the subdirectories that replace the runfolder placeholders of
+        a CSV, from its sidecar answers file if there is one, otherwise from
+        the runfolder rule
+            :param csv_path (str):  Path to CSV file
+            :param logger (obj):    Python logging object for the CSV
+            :return (dict):         Subdirectories keyed worksheets_dir and
+                                    runfolder_dir, empty if not answered
+        """
+        answers_path = (
+            f"{csv_path.rsplit('.csv', 1)[0]}"
+            f"{config.DAEMON['ANSWERS_SUFFIX']}"
+        )
+        if os.path.exists(answers_path):
+            try:
+                with open(answers_path, encoding="utf-8") as file:
+                    answers = json.load(file)
+                logger.info("Read the answers file %s", answers_path)
+                return answers
+            except (OSError, ValueError) as exception:
+                logger.error(
+                    "%s was raised when reading the answers file %s: %s",
+                    type(exception).__name__,
+                    answers_path,
+                    exception,
+                )
+                return {}
+        if self.runfolder_rule is not None:
+            match = self.runfolder_rule.search(csv_path.rsplit("/", 1)[1])
+            if match:
+                return {
+                    name: value
+                    for name, value in match.groupdict().items()
+                    if value
+                }
+            logger.info("The CSV name does not match the runfolder rule")
+        return {}
+
+    def _worker(self) -> None:
+        """
+        Process the CSVs put on the queue until the sentinel (None) is
+        received. CSVs still queued once the daemon is stopping are left for
+        the next run
+        """
+        while True:
+            csv_path = self._queue.get()
+            if csv_path is None or self._stop.is_set():
+                return
+            self.process_csv(csv_path)
+
+
 class GetTkinterEntry:
     """
     Class to collect the user input from a Tkinter entry as a variable
@@ -349,7 +1992,8 @@ class GetTkinterEntry:
             Open a message box on closing the Tkinter Entry
     """
 
-    def __init__(self, master: tk.Tk, label: str):
+    def __init__(self, master: "tkinter.Tk", label: str):
+        tk = startup.timed_import("tkinter")
         self.master = master
         self.label = label
         self.logger = logger
@@ -410,23 +2054,169 @@ def arg_parse() -> dict:
         default=False,
         required=False,
     )  # Optional arg
-    return vars(parser.parse_args())
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Maximum number of concurrent downloads",
+        default=config.JOBS,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--share-jobs",
+        type=int,
+        help="Maximum number of concurrent downloads to a single "
+        "destination share",
+        default=config.SHARE_JOBS,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Process every unarchived CSV in the CSV folder as a single "
+        "batch, instead of selecting one CSV",
+        default=False,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Dry run: probe every URL and check the free space on each "
+        "destination volume, write a report of the bytes and estimated time, "
+        "and exit without downloading",
+        default=False,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Watch the CSV folder and process each CSV as it lands, until "
+        "stopped with SIGINT or SIGTERM",
+        default=False,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--runfolder-rule",
+        help="In daemon mode, regular expression matched against the CSV "
+        "name whose worksheets_dir and runfolder_dir named groups answer the "
+        "runfolder placeholders of CSVs without an answers file",
+        default=None,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="Report the time taken by imports and initialisation before "
+        "the first user input",
+        default=False,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--profile",
+        nargs="*",
+        choices=["cpu", "memory"],
+        help="Time each stage of processing the CSV and write a breakdown to "
+        "the process logs. Add cpu to also capture a cProfile profile, and "
+        "memory to trace memory allocations with tracemalloc",
+        default=None,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--cache-git-tag",
+        action="store_true",
+        help="Write the git tag to file at deploy time and exit, so that git "
+        "is not run at start-up",
+        default=False,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--transport",
+        choices=sorted(TRANSPORTS),
+        help="Download transport backend. bits runs a powershell "
+        "Start-BitsTransfer command per file, http streams files in-process",
+        default=config.TRANSPORT,
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--attempts",
+        type=int,
+        help="Maximum number of attempts per download",
+        default=config.RETRY["ATTEMPTS"],
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--staging-dir",
+        help="Download files to this directory on local disk, then move them "
+        "to their destinations in the background",
+        default=config.STAGING["DIR"],
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep a cache of downloaded files in this directory on local "
+        "disk, and serve files found in it instead of downloading them again",
+        default=config.CACHE["DIR"],
+        required=False,
+    )  # Optional arg
+    parser.add_argument(
+        "--prometheus-textfile",
+        help="Write the transfer metrics totals to this Prometheus textfile "
+        "(for the node_exporter textfile collector)",
+        default=config.PROMETHEUS_TEXTFILE,
+        required=False,
+    )  # Optional arg
+    args = vars(parser.parse_args())
+    if args["plan"] and args["daemon"]:
+        parser.error("--plan cannot be used with --daemon")
+    return args
 
 
+@functools.lru_cache(maxsize=None)
 def git_tag() -> str:
     """
-    Obtain git tag from current commit
+    Obtain git tag from current commit. The tag is read from the file written
+    at deploy time with --cache-git-tag if it exists, otherwise from git. The
+    result is memoised for the lifetime of the process
+        :return (str):  Git tag
+    """
+    tag_filepath = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), config.GIT_TAG_FILE
+    )
+    if os.path.exists(tag_filepath):
+        with open(tag_filepath, encoding="utf-8") as file:
+            return file.read().strip()
+    return describe_git_tag()
+
+
+def describe_git_tag() -> str:
+    """
+    Obtain git tag from current commit using git describe
         :return stdout (str):   String containing stdout,
                                 with newline characters removed
     """
     filepath = os.path.dirname(os.path.realpath(__file__))
-    cmd = f"git -C {filepath} describe --tags"
+    proc = subprocess.run(
+        ["git", "-C", filepath, "describe", "--tags"],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        check=False,
+    )
+    return proc.stdout.rstrip().decode("utf-8")
+
 
-    proc = subprocess.Popen(
-        [cmd], stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True
+def cache_git_tag() -> str:
+    """
+    Write the git tag of the current commit to config.GIT_TAG_FILE, so that
+    git does not need to be run each time the script starts. Run at deploy
+    time, after checking out the release
+        :return tag_filepath (str): Path the git tag was written to
+    """
+    tag_filepath = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), config.GIT_TAG_FILE
     )
-    out, _ = proc.communicate()
-    return out.rstrip().decode("utf-8")
+    with open(tag_filepath, "w", encoding="utf-8") as file:
+        file.write(f"{describe_git_tag()}\n")
+    return tag_filepath
 
 
 def get_csv_path(script_mode: str) -> str:
@@ -434,6 +2224,7 @@ def get_csv_path(script_mode: str) -> str:
     Get CSV path from user input using filedialog
         :return csv_path(str): Path to CSV file
     """
+    filedialog = startup.timed_import("tkinter.filedialog")
     csv_path = filedialog.askopenfilename(
         initialdir=config.CSV_FOLDER[script_mode],
         title="Select file",
@@ -446,19 +2237,117 @@ def get_csv_path(script_mode: str) -> str:
         return csv_path
 
 
-def get_logger(logfile_path: str) -> Tuple[Logger, logging.Logger]:
+def get_logger(
+    logfile_path: str, name: str = "logger"
+) -> Tuple[Logger, logging.Logger]:
     """
-    Get logger object and logger
+    Get logger object and logger. Records are logged via a queue so that
+    download threads never block on writing to the logfile
+        :param logfile_path (str):  Logfile path
+        :param name (str):          Logger name, unique per logfile
         :return logger_obj (class): Logger() class object from logger submodule
         :return logger (class):     Logger object from logging module
     """
-    logger_obj = Logger(logfile_path)
+    logger_obj = Logger(logfile_path, name, queued=True)
     logger = logger_obj.logger
     return logger_obj, logger
 
 
+def get_staging(
+    directory: str, logger: logging.Logger, cache_dir: str = None
+) -> StagingArea:
+    """
+    Create the staging area for downloads, exiting if the staging directory
+    cannot be created. Downloads are cached from the staging directory, so
+    with a download cache but no staging directory, downloads are staged in
+    a subdirectory of the cache directory
+        :param directory (str): Staging directory, or None to not stage
+        :param logger (obj):    Python logging object
+        :param cache_dir (str): Download cache directory, or None
+        :return (StagingArea):  StagingArea object, or None
+    """
+    if not directory and cache_dir:
+        directory = os.path.join(cache_dir, "staging")
+    if not directory:
+        return None
+    try:
+        return StagingArea(directory, logger)
+    except OSError as exception:
+        logger.error(
+            "%s was raised when creating the staging directory %s: %s",
+            type(exception).__name__,
+            directory,
+            exception,
+        )
+        sys.exit(1)
+
+
+def get_cache(directory: str, logger: logging.Logger) -> DownloadCache:
+    """
+    Open the download cache, exiting if the cache directory cannot be
+    created
+        :param directory (str):     Cache directory, or None to not cache
+        :param logger (obj):        Python logging object
+        :return (DownloadCache):    DownloadCache object, or None
+    """
+    if not directory:
+        return None
+    try:
+        return DownloadCache(directory, logger)
+    except OSError as exception:
+        logger.error(
+            "%s was raised when opening the download cache %s: %s",
+            type(exception).__name__,
+            directory,
+            exception,
+        )
+        sys.exit(1)
+
+
+def get_profiler(options: list) -> "profiling.StageProfiler":
+    """
+    Create the stage profiler requested with --profile
+        :param options (list):      --profile options (cpu, memory), or None
+                                    if --profile was not given
+        :return (StageProfiler):    StageProfiler object, or None
+    """
+    if options is None:
+        return None
+    # Imported on first use, as cProfile, pstats and tracemalloc slow start-up
+    profiling = startup.timed_import("profiling")
+    return profiling.StageProfiler("cpu" in options, "memory" in options)
+
+
+def export_prometheus(
+    textfile_path: str, metrics: list, logger: logging.Logger
+) -> None:
+    """
+    Write the transfer metrics totals to a Prometheus textfile, if a path
+    was given. A failure to write the file is logged but does not change the
+    exit code
+        :param textfile_path (str): Textfile path, or None
+        :param metrics (list):      TransferMetrics objects
+        :param logger (obj):        Python logging object
+    """
+    if not textfile_path:
+        return
+    try:
+        write_prometheus(textfile_path, metrics)
+        logger.info("Prometheus metrics written to %s", textfile_path)
+    except Exception as exception:
+        logger.error(
+            "%s was raised when writing the Prometheus textfile %s: %s",
+            type(exception).__name__,
+            textfile_path,
+            exception,
+        )
+
+
 if __name__ == "__main__":
     args = arg_parse()
+    if args["cache_git_tag"]:
+        print(f"Git tag written to {cache_git_tag()}")
+        sys.exit(0)
     # Get script mode from cmd line arg
     if args["testing"]:
         SCRIPT_MODE = "TEST"
@@ -470,12 +2359,106 @@ if __name__ == "__main__":
         f"{config.DIRS['LOGS'] % config.CSV_FOLDER[SCRIPT_MODE]}"
         f"process_duty_csv_{config.TIMESTAMP}.log"
     )
+    phase_start = time.perf_counter()
     logger_obj, logger = get_logger(logfile_path)
-    logger.info(
-        "Running process_duty_csv %s in %s mode", git_tag(), SCRIPT_MODE
-    )
+    startup.record("logger initialisation", phase_start)
+    phase_start = time.perf_counter()
+    tag = git_tag()
+    startup.record("git_tag", phase_start)
+    logger.info("Running process_duty_csv %s in %s mode", tag, SCRIPT_MODE)
     logger.info("The logfile path is %s", logfile_path)
+    phase_start = time.perf_counter()
+    transport = get_transport(args["transport"])
+    startup.record("transport initialisation", phase_start)
+    retry_policy = RetryPolicy(args["attempts"])
+    if transport.name == "bits" and config.THROTTLE["PROFILES"]:
+        logger.info(
+            "The bits transport cannot hold downloads to the byte rates in "
+            "config.THROTTLE; downloads started while a profile is in force "
+            "run at BITS priority %s instead",
+            config.BITS["THROTTLED_PRIORITY"],
+        )
+
+    if args["batch"]:
+        # Rename log file to identify it as the batch log
+        new_logfile_path = f"{logfile_path.split('.log')[0]}batch.log"
+        logger_obj.shutdown_logs()
+        os.rename(logfile_path, new_logfile_path)
+        logfile_path = new_logfile_path
+        logger_obj, logger = get_logger(logfile_path)
+        logger.info("The logfile has been renamed to %s", logfile_path)
+        if args["startup_profile"]:
+            startup.report(logger)
+        staging = get_staging(args["staging_dir"], logger, args["cache_dir"])
+        cache = get_cache(args["cache_dir"], logger)
+        profiler = get_profiler(args["profile"])
+        batch = BatchScheduler(
+            SCRIPT_MODE,
+            transport,
+            args["jobs"],
+            args["share_jobs"],
+            logger,
+            retry_policy,
+            staging,
+            cache,
+            profiler,
+            args["plan"],
+        )
+        if profiler is not None:
+            profiler.start()
+        try:
+            exit_code = batch.run()
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                profiler.write(
+                    f"{logfile_path.rsplit('.log', 1)[0]}_profile", logger
+                )
+            transport.close()
+            if not args["plan"]:
+                export_prometheus(
+                    args["prometheus_textfile"],
+                    [process.metrics for process in batch.processes],
+                    logger,
+                )
+        sys.exit(exit_code)
 
+    if args["daemon"]:
+        # Rename log file to identify it as the daemon log
+        new_logfile_path = f"{logfile_path.split('.log')[0]}daemon.log"
+        logger_obj.shutdown_logs()
+        os.rename(logfile_path, new_logfile_path)
+        logfile_path = new_logfile_path
+        logger_obj, logger = get_logger(logfile_path)
+        logger.info("The logfile has been renamed to %s", logfile_path)
+        if args["startup_profile"]:
+            startup.report(logger)
+        staging = get_staging(args["staging_dir"], logger, args["cache_dir"])
+        cache = get_cache(args["cache_dir"], logger)
+        daemon = CSVDaemon(
+            SCRIPT_MODE,
+            transport,
+            args["jobs"],
+            args["share_jobs"],
+            logger,
+            retry_policy,
+            staging,
+            cache,
+            args["runfolder_rule"],
+            args["prometheus_textfile"],
+            args["profile"],
+        )
+        try:
+            exit_code = daemon.run()
+        finally:
+            transport.close()
+        sys.exit(exit_code)
+
+    if args["startup_profile"]:
+        # Load tkinter before reporting so the report covers everything up to
+        # the file dialog appearing
+        startup.timed_import("tkinter.filedialog")
+        startup.report(logger)
     csv_path = get_csv_path(SCRIPT_MODE)
     logger.info(
         "The script is being run using the csv file: %s",
@@ -493,4 +2476,42 @@ if __name__ == "__main__":
     logger_obj, logger = get_logger(logfile_path)
 
     logger.info("The logfile has been renamed to %s", logfile_path)
-    ProcessCSV()
+    staging = get_staging(args["staging_dir"], logger, args["cache_dir"])
+    cache = get_cache(args["cache_dir"], logger)
+    profiler = get_profiler(args["profile"])
+    if profiler is not None:
+        profiler.start()
+    csv_process = None
+    try:
+        csv_process = ProcessCSV(
+            csv_path,
+            SCRIPT_MODE,
+            logfile_path,
+            logger_obj,
+            transport,
+            args["jobs"],
+            args["share_jobs"],
+            retry_policy=retry_policy,
+            staging=staging,
+            cache=cache,
+            profiler=profiler,
+        )
+        if args["plan"]:
+            csv_process.plan()
+        else:
+            csv_process.process()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(
+                f"{logfile_path.rsplit('.log', 1)[0]}_profile", logger
+            )
+        transport.close()
+        if staging is not None:
+            staging.close()
+        if cache is not None:
+            cache.close()
+        if csv_process is not None and not args["plan"]:
+            export_prometheus(
+                args["prometheus_textfile"], [csv_process.metrics], logger
+            )
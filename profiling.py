@@ -0,0 +1,275 @@
+""" profiling.py
+
+Stage profiling for process_duty_csv, enabled with --profile. Each stage of
+ProcessCSV (the generator stages that read the CSV and build the download
+tasks, the path validation and directory creation on the share, and the
+transfers) is timed as a span. Spans nest, so the self time of a stage
+excludes the stages it calls. cProfile and tracemalloc can be enabled as
+well, writing a .prof file and the top allocation sites. When --profile is
+not given nothing is wrapped, so profiling costs nothing
+"""
+import time
+import cProfile
+import pstats
+import threading
+import functools
+import tracemalloc
+import logging
+
+
+class StageProfiler:
+    """
+    Timing spans for the stages of ProcessCSV, with optional cProfile and
+    tracemalloc capture. Safe to use from multiple threads: each thread has
+    its own stack of open spans. The CPU profile covers the thread that
+    called start(), and the other threads while they are inside a span
+
+    Methods
+        start()
+            Start cProfile and tracemalloc, if requested
+        stop()
+            Stop cProfile and tracemalloc
+        wrap()
+            Return a function whose calls are timed as a stage
+        wrap_iter()
+            Return an iterator whose steps are timed as a stage
+        write()
+            Write the per-stage breakdown table and the .prof file
+        breakdown()
+            Return the per-stage breakdown table
+        _enter()
+            Open a span on the current thread
+        _exit()
+            Close the current thread's innermost span and record it
+        _stack()
+            Return the current thread's stack of open spans
+    """
+
+    def __init__(self, cpu: bool = False, memory: bool = False):
+        """
+        Constructor for the StageProfiler class
+            :param cpu (bool):      Capture a cProfile profile
+            :param memory (bool):   Trace memory allocations with tracemalloc
+        """
+        self.cpu = cpu
+        self.memory = memory
+        # name: [calls, total seconds, self seconds, net bytes allocated]
+        self.stages = {}
+        self.started_at = None
+        self.wall_time = None
+        self.peak_memory = None
+        self.snapshot = None
+        self._profile = None
+        self._profile_thread = None
+        self._thread_profiles = []
+        self._profile_threads = cpu
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Start cProfile on the calling thread and tracemalloc, if requested
+        """
+        self.started_at = time.perf_counter()
+        self._profile_thread = threading.current_thread()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.cpu:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self) -> None:
+        """
+        Stop cProfile and tracemalloc, keeping a snapshot of the traced
+        memory
+        """
+        self.wall_time = time.perf_counter() - self.started_at
+        if self._profile is not None:
+            self._profile.disable()
+        if self.memory and tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)]
+            )
+            tracemalloc.stop()
+
+    def wrap(self, name: str, func):
+        """
+        Return a function whose calls are timed as a stage
+            :param name (str):      Stage name
+            :param func (callable): Function to wrap
+            :return (callable):     Wrapped function
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self._enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit()
+
+        return wrapper
+
+    def wrap_iter(self, name: str, iterator):
+        """
+        Return an iterator whose steps are timed as a stage. Used for the
+        generator stages of the CSV pipeline, where each step of a stage
+        also runs a step of the stages before it
+            :param name (str):          Stage name
+            :param iterator (Iterator): Iterator to wrap
+            :return (Iterator):         Wrapped iterator
+        """
+        iterator = iter(iterator)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            yield item
+
+    def write(self, path_prefix: str, logger: logging.Logger) -> None:
+        """
+        Log the per-stage breakdown table and write it to <prefix>.txt, and
+        write the cProfile stats to <prefix>.prof if captured. A failure to
+        write the files is logged but does not stop the script
+            :param path_prefix (str):   Path of the files without extension
+            :param logger (obj):        Python logging object
+        """
+        table = self.breakdown()
+        for line in table.splitlines():
+            logger.info("Profile: %s", line)
+        try:
+            with open(f"{path_prefix}.txt", "w", encoding="utf-8") as file:
+                file.write(f"{table}\n")
+            logger.info("Stage profile written to %s.txt", path_prefix)
+            profiles = [
+                profile
+                for profile in [self._profile] + self._thread_profiles
+                if profile is not None and profile.getstats()
+            ]
+            if profiles:
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(f"{path_prefix}.prof")
+                logger.info(
+                    "CPU profile written to %s.prof, view it with "
+                    "python -m pstats",
+                    path_prefix,
+                )
+        except Exception as exception:
+            logger.error(
+                "%s was raised when writing the profile to %s: %s",
+                type(exception).__name__,
+                path_prefix,
+                exception,
+            )
+
+    def breakdown(self) -> str:
+        """
+        Return the per-stage breakdown table, stages with the most self time
+        first. Total time includes the stages a stage calls, and sums the
+        time of stages that ran concurrently in several threads
+            :return (str):  Table
+        """
+        lines = [
+            f"{'stage':<28}{'calls':>8}{'total s':>12}{'self s':>12}"
+            f"{'mean ms':>10}" + (f"{'net KiB':>12}" if self.memory else "")
+        ]
+        with self._lock:
+            stages = sorted(
+                self.stages.items(), key=lambda item: item[1][2], reverse=True
+            )
+        for name, (calls, total, own, allocated) in stages:
+            lines.append(
+                f"{name:<28}{calls:>8}{total:>12.3f}{own:>12.3f}"
+                f"{total / calls * 1000:>10.2f}"
+                + (f"{allocated / 1024:>12.1f}" if self.memory else "")
+            )
+        if self.wall_time is not None:
+            lines.append(f"Wall time {self.wall_time:.3f}s")
+        if self.cpu and not self._profile_threads:
+            lines.append(
+                "The CPU profile only covers the thread reading the CSV, as "
+                "this Python does not allow a profiler per thread"
+            )
+        if self.snapshot is not None:
+            lines.append(
+                f"Peak traced memory {self.peak_memory / 1024:.1f} KiB"
+            )
+            lines.append("Top allocation sites:")
+            for stat in self.snapshot.statistics("lineno")[:10]:
+                lines.append(
+                    f"  {stat.traceback[0]}: {stat.size / 1024:.1f} KiB in "
+                    f"{stat.count} blocks"
+                )
+        return "\n".join(lines)
+
+    def _enter(self, name: str) -> None:
+        """
+        Open a span on the current thread. On threads other than the one
+        that started the profiler, the outermost span enables that thread's
+        CPU profile
+            :param name (str):  Stage name
+        """
+        stack = self._stack()
+        if (
+            not stack
+            and self._profile_threads
+            and (threading.current_thread() is not self._profile_thread)
+        ):
+            profile = getattr(self._local, "profile", None)
+            if profile is None:
+                profile = cProfile.Profile()
+                self._local.profile = profile
+                with self._lock:
+                    self._thread_profiles.append(profile)
+            try:
+                profile.enable()
+            except ValueError:
+                # Only one profiler may be active from Python 3.12
+                self._profile_threads = False
+                self._local.profile = None
+        memory = (
+            tracemalloc.get_traced_memory()[0]
+            if self.memory and tracemalloc.is_tracing()
+            else 0
+        )
+        stack.append([name, time.perf_counter(), 0.0, memory])
+
+    def _exit(self) -> None:
+        """
+        Close the current thread's innermost span and record its total and
+        self time, and the net memory allocated while it was open
+        """
+        stack = self._stack()
+        name, start, child_time, memory = stack.pop()
+        elapsed = time.perf_counter() - start
+        if self.memory and tracemalloc.is_tracing():
+            memory = tracemalloc.get_traced_memory()[0] - memory
+        else:
+            memory = 0
+        if stack:
+            stack[-1][2] += elapsed
+        elif getattr(self._local, "profile", None) is not None:
+            self._local.profile.disable()
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0, 0])
+            stage[0] += 1
+            stage[1] += elapsed
+            stage[2] += elapsed - child_time
+            stage[3] += memory
+
+    def _stack(self) -> list:
+        """
+        Return the current thread's stack of open spans
+            :return (list): [name, start time, child time, memory] lists
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
@@ -0,0 +1,232 @@
+""" retry.py
+
+Retry policy for downloads. Failed attempts are retried after an
+exponentially increasing delay with full jitter, so that retries from many
+workers are spread out rather than arriving at a struggling endpoint
+together. A circuit breaker per host pauses all work to a host after
+repeated consecutive failures (e.g. during a DNAnexus or proxy outage), then
+lets a single trial request through to test whether the host has recovered
+"""
+import time
+import random
+import threading
+import logging
+import urllib.parse
+import config
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. A host's circuit opens after a number of
+    consecutive failures, and work to the host waits until the reset timeout
+    has passed. A single trial request is then allowed (half-open): if it
+    succeeds the circuit closes, otherwise it opens again for twice as long,
+    up to the maximum reset timeout. A trial that is released without an
+    outcome, or that has not finished within the trial timeout, lets another
+    trial through
+
+    Methods
+        wait()
+            Wait until a request to the URL's host is allowed
+        release()
+            Release a trial request that ended without recording an outcome
+        success()
+            Record a successful request, closing the host's circuit
+        failure()
+            Record a failed request, opening the host's circuit once the
+            failure threshold is reached
+        _host()
+            Return the host a URL belongs to
+    """
+
+    def __init__(
+        self,
+        threshold: int = config.RETRY["BREAKER_THRESHOLD"],
+        reset_timeout: float = config.RETRY["BREAKER_RESET"],
+        max_reset_timeout: float = config.RETRY["BREAKER_MAX_RESET"],
+        trial_timeout: float = config.RETRY["BREAKER_TRIAL_TIMEOUT"],
+    ):
+        """
+        Constructor for the CircuitBreaker class
+            :param threshold (int):             Consecutive failures that open
+                                                a host's circuit, 0 to disable
+            :param reset_timeout (float):       Seconds a circuit stays open
+                                                before a trial request
+            :param max_reset_timeout (float):   Maximum seconds a circuit
+                                                stays open
+            :param trial_timeout (float):       Seconds after which a trial
+                                                request that has not finished
+                                                lets another trial through
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.trial_timeout = trial_timeout
+        self._condition = threading.Condition()
+        # host: [consecutive failures, reopen time, open timeout, trial
+        # deadline or None]
+        self._hosts = {}
+
+    def wait(self, url: str, logger: logging.Logger) -> bool:
+        """
+        Wait until a request to the URL's host is allowed. Returns straight
+        away while the circuit is closed. While it is open, waits until the
+        reset timeout has passed, then either becomes the trial request or
+        waits for the trial's outcome, up to the trial timeout. The caller
+        of a trial request must record its outcome with success() or
+        failure(), or release() it
+            :param url (str):       Download URL
+            :param logger (obj):    Python logging object
+            :return (bool):         True if the request is the trial request
+        """
+        if not self.threshold:
+            return False
+        host = self._host(url)
+        logged = False
+        with self._condition:
+            while True:
+                state = self._hosts.get(host)
+                if state is None or state[1] is None:
+                    return False
+                now = time.monotonic()
+                remaining = state[1] - now
+                if state[3] is not None and state[3] <= now:
+                    logger.info(
+                        "Trial request to %s has not finished within %ss",
+                        host,
+                        self.trial_timeout,
+                    )
+                    state[3] = None
+                if remaining <= 0 and state[3] is None:
+                    state[3] = now + self.trial_timeout
+                    logger.info(
+                        "Circuit for %s is half-open, sending a trial request",
+                        host,
+                    )
+                    return True
+                if not logged:
+                    logger.info(
+                        "Circuit for %s is open, waiting before downloading "
+                        "%s",
+                        host,
+                        url,
+                    )
+                    logged = True
+                self._condition.wait(
+                    remaining if remaining > 0 else state[3] - now
+                )
+
+    def release(self, url: str) -> None:
+        """
+        Release a trial request that ended without recording an outcome
+        (e.g. the server rejected the request), letting another trial
+        through. Does nothing if the trial's outcome was recorded
+            :param url (str):   Download URL
+        """
+        if not self.threshold:
+            return
+        host = self._host(url)
+        with self._condition:
+            state = self._hosts.get(host)
+            if state is not None and state[3] is not None:
+                state[3] = None
+                self._condition.notify_all()
+
+    def success(self, url: str, logger: logging.Logger) -> None:
+        """
+        Record a successful request, closing the host's circuit
+            :param url (str):       Download URL
+            :param logger (obj):    Python logging object
+        """
+        if not self.threshold:
+            return
+        host = self._host(url)
+        with self._condition:
+            state = self._hosts.pop(host, None)
+            if state and state[1] is not None:
+                logger.info("Circuit for %s is closed", host)
+                self._condition.notify_all()
+
+    def failure(self, url: str, logger: logging.Logger) -> None:
+        """
+        Record a failed request. The host's circuit opens once the failure
+        threshold is reached, and a failed trial reopens it for twice as long
+            :param url (str):       Download URL
+            :param logger (obj):    Python logging object
+        """
+        if not self.threshold:
+            return
+        host = self._host(url)
+        with self._condition:
+            state = self._hosts.setdefault(host, [0, None, None, None])
+            state[0] += 1
+            if state[3] is not None:
+                state[2] = min(state[2] * 2, self.max_reset_timeout)
+            elif state[1] is None and state[0] >= self.threshold:
+                state[2] = self.reset_timeout
+            else:
+                return
+            state[1] = time.monotonic() + state[2]
+            state[3] = None
+            logger.error(
+                "Circuit for %s is open after %s consecutive failures, "
+                "pausing downloads from it for %ss",
+                host,
+                state[0],
+                state[2],
+            )
+            self._condition.notify_all()
+
+    @staticmethod
+    def _host(url: str) -> str:
+        """
+        Return the host a URL belongs to
+            :param url (str):   Download URL
+            :return (str):      Host and port
+        """
+        return urllib.parse.urlsplit(url).netloc.lower()
+
+
+class RetryPolicy:
+    """
+    Number of attempts per download, exponential backoff with full jitter
+    between attempts, and the per-host circuit breaker. One policy is shared
+    by all CSVs of a run
+
+    Methods
+        delay()
+            Return the number of seconds to wait before the next attempt
+    """
+
+    def __init__(
+        self,
+        attempts: int = config.RETRY["ATTEMPTS"],
+        base_delay: float = config.RETRY["BASE_DELAY"],
+        max_delay: float = config.RETRY["MAX_DELAY"],
+        breaker: CircuitBreaker = None,
+    ):
+        """
+        Constructor for the RetryPolicy class
+            :param attempts (int):      Maximum attempts per download
+            :param base_delay (float):  Maximum delay before the first retry
+                                        in seconds, doubled for each retry
+            :param max_delay (float):   Maximum delay before any retry
+            :param breaker (obj):       CircuitBreaker, a new breaker is used
+                                        if not supplied
+        """
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._random = random.Random()
+
+    def delay(self, attempt: int) -> float:
+        """
+        Return the number of seconds to wait before the next attempt, drawn
+        uniformly between zero and the exponential backoff for the attempt
+        (full jitter)
+            :param attempt (int):   Number of the attempt that just failed
+            :return (float):        Delay in seconds
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return self._random.uniform(0, backoff)
@@ -0,0 +1,232 @@
+""" scheduler.py
+
+Size- and priority-aware ordering of downloads. Each task is assigned a
+priority class from config.PRIORITY_CLASSES by file extension or destination,
+and its size is taken from the CSV or learned with a concurrent HEAD probe.
+The executor starts the pending task with the lowest sort key, so small
+reports the scientists need straight away are not queued behind large BAMs,
+and large files start early so the run does not end on one long straggler
+"""
+import os
+import logging
+import threading
+import functools
+import concurrent.futures
+import config
+from transport import UrlProber
+
+
+class PriorityPolicy:
+    """
+    Assign priority classes to tasks and return the key used to order them
+
+    Methods
+        classify()
+            Set the task's priority class name and rank
+        sort_key()
+            Return the key that orders pending tasks, lowest first
+    """
+
+    def __init__(self, priority_classes: list = None):
+        """
+        Constructor for the PriorityPolicy class
+            :param priority_classes (list): Priority class definitions, in
+                                            priority order (defaults to
+                                            config.PRIORITY_CLASSES)
+        """
+        self.priority_classes = priority_classes or config.PRIORITY_CLASSES
+
+    def classify(self, task) -> None:
+        """
+        Set the task's priority class name and rank, from the first class
+        whose extensions match the file name or whose destinations match the
+        destination directory. A class with neither matches every task
+            :param task (DownloadTask): Download task
+        """
+        filename = os.path.basename(task.filepath).lower()
+        destination = task.destination.lower()
+        for rank, priority_class in enumerate(self.priority_classes):
+            extensions = priority_class["EXTENSIONS"]
+            destinations = priority_class["DESTINATIONS"]
+            if (
+                (not extensions and not destinations)
+                or any(filename.endswith(ext.lower()) for ext in extensions)
+                or any(dest.lower() in destination for dest in destinations)
+            ):
+                task.priority = priority_class["NAME"]
+                task.rank = rank
+                return
+        task.priority = "unclassified"
+        task.rank = len(self.priority_classes)
+
+    def sort_key(self, task) -> tuple:
+        """
+        Return the key that orders pending tasks, lowest first. Tasks are
+        ordered by priority class, then within a class smallest first (to
+        minimise time to the first useful file) or largest first (to
+        minimise the total time). Tasks of unknown size sort as size zero
+            :param task (DownloadTask): Download task
+            :return (tuple):            Sort key
+        """
+        size = task.size or 0
+        if task.rank < len(self.priority_classes) and (
+            self.priority_classes[task.rank]["ORDER"] == "largest"
+        ):
+            size = -size
+        return (task.rank, size)
+
+
+class SizeProber:
+    """
+    Learn the size of tasks not given one in the CSV by probing their URLs
+    with concurrent HEAD requests. Probes run in the background, and the
+    executor uses each size as soon as it is known. The validator of each
+    URL is recorded for the download cache, and a callback can be given to
+    reorder the task in the executor once its size is known. A URL can be
+    probed before its task exists (e.g. while the user is asked for the
+    runfolder inputs), and the result is applied to the task once it is
+    submitted
+
+    Methods
+        prefetch()
+            Queue a probe for a URL whose task does not exist yet
+        submit()
+            Queue a probe for a task of unknown size or validator
+        results()
+            Probe URLs and wait for the results
+        _probe()
+            Probe the task's URL and record its size and validator
+        _apply_prefetched()
+            Record the result of a prefetched probe on a task
+        _apply()
+            Record a probe result's size and validator on a task
+        close()
+            Cancel any probes not yet started
+    """
+
+    def __init__(self, jobs: int, logger: logging.Logger):
+        """
+        Constructor for the SizeProber class
+            :param jobs (int):      Maximum number of concurrent probes, 0 to
+                                    disable probing
+            :param logger (obj):    Python logging object
+        """
+        self.jobs = jobs
+        self.logger = logger
+        self.prober = UrlProber()
+        self._executor = None
+        # Futures of the URLs probed by prefetch(), keyed by URL
+        self._prefetched = {}
+        self._lock = threading.Lock()
+        if jobs:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs, thread_name_prefix="size_probe"
+            )
+
+    def prefetch(self, url: str) -> None:
+        """
+        Queue a probe for a URL whose task does not exist yet. The result is
+        kept for submit(), so the URL is not probed again
+            :param url (str):   URL to probe
+        """
+        if not self._executor:
+            return
+        with self._lock:
+            if url not in self._prefetched:
+                self._prefetched[url] = self._executor.submit(
+                    self.prober.probe, url
+                )
+
+    def submit(self, task, validate: bool = False, on_probed=None) -> None:
+        """
+        Queue a probe for a task of unknown size, or of unknown validator if
+        one is needed. If the URL was prefetched, its result is applied as
+        soon as it is available instead
+            :param task (DownloadTask):     Download task
+            :param validate (bool):         True if the task's validator is
+                                            needed
+            :param on_probed (callable):    Called with the task once the
+                                            result has been recorded, or None
+        """
+        if not self._executor or not (
+            task.size is None or (validate and task.validator is None)
+        ):
+            return
+        with self._lock:
+            future = self._prefetched.get(task.url)
+        if future is None:
+            self._executor.submit(self._probe, task, on_probed)
+        else:
+            future.add_done_callback(
+                functools.partial(self._apply_prefetched, task, on_probed)
+            )
+
+    def results(self, urls: list) -> dict:
+        """
+        Probe URLs, reusing any probe already queued for them, and wait for
+        the results. The results are kept for submit(), so the URLs are not
+        probed again when their tasks are scheduled
+            :param urls (list): URLs to probe
+            :return (dict):     ProbeResult objects keyed by URL, or None if
+                                probing is disabled
+        """
+        if not self._executor:
+            return None
+        for url in urls:
+            self.prefetch(url)
+        with self._lock:
+            futures = {url: self._prefetched[url] for url in urls}
+        return {url: future.result() for url, future in futures.items()}
+
+    def _probe(self, task, on_probed=None) -> None:
+        """
+        Probe the task's URL and record its size and validator
+            :param task (DownloadTask):     Download task
+            :param on_probed (callable):    Called with the task once the
+                                            result has been recorded, or None
+        """
+        self._apply(task, self.prober.probe(task.url), on_probed)
+
+    def _apply_prefetched(
+        self, task, on_probed, future: concurrent.futures.Future
+    ) -> None:
+        """
+        Record the result of a prefetched probe on a task, unless the probe
+        was cancelled
+            :param task (DownloadTask):     Download task
+            :param on_probed (callable):    Called with the task once the
+                                            result has been recorded, or None
+            :param future (Future):         Future of the prefetched probe
+        """
+        if not future.cancelled():
+            self._apply(task, future.result(), on_probed)
+
+    def _apply(self, task, result, on_probed=None) -> None:
+        """
+        Record a probe result's size and validator on a task, calling
+        on_probed with the task if its size was learned
+            :param task (DownloadTask):     Download task
+            :param result (ProbeResult):    Result of probing the task's URL
+            :param on_probed (callable):    Called with the task once the
+                                            result has been recorded, or None
+        """
+        if result.validator:
+            task.validator = result.validator
+        if result.size is not None:
+            task.size = result.size
+            if on_probed is not None:
+                on_probed(task)
+        else:
+            self.logger.debug(
+                "The size of %s could not be probed: %s",
+                task.url,
+                result.error,
+            )
+
+    def close(self) -> None:
+        """
+        Cancel any probes not yet started
+        """
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self.prober.pool.close()
@@ -0,0 +1,172 @@
+""" staging.py
+
+Optional local staging tier for downloads. Files are downloaded to a
+staging directory on local disk, so that the network stream is not
+throttled by the latency of writes to the destination share, then moved to
+their destination by a separate pool of flusher threads using large
+buffered writes. Each file is written beside its destination as a temporary
+file and renamed into place, so partial files never appear at the
+destination. Network receives for later files overlap with the writes of
+earlier files to the share
+"""
+import os
+import shutil
+import hashlib
+import logging
+import threading
+import concurrent.futures
+import config
+
+
+class StagingArea:
+    """
+    Staging directory on local disk and the pool of flusher threads that
+    move staged files to their destinations
+
+    Methods
+        stage()
+            Point a task's download at its path in the staging directory
+        submit()
+            Run a function in the flusher pool
+        flush()
+            Move a staged file to its destination
+        wait()
+            Wait for the functions submitted to the flusher pool to finish
+        close()
+            Wait for the flusher pool to finish, then shut it down
+        _discard()
+            Forget a finished future
+        _run()
+            Run a function, logging any exception it raises
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        logger: logging.Logger,
+        jobs: int = config.STAGING["FLUSH_JOBS"],
+        buffer_size: int = config.STAGING["BUFFER_SIZE"],
+    ):
+        """
+        Constructor for the StagingArea class
+            :param directory (str):     Staging directory on local disk
+            :param logger (obj):        Python logging object
+            :param jobs (int):          Maximum number of files flushed at
+                                        once
+            :param buffer_size (int):   Size in bytes of each write to the
+                                        destination
+        """
+        self.directory = os.path.abspath(directory)
+        self.logger = logger
+        self.buffer_size = buffer_size
+        os.makedirs(self.directory, exist_ok=True)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, jobs), thread_name_prefix="flusher"
+        )
+        self._futures = set()
+        self._lock = threading.Lock()
+        self.logger.info(
+            "Staging downloads in %s, flushing with %s threads",
+            self.directory,
+            max(1, jobs),
+        )
+
+    def stage(self, task) -> None:
+        """
+        Point a task's download at its path in the staging directory. Each
+        destination file has its own subdirectory, named from a hash of the
+        destination path, so files with the same name do not collide and a
+        rerun resumes the same partial download
+            :param task (DownloadTask): Download task
+        """
+        name = hashlib.sha1(task.filepath.encode("utf-8")).hexdigest()[:16]
+        task.set_download_dir(os.path.join(self.directory, name) + os.sep)
+        os.makedirs(task.download_dir, exist_ok=True)
+
+    def submit(self, func, *args) -> concurrent.futures.Future:
+        """
+        Run a function in the flusher pool
+            :param func (callable): Function to run
+            :param args:            Arguments to call it with
+            :return (Future):       Future of the function's result
+        """
+        future = self._executor.submit(self._run, func, *args)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def flush(self, task) -> str:
+        """
+        Move a staged file to its destination. A rename is used where the
+        staging directory is on the same volume, otherwise the file is
+        copied with large buffered writes to a temporary file beside the
+        destination, which is renamed into place before the staged file is
+        removed. Raises OSError if the file could not be moved
+            :param task (DownloadTask): Download task whose file is staged
+            :return (str):              Method used: rename or copy
+        """
+        try:
+            os.replace(task.download_path, task.filepath)
+            method = "rename"
+        except OSError:
+            tmp_path = f"{task.filepath}.part"
+            try:
+                with open(task.download_path, "rb") as src, open(
+                    tmp_path, "wb", buffering=0
+                ) as dst:
+                    shutil.copyfileobj(src, dst, self.buffer_size)
+                os.replace(tmp_path, task.filepath)
+            except BaseException:
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            os.remove(task.download_path)
+            method = "copy"
+        try:
+            os.rmdir(task.download_dir)
+        except OSError:
+            pass
+        return method
+
+    def wait(self) -> None:
+        """
+        Wait for the functions submitted to the flusher pool to finish,
+        leaving the pool running for later files
+        """
+        with self._lock:
+            futures = list(self._futures)
+        concurrent.futures.wait(futures)
+
+    def close(self) -> None:
+        """
+        Wait for the flusher pool to finish the files submitted, then shut it
+        down
+        """
+        self._executor.shutdown(wait=True)
+
+    def _discard(self, future: concurrent.futures.Future) -> None:
+        """
+        Forget a finished future
+            :param future (Future): Finished future
+        """
+        with self._lock:
+            self._futures.discard(future)
+
+    def _run(self, func, *args):
+        """
+        Run a function, logging any exception it raises, as the result of a
+        flusher pool future is not read
+            :param func (callable): Function to run
+            :param args:            Arguments to call it with
+            :return:                Result of the function, or None
+        """
+        try:
+            return func(*args)
+        except Exception as exception:
+            self.logger.error(
+                "%s was raised when flushing a staged download: %s",
+                type(exception).__name__,
+                exception,
+            )
+            return None
@@ -0,0 +1,51 @@
+""" startup.py
+
+Records the time taken by the start-up phases of process_duty_csv, reported
+when the script is run with --startup-profile. Heavy modules (such as
+tkinter) are imported on first use via timed_import(), so that they are only
+loaded on the code paths that need them
+"""
+import sys
+import time
+import importlib
+import logging
+
+START_TIME = time.perf_counter()
+TIMINGS = {}
+
+
+def record(phase: str, start: float) -> None:
+    """
+    Record the time elapsed since start against a start-up phase
+        :param phase (str):     Name of the phase
+        :param start (float):   time.perf_counter() value the phase started at
+    """
+    TIMINGS[phase] = TIMINGS.get(phase, 0) + time.perf_counter() - start
+
+
+def timed_import(name: str):
+    """
+    Import a module on first use, recording the time taken to import it
+        :param name (str):  Module name
+        :return (module):   Imported module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    record(f"import {name}", start)
+    return module
+
+
+def report(logger: logging.Logger) -> None:
+    """
+    Log the time taken by each start-up phase recorded so far, and the total
+    time since the script's modules started importing
+        :param logger (obj):    Python logging object
+    """
+    for phase, seconds in TIMINGS.items():
+        logger.info("Startup profile: %s took %.3fs", phase, seconds)
+    logger.info(
+        "Startup profile: %.3fs from start of imports to first user input",
+        time.perf_counter() - START_TIME,
+    )
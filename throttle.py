@@ -0,0 +1,177 @@
+""" throttle.py
+
+Bandwidth limit shared by all downloads, so that a large end of duty
+download does not saturate the Trust's shared network link during clinical
+hours. The limit is a token bucket refilled at a rate set by time of day
+profiles in config.THROTTLE. The profile in force is looked up again as
+downloads progress, so a new limit (or the lifting of the limit) applies to
+downloads already running as soon as its time window starts
+"""
+import time
+import threading
+import logging
+import config
+
+
+def parse_clock(value: str) -> int:
+    """
+    Convert a time of day to minutes since midnight
+        :param value (str): Time of day as HH:MM
+        :return (int):      Minutes since midnight
+    """
+    hours, minutes = value.split(":")
+    if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60):
+        raise ValueError(f"invalid time of day {value!r}, expected HH:MM")
+    return int(hours) * 60 + int(minutes)
+
+
+class BandwidthThrottle:
+    """
+    Token bucket shared by all download threads. Each chunk read from the
+    network takes tokens from the bucket, and the reading thread sleeps
+    until the bucket has refilled enough to cover it. Safe to use from
+    multiple threads
+
+    Methods
+        consume()
+            Take tokens for bytes received, sleeping while over the limit
+        current_profile()
+            Return the profile in force at a time
+        _update_rate()
+            Look up the profile in force, changing the rate if it differs
+        _refill()
+            Add the tokens accumulated since the last refill
+    """
+
+    # Seconds between lookups of the profile in force
+    CHECK_INTERVAL = 1
+
+    def __init__(
+        self,
+        profiles: list = config.THROTTLE["PROFILES"],
+        burst: float = config.THROTTLE["BURST"],
+    ):
+        """
+        Constructor for the BandwidthThrottle class
+            :param profiles (list): Dicts with START and END times of day
+                                    (HH:MM, local time), optional DAYS
+                                    (0 = Monday) and BYTES_PER_SEC
+            :param burst (float):   Seconds of transfer at the limit that may
+                                    be received at once
+        """
+        self.profiles = [
+            {
+                "start": parse_clock(profile["START"]),
+                "end": parse_clock(profile["END"]),
+                "days": set(profile.get("DAYS", range(7))),
+                "rate": profile["BYTES_PER_SEC"],
+                "name": f"{profile['START']}-{profile['END']}",
+            }
+            for profile in profiles
+        ]
+        self.burst = burst
+        self.rate = None
+        self._tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes: int, logger: logging.Logger) -> None:
+        """
+        Take tokens for bytes received from the network, sleeping until the
+        bucket covers them while a limit is in force. The bucket may go into
+        debt by one chunk, so chunks larger than the burst are not stuck.
+        The sleep is cut short if the limit is lifted
+            :param nbytes (int):    Bytes received
+            :param logger (obj):    Python logging object
+        """
+        if not self.profiles:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._update_rate(now, logger)
+            if self.rate is None:
+                return
+            self._refill(now)
+            self._tokens -= nbytes
+            deadline = now - self._tokens / self.rate
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, self.CHECK_INTERVAL))
+            with self._lock:
+                self._update_rate(time.monotonic(), logger)
+                if self.rate is None:
+                    return
+
+    def current_profile(self, when: time.struct_time = None) -> dict:
+        """
+        Return the first profile in force at a time. A profile whose end is
+        before its start runs past midnight, into the day after each of its
+        days
+            :param when (struct_time):  Local time, now if not given
+            :return (dict):             Profile, or None if no limit applies
+        """
+        when = when or time.localtime()
+        minute = when.tm_hour * 60 + when.tm_min
+        for profile in self.profiles:
+            if profile["start"] <= profile["end"]:
+                active = (
+                    profile["start"] <= minute < profile["end"]
+                    and when.tm_wday in profile["days"]
+                )
+            else:
+                active = (
+                    minute >= profile["start"]
+                    and when.tm_wday in profile["days"]
+                ) or (
+                    minute < profile["end"]
+                    and (when.tm_wday - 1) % 7 in profile["days"]
+                )
+            if active:
+                return profile
+        return None
+
+    def _update_rate(self, now: float, logger: logging.Logger) -> None:
+        """
+        Look up the profile in force, at most once per check interval, and
+        change the rate if it differs. Called with the lock held
+            :param now (float):     time.monotonic() value
+            :param logger (obj):    Python logging object
+        """
+        if now < self._next_check:
+            return
+        self._next_check = now + self.CHECK_INTERVAL
+        profile = self.current_profile()
+        rate = profile["rate"] if profile else None
+        if rate == self.rate:
+            return
+        if rate is None:
+            logger.info("Bandwidth limit lifted, downloads are unlimited")
+        else:
+            logger.info(
+                "Bandwidth limited to %s bytes/s by the %s profile",
+                rate,
+                profile["name"],
+            )
+        if self.rate is not None:
+            # Tokens accumulated so far are at the old rate
+            self._refill(now)
+        elif rate is not None:
+            # Start with a full bucket
+            self._tokens = rate * self.burst
+            self._last_refill = now
+        self.rate = rate
+
+    def _refill(self, now: float) -> None:
+        """
+        Add the tokens accumulated since the last refill, up to the burst.
+        Called with the lock held
+            :param now (float): time.monotonic() value
+        """
+        self._tokens = min(
+            self.rate * self.burst,
+            self._tokens + (now - self._last_refill) * self.rate,
+        )
+        self._last_refill = now
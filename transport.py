@@ -0,0 +1,1146 @@
+""" transport.py
+
+Transport backends used by process_duty_csv to download a file from its
+DNAnexus URL to the destination directory defined in the CSV
+
+    BitsTransport   Runs the powershell Start-BitsTransfer command in a pool of
+                    long-lived shell processes, at background priority while
+                    a bandwidth limit is in force
+    HttpTransport   Streams the file in-process over pooled keep-alive
+                    HTTP(S) connections, resuming partial downloads. Large
+                    files are downloaded as byte ranges in parallel, within
+                    the bandwidth limit of the time of day
+"""
+import os
+import re
+import json
+import posixpath
+import threading
+import logging
+import hashlib
+import concurrent.futures
+import http.client
+import urllib.parse
+import urllib.request
+import config
+from checksum import hash_file
+from command_runner import CommandRunnerPool, CommandRunnerError
+from throttle import BandwidthThrottle
+
+
+# HTTP status in a BITS error, e.g. "HTTP status 404: The requested URL does
+# not exist on the server."
+BITS_STATUS_REGEX = re.compile(r"HTTP status (\d{3})")
+
+
+class TransferError(Exception):
+    """
+    Raised by a transport when a download does not complete
+
+    Attributes
+        status (int):   HTTP status returned by the server, if the download
+                        failed because of the response status
+    """
+
+    def __init__(self, message: str, status: int = None):
+        """
+        Constructor for the TransferError class
+            :param message (str):   Error message
+            :param status (int):    HTTP status returned by the server
+        """
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def client_error(self) -> bool:
+        """
+        True if the server rejected the request itself (HTTP 4xx), which
+        says nothing about the health of the host
+        """
+        return self.status is not None and 400 <= self.status < 500
+
+
+class RangeNotSupported(TransferError):
+    """
+    Raised when a server ignores the Range request for a segment of a file
+    """
+
+
+class BitsTransport:
+    """
+    Download files by running the powershell Start-BitsTransfer command in a
+    pool of long-lived shell processes, so that a new shell and PowerShell
+    are not started for every file. On Windows the workers are PowerShell
+    processes that run the Start-BitsTransfer cmdlet directly. Elsewhere the
+    workers are bash processes that run the full powershell command, so that
+    a stand-in powershell script can be used for testing. BITS cannot be
+    held to a byte rate per job, so while a time of day bandwidth profile is
+    in force jobs are started at a background priority instead of the
+    default foreground priority. Background jobs only use idle network
+    bandwidth and are subject to the BITS bandwidth group policy, which
+    foreground jobs bypass
+
+    Methods
+        command()
+            Return the powershell download command for a file
+        script()
+            Return the Start-BitsTransfer cmdlet for a file
+        priority()
+            Return the BITS priority for a job started now
+        fetch()
+            Run the task's download command in a worker shell, forwarding its
+            output to the logger
+        close()
+            Close the worker shells
+    """
+
+    name = "bits"
+
+    def __init__(
+        self,
+        max_workers: int = config.BITS["MAX_WORKERS"],
+        timeout: float = config.BITS["TIMEOUT"],
+        throttle: BandwidthThrottle = None,
+    ):
+        """
+        Constructor for the BitsTransport class
+            :param max_workers (int):   Maximum number of worker shells
+            :param timeout (float):     Seconds to wait for a download command
+                                        to finish before its worker is killed
+            :param throttle (obj):      BandwidthThrottle whose profiles set
+                                        when jobs run at background priority,
+                                        the configured profiles are used if
+                                        not supplied
+        """
+        self.runner = CommandRunnerPool(max_workers, timeout)
+        self.throttle = throttle or BandwidthThrottle()
+
+    @staticmethod
+    def command(url: str, destination: str, priority: str = None) -> str:
+        """
+        Return the powershell download command for a file
+            :param url (str):           DNAnexus download URL
+            :param destination (str):   Directory to download the file to
+            :param priority (str):      BITS priority, or None for the
+                                        default (Foreground)
+            :return (str):              Powershell download command
+        """
+        return f"powershell {BitsTransport.script(url, destination, priority)}"
+
+    @staticmethod
+    def script(url: str, destination: str, priority: str = None) -> str:
+        """
+        Return the Start-BitsTransfer cmdlet for a file
+            :param url (str):           DNAnexus download URL
+            :param destination (str):   Directory to download the file to
+            :param priority (str):      BITS priority, or None for the
+                                        default (Foreground)
+            :return (str):              Start-BitsTransfer cmdlet
+        """
+        return (
+            f"Start-BitsTransfer -Source '{url}' "
+            f"-Destination '{destination}'"
+            + (f" -Priority {priority}" if priority else "")
+        )
+
+    def priority(self, logger: logging.Logger) -> str:
+        """
+        Return the BITS priority for a job started now: the background
+        priority set by config.BITS while a bandwidth profile is in force,
+        otherwise the default foreground priority
+            :param logger (obj):    Python logging object
+            :return (str):          BITS priority, or None for the default
+        """
+        profile = self.throttle.current_profile()
+        if profile is None:
+            return None
+        logger.info(
+            "The %s bandwidth profile is in force, downloading at BITS "
+            "priority %s",
+            profile["name"],
+            config.BITS["THROTTLED_PRIORITY"],
+        )
+        return config.BITS["THROTTLED_PRIORITY"]
+
+    def fetch(self, task, logger: logging.Logger) -> None:
+        """
+        Run the task's download command in a worker shell, forwarding each
+        line of its output to the logger as it is written. A command that
+        times out, or whose worker crashes, raises a TransferError and the
+        worker is replaced. A failed command raises a TransferError with the
+        HTTP status BITS reports in its error (e.g. "HTTP status 404"), if
+        any, so that rejected links are not counted as host failures. BITS
+        writes the file itself, so no checksum is returned
+            :param task (DownloadTask): Download task
+            :param logger (obj):        Python logging object
+            :return None:
+        """
+        logger.info("Running the following command: %s", task.command)
+        if task.staged():
+            logger.info(
+                "Downloading to the staging directory %s", task.download_dir
+            )
+        priority = self.priority(logger)
+        if self.runner.shell.name == "powershell":
+            command = self.script(task.url, task.download_dir, priority)
+        else:
+            command = self.command(task.url, task.download_dir, priority)
+        statuses = []
+
+        def forward(line: str) -> None:
+            if line.strip():
+                logger.info(line.rstrip())
+                match = BITS_STATUS_REGEX.search(line)
+                if match:
+                    statuses.append(int(match.group(1)))
+
+        try:
+            returncode = self.runner.run(command, forward)
+        except CommandRunnerError as exception:
+            raise TransferError(str(exception)) from exception
+        if returncode != 0:
+            raise TransferError(
+                f"command exited with returncode {returncode}",
+                statuses[-1] if statuses else None,
+            )
+
+    def close(self) -> None:
+        """
+        Close the worker shells
+        """
+        self.runner.close()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of idle keep-alive HTTP(S) connections, keyed by scheme,
+    host and port. Requests are sent via a proxy if one is defined in the
+    environment (HTTP_PROXY / HTTPS_PROXY)
+
+    Methods
+        acquire()
+            Return an idle connection to the URL's host, or a new one
+        release()
+            Return a connection to the pool for reuse
+        close()
+            Close all idle connections
+        request_target()
+            Return the request target for the URL, which is the absolute URL
+            when sending plain HTTP via a proxy
+        request()
+            Send a request, following redirects, and return the connection
+            and response
+        finish()
+            Return the connection to the pool, or close it
+    """
+
+    def __init__(self, max_idle: int, timeout: float):
+        """
+        Constructor for the ConnectionPool class
+            :param max_idle (int):  Maximum idle connections kept per host
+            :param timeout (float): Socket timeout in seconds
+        """
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.proxies = urllib.request.getproxies()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _proxy(self, parts: urllib.parse.SplitResult) -> str:
+        """
+        Return the proxy URL to use for the request, if any
+            :param parts (SplitResult): Split request URL
+            :return (str):              Proxy URL, or None
+        """
+        proxy = self.proxies.get(parts.scheme)
+        if proxy and not urllib.request.proxy_bypass(parts.hostname):
+            return proxy
+        return None
+
+    def _key(self, parts: urllib.parse.SplitResult) -> tuple:
+        """
+        Return the pool key for the request URL
+            :param parts (SplitResult): Split request URL
+            :return (tuple):            Scheme, host and port
+        """
+        return (parts.scheme, parts.hostname, parts.port)
+
+    def acquire(self, url: str) -> http.client.HTTPConnection:
+        """
+        Return an idle connection to the URL's host, or a new one
+            :param url (str):   Request URL
+            :return (obj):      HTTPConnection or HTTPSConnection
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = self._key(parts)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        proxy = self._proxy(parts)
+        if parts.scheme == "https":
+            if proxy:
+                proxy_parts = urllib.parse.urlsplit(proxy)
+                conn = http.client.HTTPSConnection(
+                    proxy_parts.hostname,
+                    proxy_parts.port,
+                    timeout=self.timeout,
+                )
+                conn.set_tunnel(parts.hostname, parts.port)
+            else:
+                conn = http.client.HTTPSConnection(
+                    parts.hostname, parts.port, timeout=self.timeout
+                )
+        elif parts.scheme == "http":
+            if proxy:
+                proxy_parts = urllib.parse.urlsplit(proxy)
+                conn = http.client.HTTPConnection(
+                    proxy_parts.hostname,
+                    proxy_parts.port,
+                    timeout=self.timeout,
+                )
+            else:
+                conn = http.client.HTTPConnection(
+                    parts.hostname, parts.port, timeout=self.timeout
+                )
+        else:
+            raise TransferError(f"Unsupported URL scheme: {parts.scheme}")
+        return conn
+
+    def release(self, url: str, conn: http.client.HTTPConnection) -> None:
+        """
+        Return a connection to the pool for reuse. The response must have
+        been read in full
+            :param url (str):   Request URL the connection was acquired for
+            :param conn (obj):  HTTPConnection or HTTPSConnection
+        """
+        key = self._key(urllib.parse.urlsplit(url))
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        """
+        Close all idle connections
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+    def request_target(self, url: str) -> str:
+        """
+        Return the request target for the URL, which is the absolute URL
+        when sending plain HTTP via a proxy
+            :param url (str):   Request URL
+            :return (str):      Request target
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == "http" and self._proxy(parts):
+            return url
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+        return target
+
+    def request(self, method: str, url: str, headers: dict = None) -> tuple:
+        """
+        Send a request, following redirects, and return the connection and
+        response. The caller must read the response and pass the connection
+        to finish(), or close it
+            :param method (str):    HTTP method
+            :param url (str):       Request URL
+            :param headers (dict):  Additional request headers
+            :return (tuple):        Connection, response and the final URL
+        """
+        for _ in range(config.HTTP["MAX_REDIRECTS"] + 1):
+            conn = self.acquire(url)
+            try:
+                conn.request(
+                    method, self.request_target(url), headers=headers or {}
+                )
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                # Pooled connection may have been closed by the server
+                conn.close()
+                conn = self.acquire(url)
+                conn.request(
+                    method, self.request_target(url), headers=headers or {}
+                )
+                response = conn.getresponse()
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader("Location")
+                response.read()
+                self.finish(url, conn, response)
+                if not location:
+                    raise TransferError(
+                        f"HTTP {response.status} redirect without a Location"
+                    )
+                url = urllib.parse.urljoin(url, location)
+                continue
+            return conn, response, url
+        raise TransferError("too many redirects")
+
+    def finish(
+        self,
+        url: str,
+        conn: http.client.HTTPConnection,
+        response: http.client.HTTPResponse,
+    ) -> None:
+        """
+        Return the connection to the pool, or close it if the server will
+        close it. The response must have been read in full
+            :param url (str):       Request URL
+            :param conn (obj):      HTTPConnection or HTTPSConnection
+            :param response (obj):  HTTP response
+        """
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(url, conn)
+
+
+class HttpTransport:
+    """
+    Download files in-process, streaming the response body to disk in fixed
+    size chunks over pooled keep-alive connections. Each download is written
+    to a .part file alongside a .part.json sidecar recording the bytes
+    written and the server's validators (ETag, Last-Modified and size). A
+    retry or rerun resumes from that offset using an HTTP Range request,
+    falling back to a full download if the server will not resume
+
+    Files of at least the segment threshold are split into byte ranges that
+    are fetched concurrently into a preallocated .part file with positional
+    writes, the sidecar recording the progress of each range. Servers that
+    do not support Range requests are downloaded as a single stream
+
+    Every chunk received is counted against the bandwidth throttle shared
+    by all downloads, which applies the limit of the time of day profile in
+    force
+
+    Methods
+        fetch()
+            Download the task's URL to its destination directory, resuming
+            any partial download
+        _fetch_segmented()
+            Download a large file as byte ranges in parallel
+        _segment_state()
+            Load the sidecar of a partial segmented download
+        _split()
+            Split a file into byte ranges
+        _fetch_segment()
+            Download one byte range of a file
+        _write_at()
+            Write bytes to a file at an offset
+        _resume_state()
+            Load the sidecar of a partial download, if it can be resumed
+        _resume_headers()
+            Return the Range and If-Range headers to resume a download
+        _resumed()
+            Check a 206 response continues the partial download
+        _new_state()
+            Return the sidecar state for a download starting from zero
+        _save_state()
+            Atomically write the sidecar of a partial download
+        _stream()
+            Write the response body to the partial file in fixed size chunks,
+            periodically recording the offset in the sidecar
+        close()
+            Close all pooled connections
+    """
+
+    name = "http"
+    _write_lock = threading.Lock()
+
+    def __init__(
+        self,
+        chunk_size: int = config.HTTP["CHUNK_SIZE"],
+        timeout: float = config.HTTP["TIMEOUT"],
+        max_idle: int = config.HTTP["MAX_IDLE"],
+        segments: int = config.HTTP["SEGMENTS"],
+        segment_threshold: int = config.HTTP["SEGMENT_THRESHOLD"],
+        throttle: BandwidthThrottle = None,
+    ):
+        """
+        Constructor for the HttpTransport class
+            :param chunk_size (int):        Bytes read from the socket at a
+                                            time
+            :param timeout (float):         Socket timeout in seconds
+            :param max_idle (int):          Maximum idle connections kept per
+                                            host
+            :param segments (int):          Byte ranges a large file is split
+                                            into, 1 to disable
+            :param segment_threshold (int): Minimum size in bytes of a file
+                                            to split
+            :param throttle (obj):          BandwidthThrottle shared by all
+                                            downloads, the configured
+                                            profiles are used if not supplied
+        """
+        self.chunk_size = chunk_size
+        self.pool = ConnectionPool(max_idle, timeout)
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.throttle = throttle or BandwidthThrottle()
+
+    def fetch(self, task, logger: logging.Logger) -> str:
+        """
+        Download the task's URL to its download directory, resuming any
+        partial download. The .part file is renamed once the download
+        completes, and the sidecar removed. The file's MD5 checksum is
+        computed as it is written, so it does not need to be read again. The
+        bytes of a resumed partial file are hashed before the download
+        continues. Large files are downloaded as byte ranges in parallel,
+        in which case the checksum is not computed
+            :param task (DownloadTask): Download task
+            :param logger (obj):        Python logging object
+            :return (str):              MD5 hex digest of the file, or None
+                                        for a segmented download
+        """
+        filepath = task.download_path
+        digest = hashlib.md5()
+        part_path = f"{filepath}.part"
+        state_path = f"{part_path}.json"
+        try:
+            if self.segments > 1 and self._fetch_segmented(
+                task, part_path, state_path, logger
+            ):
+                os.replace(part_path, filepath)
+                os.remove(state_path)
+                logger.info(
+                    "Downloaded %s bytes to %s in %s segments",
+                    os.path.getsize(filepath),
+                    filepath,
+                    self.segments,
+                )
+                return None
+            state = self._resume_state(part_path, state_path)
+            if state:
+                logger.info(
+                    "Resuming download of %s to %s from byte %s",
+                    task.url,
+                    filepath,
+                    state["offset"],
+                )
+                conn, response, url = self.pool.request(
+                    "GET", task.url, self._resume_headers(state)
+                )
+            else:
+                logger.info("Downloading %s to %s", task.url, filepath)
+                conn, response, url = self.pool.request("GET", task.url)
+            try:
+                if state and response.status == 416:
+                    # Range starts at the end of the file, nothing to fetch
+                    if state["offset"] != state["size"]:
+                        raise TransferError(
+                            "server rejected the Range request (HTTP 416)"
+                        )
+                    response.read()
+                    hash_file(part_path, digest, state["offset"])
+                elif state and response.status == 206:
+                    if not self._resumed(response, state):
+                        # Discard the partial so the retry starts from zero
+                        os.remove(state_path)
+                        raise TransferError(
+                            "server returned an unexpected Content-Range: "
+                            f"{response.getheader('Content-Range')}"
+                        )
+                    hash_file(part_path, digest, state["offset"])
+                    self._stream(
+                        response, part_path, state, state_path, digest, logger
+                    )
+                elif response.status == 200:
+                    if state:
+                        logger.info(
+                            "Server did not resume the download of %s, "
+                            "restarting from zero",
+                            task.url,
+                        )
+                    state = self._new_state(task.url, response)
+                    self._save_state(state_path, state)
+                    self._stream(
+                        response, part_path, state, state_path, digest, logger
+                    )
+                else:
+                    raise TransferError(
+                        f"server returned HTTP {response.status} "
+                        f"{response.reason}",
+                        response.status,
+                    )
+            except BaseException:
+                conn.close()
+                raise
+            self.pool.finish(url, conn, response)
+            if state["size"] is not None and state["offset"] != state["size"]:
+                raise TransferError(
+                    f"received {state['offset']} of {state['size']} bytes"
+                )
+            os.replace(part_path, filepath)
+            os.remove(state_path)
+        except (OSError, ValueError, http.client.HTTPException) as exception:
+            raise TransferError(
+                f"{type(exception).__name__}: {exception}"
+            ) from exception
+        logger.info("Downloaded %s bytes to %s", state["offset"], filepath)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _resume_state(part_path: str, state_path: str) -> dict:
+        """
+        Load the sidecar of a partial download, if it can be resumed. Bytes
+        in the partial file beyond the recorded offset may not have been
+        flushed to disk, so the resume point is the smaller of the two
+            :param part_path (str):     Partial file path
+            :param state_path (str):    Sidecar path
+            :return (dict):             Sidecar state, or None
+        """
+        if not (os.path.exists(state_path) and os.path.exists(part_path)):
+            return None
+        try:
+            with open(state_path, encoding="utf-8") as file:
+                state = json.load(file)
+        except ValueError:
+            return None
+        if "segments" in state:
+            return None
+        state["offset"] = min(state["offset"], os.path.getsize(part_path))
+        if not state["offset"]:
+            return None
+        if not (state["etag"] or state["last_modified"] or state["size"]):
+            # No way to confirm the server is sending the same file
+            return None
+        return state
+
+    @staticmethod
+    def _resume_headers(state: dict) -> dict:
+        """
+        Return the Range and If-Range headers to resume a download. If-Range
+        makes the server send the full file if it has changed
+            :param state (dict):    Sidecar state
+            :return (dict):         Request headers
+        """
+        headers = {"Range": f"bytes={state['offset']}-"}
+        validator = state["etag"] or state["last_modified"]
+        if validator and not validator.startswith("W/"):
+            headers["If-Range"] = validator
+        return headers
+
+    @staticmethod
+    def _resumed(response: http.client.HTTPResponse, state: dict) -> bool:
+        """
+        Check a 206 response continues the partial download from its offset
+        and is for a file of the recorded size
+            :param response (obj):  HTTP response
+            :param state (dict):    Sidecar state
+            :return (bool):         True if the response can be appended
+        """
+        match = re.fullmatch(
+            r"bytes (\d+)-\d+/(\d+|\*)",
+            (response.getheader("Content-Range") or "").strip(),
+        )
+        if not match or int(match.group(1)) != state["offset"]:
+            return False
+        if match.group(2) != "*" and state["size"] is not None:
+            return int(match.group(2)) == state["size"]
+        return True
+
+    @staticmethod
+    def _new_state(url: str, response: http.client.HTTPResponse) -> dict:
+        """
+        Return the sidecar state for a download starting from zero
+            :param url (str):       Download URL
+            :param response (obj):  HTTP 200 response
+            :return (dict):         Sidecar state
+        """
+        size = response.getheader("Content-Length")
+        return {
+            "url": url,
+            "offset": 0,
+            "size": int(size) if size is not None else None,
+            "etag": response.getheader("ETag"),
+            "last_modified": response.getheader("Last-Modified"),
+        }
+
+    @staticmethod
+    def _save_state(state_path: str, state: dict) -> None:
+        """
+        Atomically write the sidecar of a partial download
+            :param state_path (str):    Sidecar path
+            :param state (dict):        Sidecar state
+        """
+        tmp_path = f"{state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, state_path)
+
+    def _stream(
+        self,
+        response: http.client.HTTPResponse,
+        part_path: str,
+        state: dict,
+        state_path: str,
+        digest,
+        logger: logging.Logger,
+    ) -> None:
+        """
+        Write the response body to the partial file from the state's offset
+        in fixed size chunks, updating the file's hash with each chunk and
+        counting it against the bandwidth throttle. The
+        offset is recorded in the sidecar after the file is flushed, every
+        config.HTTP["STATE_INTERVAL"] bytes and when the response ends or
+        fails
+            :param response (obj):      HTTP response
+            :param part_path (str):     Partial file path
+            :param state (dict):        Sidecar state, offset is updated
+            :param state_path (str):    Sidecar path
+            :param digest (obj):        hashlib object updated with the bytes
+                                        written
+            :param logger (obj):        Python logging object
+        """
+        mode = "r+b" if state["offset"] else "wb"
+        with open(part_path, mode) as file:
+            file.seek(state["offset"])
+            file.truncate()
+            unsaved = 0
+            try:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    self.throttle.consume(len(chunk), logger)
+                    file.write(chunk)
+                    digest.update(chunk)
+                    state["offset"] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= config.HTTP["STATE_INTERVAL"]:
+                        file.flush()
+                        self._save_state(state_path, state)
+                        unsaved = 0
+            finally:
+                file.flush()
+                self._save_state(state_path, state)
+
+    def _fetch_segmented(
+        self, task, part_path: str, state_path: str, logger: logging.Logger
+    ) -> bool:
+        """
+        Download a large file as byte ranges fetched concurrently into a
+        preallocated partial file, resuming any partial segmented download.
+        Returns False without downloading if the file is below the segment
+        threshold, its size is unknown, a single stream download is partly
+        complete, or the server does not support Range requests. Raises
+        TransferError if a range fails or the file is incomplete
+            :param task (DownloadTask): Download task
+            :param part_path (str):     Partial file path
+            :param state_path (str):    Sidecar path
+            :param logger (obj):        Python logging object
+            :return (bool):             True if the file was downloaded
+        """
+        if task.size is not None and task.size < self.segment_threshold:
+            return False
+        state = self._segment_state(part_path, state_path)
+        flags = os.O_RDWR | getattr(os, "O_BINARY", 0)
+        if state is None:
+            if self._resume_state(part_path, state_path):
+                return False
+            result = UrlProber(self.pool).probe(task.url)
+            if not (
+                result.reachable
+                and result.accept_ranges
+                and result.size is not None
+                and result.size >= self.segment_threshold
+            ):
+                return False
+            state = {
+                "url": task.url,
+                "size": result.size,
+                "etag": result.etag,
+                "last_modified": result.last_modified,
+                "segments": self._split(result.size),
+            }
+            fd = os.open(part_path, flags | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                try:
+                    os.posix_fallocate(fd, 0, result.size)
+                except (AttributeError, OSError):
+                    # Not available on Windows or on all filesystems
+                    os.ftruncate(fd, result.size)
+                self._save_state(state_path, state)
+            except BaseException:
+                os.close(fd)
+                raise
+            logger.info(
+                "Downloading %s to %s in %s segments",
+                task.url,
+                part_path,
+                len(state["segments"]),
+            )
+        else:
+            fd = os.open(part_path, flags)
+            logger.info(
+                "Resuming segmented download of %s to %s, %s of %s bytes "
+                "remaining",
+                task.url,
+                part_path,
+                sum(end + 1 - offset for _, end, offset in state["segments"]),
+                state["size"],
+            )
+        lock = threading.Lock()
+        stop = threading.Event()
+        progress = {"unsaved": 0}
+        pending = [
+            segment
+            for segment in state["segments"]
+            if segment[2] <= segment[1]
+        ]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, len(pending)),
+                thread_name_prefix="segment",
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self._fetch_segment,
+                        fd,
+                        segment,
+                        state,
+                        state_path,
+                        lock,
+                        stop,
+                        progress,
+                        logger,
+                    )
+                    for segment in pending
+                ]
+                concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_EXCEPTION
+                )
+                stop.set()
+            errors = [f.exception() for f in futures if f.exception()]
+        finally:
+            os.close(fd)
+            with lock:
+                self._save_state(state_path, state)
+        if any(isinstance(error, RangeNotSupported) for error in errors):
+            logger.info(
+                "Server did not honour the Range request for %s, "
+                "downloading it as a single stream",
+                task.url,
+            )
+            os.remove(state_path)
+            os.remove(part_path)
+            return False
+        if errors:
+            raise errors[0]
+        missing = sum(end + 1 - offset for _, end, offset in state["segments"])
+        if missing or os.path.getsize(part_path) != state["size"]:
+            raise TransferError(
+                f"segmented download of {task.url} is incomplete, {missing} "
+                f"of {state['size']} bytes missing"
+            )
+        return True
+
+    def _segment_state(self, part_path: str, state_path: str) -> dict:
+        """
+        Load the sidecar of a partial segmented download, if it can be
+        resumed with the current number of segments
+            :param part_path (str):     Partial file path
+            :param state_path (str):    Sidecar path
+            :return (dict):             Sidecar state, or None
+        """
+        if not (os.path.exists(state_path) and os.path.exists(part_path)):
+            return None
+        try:
+            with open(state_path, encoding="utf-8") as file:
+                state = json.load(file)
+        except ValueError:
+            return None
+        if "segments" not in state or os.path.getsize(part_path) != (
+            state["size"]
+        ):
+            return None
+        return state
+
+    def _split(self, size: int) -> list:
+        """
+        Split a file into byte ranges of near equal size
+            :param size (int):  File size in bytes
+            :return (list):     [start, end, next offset] of each range, end
+                                being inclusive
+        """
+        length = -(-size // self.segments)
+        return [
+            [start, min(start + length, size) - 1, start]
+            for start in range(0, size, length)
+        ]
+
+    def _fetch_segment(
+        self,
+        fd: int,
+        segment: list,
+        state: dict,
+        state_path: str,
+        lock: threading.Lock,
+        stop: threading.Event,
+        progress: dict,
+        logger: logging.Logger,
+    ) -> None:
+        """
+        Download one byte range of a file, writing each chunk at its offset
+        and recording the range's progress in the sidecar every
+        config.HTTP["STATE_INTERVAL"] bytes across all ranges. Each chunk is
+        counted against the bandwidth throttle. Stops early if another range
+        fails
+            :param fd (int):                File descriptor of the partial file
+            :param segment (list):          [start, end, next offset] of the
+                                            range, next offset is updated
+            :param state (dict):            Sidecar state
+            :param state_path (str):        Sidecar path
+            :param lock (threading.Lock):   Guards the sidecar state
+            :param stop (threading.Event):  Set when another range fails
+            :param progress (dict):         Bytes written since the sidecar
+                                            was last saved
+            :param logger (obj):            Python logging object
+        """
+        _, end, offset = segment
+        headers = {"Range": f"bytes={offset}-{end}"}
+        validator = state["etag"] or state["last_modified"]
+        if validator and not validator.startswith("W/"):
+            headers["If-Range"] = validator
+        conn, response, url = self.pool.request("GET", state["url"], headers)
+        try:
+            if response.status == 200:
+                raise RangeNotSupported(
+                    "server returned the whole file for a Range request"
+                )
+            if response.status != 206:
+                raise TransferError(
+                    f"server returned HTTP {response.status} "
+                    f"{response.reason} for bytes {offset}-{end}",
+                    response.status,
+                )
+            match = re.fullmatch(
+                r"bytes (\d+)-(\d+)/(\d+|\*)",
+                (response.getheader("Content-Range") or "").strip(),
+            )
+            if not match or (int(match.group(1)), int(match.group(2))) != (
+                offset,
+                end,
+            ):
+                raise TransferError(
+                    "server returned an unexpected Content-Range for bytes "
+                    f"{offset}-{end}: {response.getheader('Content-Range')}"
+                )
+            while offset <= end and not stop.is_set():
+                chunk = response.read(min(self.chunk_size, end + 1 - offset))
+                if not chunk:
+                    break
+                self.throttle.consume(len(chunk), logger)
+                self._write_at(fd, chunk, offset)
+                offset += len(chunk)
+                with lock:
+                    segment[2] = offset
+                    progress["unsaved"] += len(chunk)
+                    if progress["unsaved"] >= config.HTTP["STATE_INTERVAL"]:
+                        self._save_state(state_path, state)
+                        progress["unsaved"] = 0
+        except BaseException:
+            conn.close()
+            raise
+        if offset <= end:
+            conn.close()
+            if stop.is_set():
+                return
+            raise TransferError(
+                f"received {offset - segment[0]} of {end + 1 - segment[0]} "
+                f"bytes of the range starting at byte {segment[0]}"
+            )
+        self.pool.finish(url, conn, response)
+
+    @staticmethod
+    def _write_at(fd: int, data: bytes, offset: int) -> None:
+        """
+        Write bytes to a file at an offset without moving the file position,
+        so ranges can be written from several threads at once
+            :param fd (int):        File descriptor
+            :param data (bytes):    Bytes to write
+            :param offset (int):    File offset to write at
+        """
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(fd, view, offset)
+            else:
+                # Windows has no pwrite, each range is written in turn
+                with HttpTransport._write_lock:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    written = os.write(fd, view)
+            view = view[written:]
+            offset += written
+
+    def close(self) -> None:
+        """
+        Close all pooled connections
+        """
+        self.pool.close()
+
+
+class ProbeResult:
+    """
+    Result of probing a URL
+
+    Attributes
+        url (str):              Probed URL
+        status (int):           HTTP status, or None if the request failed
+        size (int):             File size in bytes, if reported
+        accept_ranges (bool):   True if the server supports Range requests
+        etag (str):             ETag validator, if reported
+        last_modified (str):    Last-Modified validator, if reported
+        error (str):            Description of the failure, if any
+    """
+
+    __slots__ = (
+        "url",
+        "status",
+        "size",
+        "accept_ranges",
+        "etag",
+        "last_modified",
+        "error",
+    )
+
+    def __init__(self, url: str):
+        """
+        Constructor for the ProbeResult class
+            :param url (str):   Probed URL
+        """
+        self.url = url
+        self.status = None
+        self.size = None
+        self.accept_ranges = False
+        self.etag = None
+        self.last_modified = None
+        self.error = None
+
+    @property
+    def reachable(self) -> bool:
+        """
+        True if the server will serve the file
+        """
+        return self.status in (200, 206)
+
+    @property
+    def validator(self) -> str:
+        """
+        ETag of the file, or its Last-Modified time and size, or None if the
+        server reported neither
+        """
+        if self.etag:
+            return self.etag
+        if self.last_modified:
+            return f"{self.last_modified} {self.size}"
+        return None
+
+
+class UrlProber:
+    """
+    Probe URLs for their size, Range support and validators without
+    downloading them. A HEAD request is sent, falling back to a GET for the
+    first byte if the server does not accept HEAD
+
+    Methods
+        probe()
+            Probe a URL, returning a ProbeResult. Never raises
+        _send()
+            Send the probe request and read the headers into the result
+    """
+
+    def __init__(self, pool: ConnectionPool = None):
+        """
+        Constructor for the UrlProber class
+            :param pool (ConnectionPool):   Connection pool to send probes on,
+                                            a new pool is used if not supplied
+        """
+        self.pool = pool or ConnectionPool(
+            config.HTTP["MAX_IDLE"], config.HTTP["TIMEOUT"]
+        )
+
+    def probe(self, url: str) -> ProbeResult:
+        """
+        Probe a URL, returning a ProbeResult. Never raises
+            :param url (str):       URL to probe
+            :return (ProbeResult):  Probe result
+        """
+        result = ProbeResult(url)
+        try:
+            self._send(result, "HEAD", {})
+            if result.status in (403, 405, 501):
+                self._send(result, "GET", {"Range": "bytes=0-0"})
+        except (OSError, TransferError, http.client.HTTPException) as error:
+            result.status = None
+            result.error = f"{type(error).__name__}: {error}"
+        if result.status is not None and not result.reachable:
+            result.error = f"HTTP {result.status}"
+        return result
+
+    def _send(self, result: ProbeResult, method: str, headers: dict) -> None:
+        """
+        Send the probe request and read the headers into the result
+            :param result (ProbeResult):    Result to update
+            :param method (str):            HEAD or GET
+            :param headers (dict):          Request headers
+        """
+        conn, response, url = self.pool.request(method, result.url, headers)
+        try:
+            response.read()
+        except BaseException:
+            conn.close()
+            raise
+        self.pool.finish(url, conn, response)
+        result.status = response.status
+        result.etag = response.getheader("ETag")
+        result.last_modified = response.getheader("Last-Modified")
+        result.accept_ranges = (
+            response.getheader("Accept-Ranges", "").lower() == "bytes"
+            or response.status == 206
+        )
+        content_range = re.fullmatch(
+            r"bytes \d+-\d+/(\d+)",
+            (response.getheader("Content-Range") or "").strip(),
+        )
+        if content_range:
+            result.size = int(content_range.group(1))
+        elif response.status == 200 and response.getheader("Content-Length"):
+            result.size = int(response.getheader("Content-Length"))
+
+
+TRANSPORTS = {
+    BitsTransport.name: BitsTransport,
+    HttpTransport.name: HttpTransport,
+}
+
+
+def get_transport(name: str):
+    """
+    Return a transport object for the named backend
+        :param name (str):  Transport name, a key of TRANSPORTS
+        :return (obj):      Transport object
+    """
+    return TRANSPORTS[name]()
+
+
+def destination_path(url: str, destination: str) -> str:
+    """
+    Return the path a file is downloaded to. As with Start-BitsTransfer
+    given a directory destination, the file name is taken from the URL
+        :param url (str):           Download URL
+        :param destination (str):   Destination directory
+        :return (str):              Destination file path
+    """
+    filename = urllib.parse.unquote(
+        posixpath.basename(urllib.parse.urlsplit(url).path)
+    )
+    return os.path.join(destination, filename)
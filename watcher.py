@@ -0,0 +1,206 @@
+""" watcher.py
+
+Watch the CSV folder for new CSV files, for the daemon mode of
+process_duty_csv. On Linux the folder is watched with inotify (through
+ctypes, as the standard library has no binding), so a CSV is reported as
+soon as it has been written or moved into the folder. Elsewhere, or if
+inotify cannot be used, the folder is polled, and a CSV is reported once its
+size and modification time are unchanged between two polls, so that files
+still being copied in are not picked up
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import config
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_EVENT_HEADER = struct.Struct("iIII")
+
+
+class FolderWatcher:
+    """
+    Report CSV files that land in a folder. Files already in the folder when
+    the watcher starts are reported by the first call to wait()
+
+    Methods
+        wait()
+            Wait for CSV files to land in the folder and return their paths
+        close()
+            Stop watching the folder
+        _start_inotify()
+            Start watching the folder with inotify, if available
+        _read_inotify()
+            Wait for inotify events and return the CSV files they name
+        _poll()
+            Return the CSV files that have become stable since the last poll
+        _scan()
+            Return the size and modification time of each CSV in the folder
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        logger: logging.Logger,
+        poll_interval: float = config.DAEMON["POLL_INTERVAL"],
+    ):
+        """
+        Constructor for the FolderWatcher class
+            :param folder (str):            Folder to watch
+            :param logger (obj):            Python logging object
+            :param poll_interval (float):   Seconds between polls when
+                                            inotify is not available
+        """
+        self.folder = folder
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self._fd = self._start_inotify()
+        # Size and modification time of each CSV at the last poll, and when
+        # it was last reported
+        self._seen = self._scan()
+        self._reported = dict(self._seen)
+        self._pending = sorted(self._seen)
+        if self._fd is None:
+            self.logger.info(
+                "Polling %s for new CSV files every %ss",
+                self.folder,
+                self.poll_interval,
+            )
+        else:
+            self.logger.info("Watching %s for new CSV files", self.folder)
+
+    def wait(self, timeout: float) -> list:
+        """
+        Wait for CSV files to land in the folder and return their paths
+            :param timeout (float): Maximum seconds to wait
+            :return (list):         Paths of the CSV files that landed, empty
+                                    if none landed before the timeout
+        """
+        if self._pending:
+            names, self._pending = self._pending, []
+        elif self._fd is not None:
+            names = self._read_inotify(timeout)
+        else:
+            time.sleep(min(timeout, self.poll_interval))
+            names = self._poll()
+        return [os.path.join(self.folder, name) for name in names]
+
+    def close(self) -> None:
+        """
+        Stop watching the folder
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _start_inotify(self) -> int:
+        """
+        Start watching the folder with inotify, if available
+            :return (int):  inotify file descriptor, or None to poll instead
+        """
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+            )
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            watch = libc.inotify_add_watch(
+                fd, os.fsencode(self.folder), IN_CLOSE_WRITE | IN_MOVED_TO
+            )
+            if watch < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            return fd
+        except (OSError, AttributeError) as exception:
+            self.logger.info(
+                "inotify is not available (%s), polling instead", exception
+            )
+            return None
+
+    def _read_inotify(self, timeout: float) -> list:
+        """
+        Wait for inotify events and return the CSV files they name. If the
+        event queue overflowed, the folder is scanned instead
+            :param timeout (float): Maximum seconds to wait
+            :return (list):         Names of the CSV files
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        except OSError as exception:
+            if exception.errno == errno.EINTR:
+                return []
+            raise
+        names = []
+        offset = 0
+        while offset + IN_EVENT_HEADER.size <= len(data):
+            _, mask, _, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return sorted(self._scan())
+            if name.lower().endswith(".csv") and name not in names:
+                names.append(name)
+        return names
+
+    def _poll(self) -> list:
+        """
+        Return the CSV files whose size and modification time are unchanged
+        since the last poll and have not been reported since they last
+        changed
+            :return (list): Names of the CSV files
+        """
+        current = self._scan()
+        names = sorted(
+            name
+            for name, stat in current.items()
+            if self._seen.get(name) == stat
+            and self._reported.get(name) != stat
+        )
+        self._reported = {
+            name: stat
+            for name, stat in self._reported.items()
+            if name in current
+        }
+        for name in names:
+            self._reported[name] = current[name]
+        self._seen = current
+        return names
+
+    def _scan(self) -> dict:
+        """
+        Return the size and modification time of each CSV in the folder
+            :return (dict): (size, mtime) keyed by file name
+        """
+        stats = {}
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError as exception:
+            self.logger.error(
+                "%s was raised when scanning %s: %s",
+                type(exception).__name__,
+                self.folder,
+                exception,
+            )
+            return stats
+        for entry in entries:
+            if entry.name.lower().endswith(".csv") and entry.is_file():
+                stat = entry.stat()
+                stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return stats